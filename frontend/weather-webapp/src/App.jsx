@@ -2,6 +2,7 @@ import React, { useState, useEffect } from 'react';
 import styled, { createGlobalStyle } from 'styled-components';
 import WeatherDisplay from './components/WeatherDisplay';
 import { LanguageProvider } from './contexts/LanguageContext';
+import { subscribe } from './services/stream';
 
 const GlobalStyle = createGlobalStyle`
   * {
@@ -76,10 +77,42 @@ function App() {
     }
   };
 
+  // Merge changed sensors pushed by /api/stream into the current list
+  const applySensorChanges = (changes) => {
+    setData(prev => {
+      const current = prev || [];
+      const updated = current.map(sensor => changes[sensor.entity_id] || sensor);
+      const added = Object.values(changes).filter(
+        sensor => !current.some(s => s.entity_id === sensor.entity_id)
+      );
+      return [...updated, ...added];
+    });
+    setError(null);
+    setLoading(false);
+  };
+
   useEffect(() => {
     fetchData();
-    const interval = setInterval(fetchData, 60000); // Update every minute
-    return () => clearInterval(interval);
+
+    let interval = null;
+    const startPolling = () => {
+      if (!interval) {
+        interval = setInterval(fetchData, 60000); // Update every minute
+      }
+    };
+
+    // Prefer pushed updates; poll only when the stream is unavailable
+    const unsubscribe = subscribe('sensors', applySensorChanges, startPolling);
+    if (!unsubscribe) {
+      startPolling();
+    }
+
+    return () => {
+      clearInterval(interval);
+      if (unsubscribe) {
+        unsubscribe();
+      }
+    };
   }, []);
 
   if (loading) {
@@ -2,6 +2,7 @@ import React, { useState, useEffect, useContext } from 'react';
 import styled from 'styled-components';
 import { LanguageContext } from '../contexts/LanguageContext';
 import { translations } from '../config/translations';
+import { subscribe } from '../services/stream';
 
 const StatsContainer = styled.div`
   background: rgba(16, 16, 28, 0.95);
@@ -58,8 +59,30 @@ const SiteStats = () => {
     };
 
     fetchStats();
-    const interval = setInterval(fetchStats, 60000); // Update every minute
-    return () => clearInterval(interval);
+
+    let interval = null;
+    const startPolling = () => {
+      if (!interval) {
+        interval = setInterval(fetchStats, 60000); // Update every minute
+      }
+    };
+
+    // Stats deltas are pushed over /api/stream; poll only as a fallback
+    const unsubscribe = subscribe(
+      'stats',
+      (changes) => setStats(prev => ({ ...prev, ...changes })),
+      startPolling
+    );
+    if (!unsubscribe) {
+      startPolling();
+    }
+
+    return () => {
+      clearInterval(interval);
+      if (unsubscribe) {
+        unsubscribe();
+      }
+    };
   }, []);
 
   if (!stats) return null;
@@ -1,6 +1,7 @@
 import React, { useState, useEffect } from 'react';
 import { ResponsiveContainer, LineChart, Line, XAxis, YAxis, Tooltip, ReferenceLine } from 'recharts';
 import styled from 'styled-components';
+import { CHART_POINTS } from '../config/sensors';
 
 const ChartContainer = styled.div`
   width: 100%;
@@ -114,7 +115,7 @@ const WeatherChart = ({ data, unit, precision, sensorType, entityId }) => {
     try {
       setError(null);
       const response = await fetch(
-        `${import.meta.env.VITE_BACKEND_URL}/api/sensors/${entityId}/history?offset=${offset}`
+        `${import.meta.env.VITE_BACKEND_URL}/api/sensors/${entityId}/history?offset=${offset}&points=${CHART_POINTS}`
       );
       
       if (response.ok) {
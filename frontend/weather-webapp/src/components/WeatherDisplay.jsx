@@ -1,6 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import styled, { keyframes } from 'styled-components';
-import { sensorConfig } from '../config/sensors';
+import { sensorConfig, CHART_POINTS, HISTORY_REFRESH_MS } from '../config/sensors';
 import WeatherChart from './WeatherChart';
 import WindCompass from './WindCompass';
 import SiteStats from './SiteStats';
@@ -67,6 +67,11 @@ const LastUpdated = styled.div`
   margin-top: 10px;
 `;
 
+const StaleNote = styled.div`
+  color: #ffff44;
+  margin-top: 3px;
+`;
+
 const ErrorMessage = styled.div`
   color: #ff4444;
   text-align: center;
@@ -99,14 +104,30 @@ const WeatherDisplay = ({ data, error }) => {
     return Number(value).toFixed(precision);
   };
 
-  const fetchHistory = async (sensorId) => {
+  // One batched request fills every chart on the page
+  const fetchHistory = async (sensorIds) => {
     try {
-      const response = await fetch(`${import.meta.env.VITE_BACKEND_URL}/api/sensors/${sensorId}/history`);
+      const response = await fetch(
+        `${import.meta.env.VITE_BACKEND_URL}/api/history?ids=${sensorIds.join(',')}&points=${CHART_POINTS}`
+      );
       if (response.ok) {
-        const data = await response.json();
+        const result = await response.json();
+        const bySensor = {};
+        Object.entries(result.series).forEach(([sensorId, series]) => {
+          bySensor[sensorId] = {
+            min: series.min,
+            max: series.max,
+            current: series.current,
+            history: result.timestamps
+              .map((timestamp, i) => ({ last_updated: timestamp, state: series.values[i] }))
+              .filter(item => item.state !== null),
+            start_time: result.start_time,
+            end_time: result.end_time
+          };
+        });
         setHistoricalData(prev => ({
           ...prev,
-          [sensorId]: data
+          ...bySensor
         }));
       }
     } catch (error) {
@@ -114,13 +135,19 @@ const WeatherDisplay = ({ data, error }) => {
     }
   };
 
+  // Streamed updates replace data often; history is refetched on a timer
+  // and whenever the sensor set changes
+  const sensorIds = data ? data.map(sensor => sensor.entity_id).join(',') : '';
+
   useEffect(() => {
-    if (data) {
-      data.forEach(sensor => {
-        fetchHistory(sensor.entity_id);
-      });
+    if (!sensorIds) {
+      return undefined;
     }
-  }, [data]);
+    const refresh = () => fetchHistory(sensorIds.split(','));
+    refresh();
+    const interval = setInterval(refresh, HISTORY_REFRESH_MS);
+    return () => clearInterval(interval);
+  }, [sensorIds]);
 
   const renderValue = (sensor, config) => {
     let value = sensor.state;
@@ -208,6 +235,11 @@ const WeatherDisplay = ({ data, error }) => {
             />
             <LastUpdated>
               Poslednji put ažurirano: {new Date(sensor.last_updated).toLocaleString()}
+              {sensor.stale && (
+                <StaleNote>
+                  Senzor trenutno nedostupan, prikazana je vrednost od pre {Math.round(sensor.stale_age / 60)} min
+                </StaleNote>
+              )}
             </LastUpdated>
           </WeatherCard>
         );
@@ -68,4 +68,10 @@ export const sensorConfig = {
     description: 'Pritisak sveden na nivo mora',
     unit: 'hPa'
   }
-}; 
\ No newline at end of file
+};
+
+// Points requested per history chart; the backend downsamples to this
+export const CHART_POINTS = 300;
+
+// How often charts and the pressure trend are refetched while the page is open
+export const HISTORY_REFRESH_MS = 5 * 60 * 1000;
@@ -0,0 +1,67 @@
+// Shared Server-Sent Events connection to /api/stream.
+// One EventSource per tab, shared by every component that subscribes.
+
+const STREAM_URL = `${import.meta.env.VITE_BACKEND_URL}/api/stream`;
+
+let source = null;
+const handlers = {};
+const fallbacks = new Set();
+
+const connect = () => {
+  source = new EventSource(STREAM_URL);
+
+  source.onerror = () => {
+    // EventSource retries on its own; CLOSED means the endpoint is unavailable
+    if (source.readyState === EventSource.CLOSED) {
+      console.warn('Stream unavailable, falling back to polling');
+      source = null;
+      fallbacks.forEach(fallback => fallback());
+      fallbacks.clear();
+    }
+  };
+};
+
+const listen = (event) => {
+  source.addEventListener(event, (message) => {
+    try {
+      const data = JSON.parse(message.data);
+      (handlers[event] || []).forEach(handler => handler(data));
+    } catch (error) {
+      console.error('Invalid stream message:', error);
+    }
+  });
+};
+
+// Subscribe to a stream event ('sensors', 'stats' or 'lightning').
+// Returns an unsubscribe function, or null when streaming is not supported.
+// onUnavailable is called if the stream cannot be used so the caller can poll.
+export const subscribe = (event, handler, onUnavailable) => {
+  if (typeof EventSource === 'undefined') {
+    return null;
+  }
+
+  if (!source) {
+    connect();
+    Object.keys(handlers).forEach(listen);
+  }
+
+  if (!handlers[event]) {
+    handlers[event] = [];
+    listen(event);
+  }
+  handlers[event].push(handler);
+  if (onUnavailable) {
+    fallbacks.add(onUnavailable);
+  }
+
+  return () => {
+    handlers[event] = handlers[event].filter(h => h !== handler);
+    if (onUnavailable) {
+      fallbacks.delete(onUnavailable);
+    }
+    if (source && Object.values(handlers).every(list => list.length === 0)) {
+      source.close();
+      source = null;
+    }
+  };
+};
@@ -0,0 +1,409 @@
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict, defaultdict, deque
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import Request
+
+from app.config import settings
+from app.hll import HyperLogLog
+from app import analytics_store, metrics
+
+# Get the FastAPI logger
+logger = logging.getLogger("main")
+
+# Define path for analytics data
+ANALYTICS_FILE = Path(__file__).parent.parent / 'data' / 'analytics.json'
+
+# Add session tracking
+SESSION_DURATION = 30 * 60  # 30 minutes in seconds
+
+# Hours of visit counts kept for hourly_stats and last_24h_visits
+HOURLY_WINDOW = 24
+
+# Per-period unique visitor sketches kept in memory and on disk
+DAILY_SKETCH_DAYS = 7
+MONTHLY_SKETCH_MONTHS = 12
+
+HOUR_FORMAT = '%Y-%m-%d %H:00'
+
+# Visits waiting for the background worker: (client IP, epoch seconds)
+visit_queue: deque = deque(maxlen=settings.ANALYTICS_QUEUE_SIZE)
+metrics.Gauge('analytics_queue_depth', 'Visits waiting for the analytics worker', lambda: len(visit_queue))
+
+_worker: Optional[asyncio.Task] = None
+_dirty = False
+_last_save = 0.0
+
+class SessionTracker:
+    """Active sessions per IP, ordered by last activity so expiry is amortized O(1)"""
+
+    def __init__(self, duration: float):
+        self.duration = duration
+        self.last_seen: "OrderedDict[str, float]" = OrderedDict()
+
+    def expire(self, now: float) -> None:
+        """Drop sessions idle for longer than the session duration"""
+        # The least recently active session is always first
+        while self.last_seen:
+            ip, timestamp = next(iter(self.last_seen.items()))
+            if now - timestamp <= self.duration:
+                break
+            self.last_seen.popitem(last=False)
+
+    def touch(self, client_ip: str, now: float) -> bool:
+        """Record activity for an IP; returns True if this starts a new session"""
+        self.expire(now)
+        is_new = client_ip not in self.last_seen
+        self.last_seen[client_ip] = now
+        self.last_seen.move_to_end(client_ip)
+        return is_new
+
+    def active(self, now: float) -> int:
+        self.expire(now)
+        return len(self.last_seen)
+
+class HourlyCounter:
+    """Visit counts for the last `hours` hours in a ring buffer indexed by epoch hour"""
+
+    def __init__(self, hours: int = HOURLY_WINDOW):
+        self.hours = hours
+        self.epochs = [-1] * hours
+        self.counts = [0] * hours
+
+    def add(self, timestamp: float, n: int = 1) -> None:
+        hour = int(timestamp // 3600)
+        slot = hour % self.hours
+        if self.epochs[slot] != hour:
+            if self.epochs[slot] > hour:
+                # Older than the window
+                return
+            # Slot last held a count from `hours` or more hours ago
+            self.epochs[slot] = hour
+            self.counts[slot] = 0
+        self.counts[slot] += n
+
+    def _window(self, now: float):
+        """(epoch hour, count) pairs inside the window, oldest first"""
+        current = int(now // 3600)
+        return sorted(
+            (hour, count) for hour, count in zip(self.epochs, self.counts)
+            if current - self.hours < hour <= current and count
+        )
+
+    def add_hour(self, hour: int, n: int) -> None:
+        self.add(hour * 3600, n)
+
+    def total(self, now: float) -> int:
+        return sum(count for _, count in self._window(now))
+
+    def to_dict(self, now: float) -> Dict[str, int]:
+        """Counts keyed by local hour ('%Y-%m-%d %H:00'), as stored in analytics.json"""
+        return {
+            datetime.fromtimestamp(hour * 3600).strftime(HOUR_FORMAT): count
+            for hour, count in self._window(now)
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, int], hours: int = HOURLY_WINDOW) -> 'HourlyCounter':
+        counter = cls(hours)
+        for key, count in data.items():
+            try:
+                counter.add(datetime.strptime(key, HOUR_FORMAT).timestamp(), count)
+            except ValueError:
+                continue
+        return counter
+
+def load_visitor_sketch(value) -> HyperLogLog:
+    """Load a visitor sketch, migrating the old list-of-IPs format"""
+    if isinstance(value, dict):
+        return HyperLogLog.from_dict(value)
+    # Older analytics.json files store every client IP
+    return HyperLogLog.from_values(value or [])
+
+def load_analytics():
+    """Load analytics data from file"""
+    try:
+        if ANALYTICS_FILE.exists():
+            with open(ANALYTICS_FILE, 'r') as f:
+                data = json.load(f)
+                return {
+                    'total_visits': data.get('total_visits', 0),
+                    'unique_visitors': load_visitor_sketch(data.get('unique_visitors')),
+                    'daily_visitors': {k: HyperLogLog.from_dict(v) for k, v in data.get('daily_visitors', {}).items()},
+                    'monthly_visitors': {k: HyperLogLog.from_dict(v) for k, v in data.get('monthly_visitors', {}).items()},
+                    'hourly_stats': HourlyCounter.from_dict(data.get('hourly_stats', {})),
+                    'sensor_requests': defaultdict(int, data.get('sensor_requests', {})),
+                    'last_save': data.get('last_save', datetime.now().isoformat())
+                }
+    except Exception as e:
+        logger.error(f"Error loading analytics: {e}")
+
+    return {
+        'total_visits': 0,
+        'unique_visitors': HyperLogLog(),
+        'daily_visitors': {},
+        'monthly_visitors': {},
+        'hourly_stats': HourlyCounter(),
+        'sensor_requests': defaultdict(int),
+        'last_save': datetime.now().isoformat()
+    }
+
+def serialize_analytics(data) -> str:
+    """Snapshot analytics data as JSON (runs on the event loop, so the data cannot change mid-write)"""
+    return json.dumps({
+        'total_visits': data['total_visits'],
+        'unique_visitors': data['unique_visitors'].to_dict(),
+        'daily_visitors': {k: v.to_dict() for k, v in data['daily_visitors'].items()},
+        'monthly_visitors': {k: v.to_dict() for k, v in data['monthly_visitors'].items()},
+        'hourly_stats': data['hourly_stats'].to_dict(time.time()),
+        'sensor_requests': dict(data['sensor_requests']),
+        'last_save': datetime.now().isoformat()
+    })
+
+def write_analytics_file(payload: str) -> None:
+    """Atomically replace analytics.json: write a temp file, fsync, then rename"""
+    ANALYTICS_FILE.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=ANALYTICS_FILE.parent, prefix='.analytics-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, ANALYTICS_FILE)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+async def save_analytics(data) -> None:
+    """Save analytics data to file without blocking the event loop"""
+    try:
+        await asyncio.to_thread(write_analytics_file, serialize_analytics(data))
+        logger.info("Analytics data saved successfully")
+    except Exception as e:
+        logger.error(f"Error saving analytics: {e}")
+
+def add_unique_visitor(data: dict, client_ip: str, now: datetime) -> None:
+    """Add a visitor to the all-time, daily and monthly sketches"""
+    data['unique_visitors'].add(client_ip)
+
+    for key, period, keep in (
+        ('daily_visitors', now.strftime('%Y-%m-%d'), DAILY_SKETCH_DAYS),
+        ('monthly_visitors', now.strftime('%Y-%m'), MONTHLY_SKETCH_MONTHS),
+    ):
+        sketches = data[key]
+        if period not in sketches:
+            sketches[period] = HyperLogLog()
+            # Keys sort chronologically; drop the oldest periods
+            for old in sorted(sketches)[:-keep]:
+                del sketches[old]
+        sketches[period].add(client_ip)
+
+def count_unique_visitors(sketches: Dict[str, HyperLogLog], periods: List[str]) -> int:
+    """Distinct visitors across several periods, by merging their sketches"""
+    merged = HyperLogLog()
+    for period in periods:
+        if period in sketches:
+            merged.merge(sketches[period])
+    return merged.count()
+
+def visit_periods(timestamp: float) -> List[Tuple[str, str]]:
+    """Shared-store sketch keys a visit counts towards"""
+    when = datetime.fromtimestamp(timestamp)
+    return [('all', 'all'), ('daily', when.strftime('%Y-%m-%d')), ('monthly', when.strftime('%Y-%m'))]
+
+def is_shared() -> bool:
+    """Whether analytics live in the SQLite store shared by all workers"""
+    return settings.ANALYTICS_BACKEND == 'sqlite'
+
+# Initialize analytics from file
+analytics_data = load_analytics()
+sessions = SessionTracker(SESSION_DURATION)
+
+# Stats reused by compute_stats until visits are applied or the hour changes
+_stats: Optional[dict] = None
+_stats_key: Optional[tuple] = None
+_version = 0
+
+def get_client_ip(request: Request) -> str:
+    """Get client IP from Cloudflare or fallback to direct IP"""
+    return request.headers.get('cf-connecting-ip') or request.headers.get('x-real-ip') or request.client.host
+
+def record_visit(request: Request) -> None:
+    """Queue a visit for the analytics worker; O(1) on the request path"""
+    try:
+        visit_queue.append((get_client_ip(request), time.time()))
+    except Exception as e:
+        logger.error(f"Error recording visit: {e}")
+
+def apply_visits(visits: List[Tuple[str, float]]) -> None:
+    """Aggregate a batch of queued visits into the analytics data"""
+    global _dirty, _version
+    for client_ip, timestamp in visits:
+        # Only count as visit if it's a new session
+        if not sessions.touch(client_ip, timestamp):
+            continue
+
+        # Update total visits, unique visitors and hourly stats
+        analytics_data['total_visits'] += 1
+        add_unique_visitor(analytics_data, client_ip, datetime.fromtimestamp(timestamp))
+        analytics_data['hourly_stats'].add(timestamp)
+        _dirty = True
+    _version += 1
+
+def drain_queue() -> List[Tuple[str, float]]:
+    """Take all queued visits"""
+    visits = []
+    while visit_queue:
+        visits.append(visit_queue.popleft())
+    return visits
+
+def hourly_window_start(now: float) -> int:
+    """First epoch hour inside the hourly stats window"""
+    return int(now // 3600) - HOURLY_WINDOW + 1
+
+async def flush(force_save: bool = False) -> None:
+    """Apply queued visits and save to disk when due"""
+    global _dirty, _last_save
+    visits = drain_queue()
+    if is_shared():
+        if visits:
+            await asyncio.to_thread(
+                analytics_store.apply_visits, visits, SESSION_DURATION,
+                visit_periods, hourly_window_start(time.time())
+            )
+        return
+
+    if visits:
+        apply_visits(visits)
+
+    now = time.time()
+    if _dirty and (force_save or now - _last_save >= settings.ANALYTICS_SAVE_INTERVAL):
+        _dirty = False
+        _last_save = now
+        await save_analytics(analytics_data)
+
+async def run_worker() -> None:
+    """Background task that batches queued visits and saves on a timer"""
+    while True:
+        await asyncio.sleep(settings.ANALYTICS_FLUSH_INTERVAL)
+        try:
+            await flush()
+        except Exception as e:
+            logger.error(f"Error updating analytics: {e}")
+
+def import_file_data() -> None:
+    """Seed an empty shared store from analytics.json"""
+    sketches = {('all', 'all'): analytics_data['unique_visitors']}
+    sketches.update({('daily', k): v for k, v in analytics_data['daily_visitors'].items()})
+    sketches.update({('monthly', k): v for k, v in analytics_data['monthly_visitors'].items()})
+    hourly = analytics_data['hourly_stats']
+    imported = analytics_store.import_data(
+        analytics_data['total_visits'],
+        {hour: count for hour, count in zip(hourly.epochs, hourly.counts) if count},
+        sketches,
+        dict(analytics_data['sensor_requests'])
+    )
+    if imported:
+        logger.info(f"Analytics: imported {ANALYTICS_FILE.name} into {analytics_store.ANALYTICS_DB.name}")
+
+async def start() -> None:
+    """Open the shared store if configured and start the analytics worker"""
+    global _worker
+    if is_shared():
+        await asyncio.to_thread(import_file_data)
+    if _worker is None or _worker.done():
+        _worker = asyncio.create_task(run_worker())
+
+async def stop() -> None:
+    """Stop the worker and persist everything still queued"""
+    global _worker
+    if _worker is not None:
+        _worker.cancel()
+        try:
+            await _worker
+        except asyncio.CancelledError:
+            pass
+        _worker = None
+    await flush(force_save=True)
+    if is_shared():
+        analytics_store.close_store()
+
+def build_stats(total_visits: int, unique_visitors: HyperLogLog, daily: Dict[str, HyperLogLog],
+                monthly: Dict[str, HyperLogLog], hourly: HourlyCounter,
+                sensor_requests: Dict[str, int], now: float) -> dict:
+    """Site statistics without the active session count"""
+    # Unique visitors today, over the last 7 days and this month
+    today = datetime.fromtimestamp(now)
+    last_7_days = [(today - timedelta(days=i)).strftime('%Y-%m-%d') for i in range(7)]
+
+    return {
+        'total_visits': total_visits,
+        'unique_visitors': unique_visitors.count(),
+        'unique_visitors_today': count_unique_visitors(daily, last_7_days[:1]),
+        'unique_visitors_7d': count_unique_visitors(daily, last_7_days),
+        'unique_visitors_month': count_unique_visitors(monthly, [today.strftime('%Y-%m')]),
+        'last_24h_visits': hourly.total(now),
+        'active_sessions': 0,
+        'hourly_stats': hourly.to_dict(now),
+        'sensor_stats': dict(sensor_requests)
+    }
+
+def _shared_stats(now: float) -> dict:
+    """Stats from the shared store, reread only after any worker committed"""
+    global _stats, _stats_key
+    key = (analytics_store.data_version(), int(now // 3600))
+    if _stats is None or key != _stats_key:
+        snapshot = analytics_store.read_snapshot(hourly_window_start(now))
+        sketches = snapshot['sketches']
+        hourly = HourlyCounter()
+        for hour, count in snapshot['hourly'].items():
+            hourly.add_hour(hour, count)
+
+        _stats = build_stats(
+            snapshot['total_visits'],
+            sketches.get(('all', 'all'), HyperLogLog()),
+            {period: sketch for (kind, period), sketch in sketches.items() if kind == 'daily'},
+            {period: sketch for (kind, period), sketch in sketches.items() if kind == 'monthly'},
+            hourly,
+            snapshot['sensor_requests'],
+            now
+        )
+        _stats_key = key
+    return {**_stats, 'active_sessions': analytics_store.active_sessions(now - SESSION_DURATION)}
+
+def stats_version(stats: dict) -> tuple:
+    """
+    Version of the latest compute_stats() result: the key its cached part was
+    built for plus the live session count, so callers need not compare stats
+    """
+    return _stats_key, stats['active_sessions']
+
+async def compute_stats() -> dict:
+    """Site statistics, recomputed only when visits were applied or the hour changed"""
+    global _stats, _stats_key
+    now = time.time()
+    if is_shared():
+        return await asyncio.to_thread(_shared_stats, now)
+
+    key = (_version, int(now // 3600))
+    if _stats is None or key != _stats_key:
+        _stats = build_stats(
+            analytics_data['total_visits'],
+            analytics_data['unique_visitors'],
+            analytics_data['daily_visitors'],
+            analytics_data['monthly_visitors'],
+            analytics_data['hourly_stats'],
+            analytics_data['sensor_requests'],
+            now
+        )
+        _stats_key = key
+
+    # Sessions expire continuously; counting them is amortized O(1)
+    return {**_stats, 'active_sessions': sessions.active(now)}
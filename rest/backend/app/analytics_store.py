@@ -0,0 +1,236 @@
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from app.hll import HyperLogLog
+
+# Get the FastAPI logger
+logger = logging.getLogger("main")
+
+# Analytics shared by all worker processes on this host
+ANALYTICS_DB = Path(__file__).parent.parent / 'data' / 'analytics.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS sessions (
+    ip TEXT PRIMARY KEY,
+    last_seen REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_last_seen ON sessions (last_seen);
+
+CREATE TABLE IF NOT EXISTS hourly (
+    hour INTEGER PRIMARY KEY,
+    visits INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS sketches (
+    kind TEXT NOT NULL,
+    period TEXT NOT NULL,
+    p INTEGER NOT NULL,
+    registers BLOB NOT NULL,
+    PRIMARY KEY (kind, period)
+);
+
+CREATE TABLE IF NOT EXISTS sensor_requests (
+    sensor_id TEXT PRIMARY KEY,
+    requests INTEGER NOT NULL
+);
+"""
+
+# Sketch kinds and how many periods of each are kept ('all' has a single period)
+SKETCH_KINDS = {'all': 1, 'daily': 7, 'monthly': 12}
+
+# A queued visit: (client IP, epoch seconds)
+Visit = Tuple[str, float]
+
+_conn: Optional[sqlite3.Connection] = None
+_db_lock = threading.Lock()
+
+# Commits made by this process; PRAGMA data_version only counts other connections
+_writes = 0
+
+def _connect() -> sqlite3.Connection:
+    """Open the store in WAL mode; transactions are managed explicitly"""
+    ANALYTICS_DB.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(ANALYTICS_DB, check_same_thread=False, isolation_level=None, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+def get_connection() -> sqlite3.Connection:
+    """Shared connection, opened on first use"""
+    global _conn
+    if _conn is None:
+        _conn = _connect()
+    return _conn
+
+def close_store() -> None:
+    """Close the shared connection"""
+    global _conn
+    with _db_lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+
+def _write(conn: sqlite3.Connection, apply) -> None:
+    """
+    Run apply(conn) in a write transaction. BEGIN IMMEDIATE takes the write
+    lock up front, so read-modify-write updates from several workers serialize.
+    """
+    global _writes
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        apply(conn)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    _writes += 1
+
+def _merge_sketch(conn: sqlite3.Connection, kind: str, period: str, sketch: HyperLogLog) -> None:
+    """Merge a sketch into the stored one and drop periods beyond the kept count"""
+    row = conn.execute(
+        "SELECT p, registers FROM sketches WHERE kind = ? AND period = ?", (kind, period)
+    ).fetchone()
+    if row:
+        sketch = HyperLogLog(row[0], row[1]).merge(sketch)
+    conn.execute(
+        "INSERT OR REPLACE INTO sketches (kind, period, p, registers) VALUES (?, ?, ?, ?)",
+        (kind, period, sketch.p, bytes(sketch.registers))
+    )
+    if not row:
+        # Period keys sort chronologically
+        conn.execute(
+            "DELETE FROM sketches WHERE kind = ? AND period NOT IN "
+            "(SELECT period FROM sketches WHERE kind = ? ORDER BY period DESC LIMIT ?)",
+            (kind, kind, SKETCH_KINDS[kind])
+        )
+
+def _add_counts(conn: sqlite3.Connection, total: int, hourly: Dict[int, int], window_start: int) -> None:
+    conn.execute(
+        "INSERT INTO counters (name, value) VALUES ('total_visits', ?) "
+        "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+        (total,)
+    )
+    conn.executemany(
+        "INSERT INTO hourly (hour, visits) VALUES (?, ?) "
+        "ON CONFLICT(hour) DO UPDATE SET visits = visits + excluded.visits",
+        hourly.items()
+    )
+    conn.execute("DELETE FROM hourly WHERE hour < ?", (window_start,))
+
+def apply_visits(visits: List[Visit], session_duration: float, periods, window_start: int) -> int:
+    """
+    Apply a batch of visits from one worker in a single transaction.
+
+    periods(timestamp) returns the (kind, period) keys a visit counts towards;
+    hourly rows before window_start (an epoch hour) are dropped. Returns the
+    number of new sessions.
+    """
+    # First and last visit per IP; a batch spans seconds, far less than a session
+    seen: Dict[str, List[float]] = {}
+    for client_ip, timestamp in visits:
+        if client_ip in seen:
+            seen[client_ip][1] = timestamp
+        else:
+            seen[client_ip] = [timestamp, timestamp]
+
+    new_sessions = 0
+
+    def apply(conn: sqlite3.Connection) -> None:
+        nonlocal new_sessions
+        hourly: Dict[int, int] = {}
+        sketches: Dict[Tuple[str, str], HyperLogLog] = {}
+        for client_ip, (first, last) in seen.items():
+            row = conn.execute("SELECT last_seen FROM sessions WHERE ip = ?", (client_ip,)).fetchone()
+            conn.execute(
+                "INSERT INTO sessions (ip, last_seen) VALUES (?, ?) "
+                "ON CONFLICT(ip) DO UPDATE SET last_seen = MAX(last_seen, excluded.last_seen)",
+                (client_ip, last)
+            )
+            # Only count as visit if it's a new session
+            if row and first - row[0] <= session_duration:
+                continue
+            new_sessions += 1
+            hour = int(first // 3600)
+            hourly[hour] = hourly.get(hour, 0) + 1
+            for key in periods(first):
+                sketches.setdefault(key, HyperLogLog()).add(client_ip)
+
+        if new_sessions:
+            _add_counts(conn, new_sessions, hourly, window_start)
+            for (kind, period), sketch in sketches.items():
+                _merge_sketch(conn, kind, period, sketch)
+        # Expire idle sessions; the index makes this proportional to what is removed
+        newest = max(last for _, last in seen.values())
+        conn.execute("DELETE FROM sessions WHERE last_seen < ?", (newest - session_duration,))
+
+    with _db_lock:
+        _write(get_connection(), apply)
+    return new_sessions
+
+def import_data(total_visits: int, hourly: Dict[int, int], sketches: Dict[Tuple[str, str], HyperLogLog],
+                sensor_requests: Dict[str, int]) -> bool:
+    """Seed an empty store (e.g. from analytics.json); returns False if it already has data"""
+    imported = False
+
+    def apply(conn: sqlite3.Connection) -> None:
+        nonlocal imported
+        # Checked inside the write transaction, so only one worker imports
+        if conn.execute("SELECT 1 FROM counters LIMIT 1").fetchone():
+            return
+        _add_counts(conn, total_visits, hourly, 0)
+        for (kind, period), sketch in sketches.items():
+            _merge_sketch(conn, kind, period, sketch)
+        conn.executemany(
+            "INSERT INTO sensor_requests (sensor_id, requests) VALUES (?, ?)", sensor_requests.items()
+        )
+        imported = True
+
+    with _db_lock:
+        _write(get_connection(), apply)
+    return imported
+
+def data_version() -> Tuple[int, int]:
+    """Changes whenever any process commits to the store"""
+    with _db_lock:
+        return get_connection().execute("PRAGMA data_version").fetchone()[0], _writes
+
+def active_sessions(since: float) -> int:
+    with _db_lock:
+        return get_connection().execute(
+            "SELECT COUNT(*) FROM sessions WHERE last_seen >= ?", (since,)
+        ).fetchone()[0]
+
+def read_snapshot(window_start: int) -> dict:
+    """Totals, hourly counts, sketches and sensor counters read in one consistent transaction"""
+    with _db_lock:
+        conn = get_connection()
+        conn.execute("BEGIN")
+        try:
+            row = conn.execute("SELECT value FROM counters WHERE name = 'total_visits'").fetchone()
+            snapshot = {
+                'total_visits': row[0] if row else 0,
+                'hourly': dict(conn.execute(
+                    "SELECT hour, visits FROM hourly WHERE hour >= ?", (window_start,)
+                ).fetchall()),
+                'sketches': {
+                    (kind, period): HyperLogLog(p, registers)
+                    for kind, period, p, registers in conn.execute(
+                        "SELECT kind, period, p, registers FROM sketches"
+                    )
+                },
+                'sensor_requests': dict(conn.execute(
+                    "SELECT sensor_id, requests FROM sensor_requests"
+                ).fetchall())
+            }
+        finally:
+            conn.execute("COMMIT")
+    return snapshot
@@ -1,17 +1,22 @@
 from fastapi import APIRouter, HTTPException, Request
-from typing import List, Optional, Literal, Dict, Tuple
-import httpx
-from pydantic import BaseModel, Field
+from fastapi.responses import Response, StreamingResponse
+from typing import List, Optional, Dict, Tuple
+import asyncio
+import json
+import numpy as np
+from pydantic import BaseModel
 from app.config import settings
+from app.ha_client import fetch_states
+from app import ha_websocket
+from app.stream import broadcaster
+from app import history_store, downsample, lightning, analytics, geoip, derived, series
+from app.payload import Payload, get_payload, respond
+from app.sensors import get_spec
+from app.telemetry import timed
+from app.metrics import CACHE_REQUESTS
 from datetime import datetime, timedelta
 import logging
-from collections import defaultdict
-from ipaddress import ip_address
 import time
-from math import exp
-import json
-import os
-from pathlib import Path
 
 # Get the FastAPI logger
 logger = logging.getLogger("main")
@@ -23,141 +28,37 @@ router = APIRouter(prefix="/api", tags=["sensors"])
 sensor_cache: Dict[str, Tuple[list, datetime]] = {}
 CACHE_TTL = 60  # seconds
 
-# Lightning history cache
-lightning_history_cache = {}
-lightning_history_cache_time = None
-lightning_history_cache_duration = 3600  # 1 hour
+# In-flight sensor refresh shared by all concurrent cache misses
+sensor_refresh_task: Optional[asyncio.Task] = None
 
-# Define path for analytics data
-ANALYTICS_FILE = Path(__file__).parent.parent / 'data' / 'analytics.json'
+# WebSocket store version the sensor cache was last built from
+sensor_store_version = -1
 
-# Add session tracking
-SESSION_DURATION = 30 * 60  # 30 minutes in seconds
-active_sessions = {}
+# Sensors of the last cache update served from their last good state; logged when it changes
+cache_stale_sensors = 0
 
-def is_new_session(client_ip: str) -> bool:
-    """Check if this is a new session for the IP"""
-    current_time = time.time()
-    
-    # Clean up expired sessions
-    expired = [ip for ip, timestamp in active_sessions.items() 
-              if current_time - timestamp > SESSION_DURATION]
-    for ip in expired:
-        del active_sessions[ip]
-    
-    # Check if this is a new session
-    if client_ip not in active_sessions:
-        active_sessions[client_ip] = current_time
-        return True
-    
-    # Update session timestamp
-    active_sessions[client_ip] = current_time
-    return False
+# format=ndjson responses: one JSON object per line
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
 
-def load_analytics():
-    """Load analytics data from file"""
-    try:
-        if ANALYTICS_FILE.exists():
-            with open(ANALYTICS_FILE, 'r') as f:
-                data = json.load(f)
-                return {
-                    'total_visits': data.get('total_visits', 0),
-                    'unique_visitors': set(data.get('unique_visitors', [])),
-                    'hourly_stats': defaultdict(int, data.get('hourly_stats', {})),
-                    'sensor_requests': defaultdict(int, data.get('sensor_requests', {})),
-                    'last_save': data.get('last_save', datetime.now().isoformat())
-                }
-    except Exception as e:
-        logger.error(f"Error loading analytics: {e}")
-    
-    return {
-        'total_visits': 0,
-        'unique_visitors': set(),
-        'hourly_stats': defaultdict(int),
-        'sensor_requests': defaultdict(int),
-        'last_save': datetime.now().isoformat()
-    }
-
-def save_analytics(data):
-    """Save analytics data to file"""
-    try:
-        # Create data directory if it doesn't exist
-        ANALYTICS_FILE.parent.mkdir(parents=True, exist_ok=True)
-        
-        # Prepare data for saving
-        save_data = {
-            'total_visits': data['total_visits'],
-            'unique_visitors': list(data['unique_visitors']),  # Convert set to list
-            'hourly_stats': dict(data['hourly_stats']),
-            'sensor_requests': dict(data['sensor_requests']),
-            'last_save': datetime.now().isoformat()
-        }
-        
-        with open(ANALYTICS_FILE, 'w') as f:
-            json.dump(save_data, f)
-            
-        logger.info("Analytics data saved successfully")
-    except Exception as e:
-        logger.error(f"Error saving analytics: {e}")
-
-# Initialize analytics from file
-analytics_data = load_analytics()
-
-def get_cached_data() -> Optional[list]:
-    """Get cached sensor data if it's still valid"""
-    if not sensor_cache:
-        logger.info("🔄 CACHE: Empty cache")
-        return None
-        
+def get_cache_entry() -> Tuple[Optional[list], Optional[float]]:
+    """Get cached sensor data and its age in seconds, regardless of freshness"""
     data, timestamp = sensor_cache.get('sensors', (None, None))
     if not data or not timestamp:
-        logger.info("🔄 CACHE: No data or timestamp")
-        return None
-        
-    age = (datetime.now() - timestamp).total_seconds()
-    if age > CACHE_TTL:
-        logger.info(f"🔄 CACHE: Expired ({age:.1f} seconds old)")
-        return None
-        
-    logger.info(f"✅ CACHE HIT! Data is {age:.1f} seconds old")
-    return data
+        return None, None
+    return data, (datetime.now() - timestamp).total_seconds()
 
 def update_cache(data: list) -> None:
     """Update the cache with new sensor data"""
+    global cache_stale_sensors
     sensor_cache['sensors'] = (data, datetime.now())
-    logger.info(f"💾 CACHE: Updated with {len(data)} sensors at {datetime.now().strftime('%H:%M:%S')}")
-
-def update_analytics(request: Request):
-    """Update analytics data for each request"""
-    try:
-        # Get client IP from Cloudflare or fallback to direct IP
-        client_ip = request.headers.get('cf-connecting-ip') or request.headers.get('x-real-ip') or request.client.host
-        
-        # Only count as visit if it's a new session
-        if is_new_session(client_ip):
-            # Update total visits
-            analytics_data['total_visits'] += 1
-            
-            # Update unique visitors
-            analytics_data['unique_visitors'].add(client_ip)
-            
-            # Update hourly stats
-            current_hour = datetime.now().strftime('%Y-%m-%d %H:00')
-            analytics_data['hourly_stats'][current_hour] += 1
-            
-            # Clean up old hourly stats (keep last 24 hours)
-            cutoff = datetime.now() - timedelta(hours=24)
-            analytics_data['hourly_stats'] = {
-                k: v for k, v in analytics_data['hourly_stats'].items()
-                if datetime.strptime(k, '%Y-%m-%d %H:00') > cutoff
-            }
-            
-            # Save to file periodically (every 10 visits)
-            if analytics_data['total_visits'] % 10 == 0:
-                save_analytics(analytics_data)
-            
-    except Exception as e:
-        logger.error(f"Error updating analytics: {e}")
+    # Runs on every sensor change; only switches between live and degraded data are worth INFO
+    stale = sum(1 for sensor in data if sensor.get('stale'))
+    if stale and not cache_stale_sensors:
+        logger.warning(f"Sensor cache: {stale} of {len(data)} sensors served from their last good state")
+    elif cache_stale_sensors and not stale:
+        logger.info("Sensor cache: all sensors live again")
+    cache_stale_sensors = stale
+    logger.debug(f"Sensor cache: updated with {len(data)} sensors")
 
 # Debug route to check if API is accessible
 @router.get("/ping")
@@ -197,71 +98,11 @@ class SensorData(BaseModel):
     
     @property
     def sensor_type(self) -> str:
-        if "temperature" in self.entity_id:
-            return "temperature"
-        elif "humidity" in self.entity_id:
-            return "humidity"
-        elif "pressure" in self.entity_id:
-            return "pressure"
-        elif "wind" in self.entity_id:
-            return "wind"
-        elif "uv" in self.entity_id:
-            return "uv"
-        elif "solar" in self.entity_id:
-            return "solar"
-        elif "rain" in self.entity_id:
-            return "rain"
-        elif "lightning" in self.entity_id:
-            return "lightning"
-        return "unknown"
+        return get_spec(self.entity_id).sensor_type
     
     def validate_state(self) -> bool:
         """Validates state based on sensor type"""
-        try:
-            # Handle lightning sensors that can be null or unknown
-            if self.sensor_type == "lightning":
-                if self.state in ["null", "None", "unknown", "unavailable"]:
-                    return True
-                if "counter" in self.entity_id:
-                    # Counter should always be a number >= 0
-                    value = float(self.state)
-                    return value >= 0
-                elif "azimuth" in self.entity_id:
-                    # Azimuth should be 0-360 degrees or null/unknown
-                    if self.state in ["null", "None", "unknown", "unavailable"]:
-                        return True
-                    value = float(self.state)
-                    return 0 <= value <= 360
-                elif "distance" in self.entity_id:
-                    # Distance can be null/unknown or positive number
-                    if self.state in ["null", "None", "unknown", "unavailable"]:
-                        return True
-                    value = float(self.state)
-                    return value >= 0
-                return True
-            
-            # Handle other sensor types
-            value = float(self.state)
-            if self.sensor_type == "temperature":
-                return -50 <= value <= 60
-            elif self.sensor_type == "humidity":
-                return 0 <= value <= 100
-            elif self.sensor_type == "pressure":
-                return 900 <= value <= 1100
-            elif self.sensor_type == "wind":
-                return 0 <= value <= 360 if "direction" in self.entity_id else value >= 0
-            elif self.sensor_type == "uv":
-                return 0 <= value <= 20
-            elif self.sensor_type == "solar":
-                return value >= 0
-            elif self.sensor_type == "rain":
-                return value >= 0
-            return True
-        except ValueError:
-            # For lightning sensors, "null", "unknown", etc. are valid
-            if self.sensor_type == "lightning" and self.state in ["null", "None", "unknown", "unavailable"]:
-                return True
-            return False
+        return get_spec(self.entity_id).validate(self.state)
 
 def parse_sensor_ids(sensor_ids):
     """Parse sensor IDs from various formats"""
@@ -275,34 +116,137 @@ def parse_sensor_ids(sensor_ids):
     cleaned = sensor_ids.strip('[]"\' ')
     return [s.strip() for s in cleaned.split(',')]
 
-def calculate_relative_pressure(absolute_pressure: float, altitude: float, temperature: float) -> float:
-    """
-    Calculate mean sea level pressure using the International Standard Atmosphere formula:
-    P0 = P1 (1 - (0.0065h/ (T + 0.0065h + 273.15)))-5.257
+def build_sensor_responses(states: Dict[str, dict]) -> list:
+    """Validate and format raw Home Assistant states, keeping configured order"""
+    responses = []
+    with timed('validate'):
+        # Derived metrics are computed once per update, before transforms change states
+        context = derived.update(states)
+        for sensor_id, sensor_data in states.items():
+            try:
+                SensorData(**sensor_data)
+                # Type, bounds and formatting were resolved once for each entity
+                if get_spec(sensor_id).process(sensor_data, context):
+                    responses.append(sensor_data)
+                else:
+                    logger.warning(f"Invalid state value for sensor {sensor_id}: {sensor_data['state']}")
+            except Exception as e:
+                logger.warning(f"Validation error for sensor {sensor_id}: {e}")
+    return responses
+
+async def refresh_sensor_data() -> list:
+    """Fetch all configured sensors from Home Assistant and refill the cache"""
+    logger.info("⚡ CACHE MISS: Fetching fresh data from Home Assistant")
+    states = await fetch_states(settings.sensor_list)
+    responses = build_sensor_responses(states)
     
-    Parameters:
-    - absolute_pressure: Station pressure (P1) in hPa
-    - altitude: Station elevation (h) in meters
-    - temperature: Temperature (T) in Celsius
+    if not responses:
+        raise HTTPException(
+            status_code=500, 
+            detail="No valid sensor data retrieved. Check server logs for details."
+        )
     
-    Returns:
-    - Mean sea level pressure (P0) in hPa
+    # Update cache with new data
+    update_cache(responses)
+    logger.info(f"Successfully retrieved and cached {len(responses)} sensors")
+    return responses
+
+def _on_refresh_done(task: asyncio.Task) -> None:
+    """Log failures of a sensor refresh, including background ones nobody awaits"""
+    if not task.cancelled() and task.exception():
+        logger.error(f"Sensor refresh failed: {task.exception()}")
+
+def start_sensor_refresh() -> asyncio.Task:
+    """Start a sensor refresh unless one is already in flight (single-flight)"""
+    global sensor_refresh_task
+    if sensor_refresh_task is None or sensor_refresh_task.done():
+        sensor_refresh_task = asyncio.create_task(refresh_sensor_data())
+        sensor_refresh_task.add_done_callback(_on_refresh_done)
+    return sensor_refresh_task
+
+def get_store_sensor_data() -> Optional[list]:
+    """Build sensor data from the WebSocket store, rebuilding only when it changed"""
+    global sensor_store_version
+    version = ha_websocket.store_version
+    data, _ = get_cache_entry()
+    if data is not None and version == sensor_store_version:
+        return data
+    
+    with timed('cache'):
+        states = ha_websocket.get_states(settings.sensor_list)
+    responses = build_sensor_responses(states)
+    if not responses:
+        return None
+    update_cache(responses)
+    sensor_store_version = version
+    return responses
+
+async def get_sensor_snapshot() -> Tuple[list, float, str]:
+    """
+    Returns (data, age in seconds, freshness) for the sensor cache, where
+    freshness is 'fresh', 'stale' (served while revalidating) or 'degraded'
+    (Home Assistant failed and some or all of the data is older than it looks).
+    
+    While the WebSocket store is live it is read directly with no upstream
+    I/O. Otherwise the REST cache is used: fresh data is returned as is. Within CACHE_STALE_GRACE seconds after
+    expiry the stale value is returned immediately while one background
+    refresh runs. Beyond that, callers wait on the shared in-flight refresh.
     """
+    if ha_websocket.is_live():
+        data = get_store_sensor_data()
+        if data is not None:
+            CACHE_REQUESTS.inc('sensors', 'store')
+            return data, 0.0, 'fresh'
+    
+    with timed('cache'):
+        data, age = get_cache_entry()
+    if data is not None:
+        if age <= CACHE_TTL:
+            CACHE_REQUESTS.inc('sensors', 'hit')
+            return data, age, freshness_of(data, 'fresh')
+        if age <= CACHE_TTL + settings.CACHE_STALE_GRACE:
+            logger.info(f"♻️ CACHE: Serving stale data ({age:.1f}s old), revalidating")
+            CACHE_REQUESTS.inc('sensors', 'stale')
+            start_sensor_refresh()
+            return data, age, freshness_of(data, 'stale')
+    
+    CACHE_REQUESTS.inc('sensors', 'miss')
     try:
-        # P0 = P1 (1 - (0.0065h/ (T + 0.0065h + 273.15)))-5.257
-        P1 = float(absolute_pressure)
-        h = float(altitude)
-        T = float(temperature)
-        
-        denominator = T + (0.0065 * h) + 273.15
-        fraction = (0.0065 * h) / denominator
-        
-        P0 = P1 * pow(1 - fraction, -5.257)
-        
-        return round(P0, 1)
-    except Exception as e:
-        logger.error(f"Error calculating sea level pressure: {e}")
-        return absolute_pressure
+        # Shield so a disconnecting client does not cancel the shared refresh
+        refreshed = await asyncio.shield(start_sensor_refresh())
+    except Exception:
+        if data is None:
+            raise
+        # Home Assistant is unreachable: expired data beats an error
+        logger.warning(f"♻️ CACHE: Refresh failed, serving expired data ({age:.1f}s old)")
+        return data, age, 'degraded'
+    return refreshed, 0.0, freshness_of(refreshed, 'fresh')
+
+def freshness_of(data: list, freshness: str) -> str:
+    """'degraded' if any sensor was filled in from its last good state"""
+    return 'degraded' if any(sensor.get('stale') for sensor in data) else freshness
+
+def respond_snapshot(request: Request, payload: Payload, age: float, freshness: str) -> Response:
+    """
+    Respond with data from the sensor snapshot, reporting its freshness.
+    Degraded data is sent with no-store so Cloudflare and browsers do not
+    keep it as if it were current.
+    """
+    headers = {
+        "Age": str(int(age)),
+        "X-Cache-Age": f"{age:.1f}",
+        "X-Cache-Stale": "false" if freshness == 'fresh' else "true"
+    }
+    if freshness == 'degraded':
+        headers["Cache-Control"] = "no-store"
+    # Caches subtract Age from max-age themselves, so max-age is the full TTL
+    return respond(
+        request,
+        payload,
+        max_age=CACHE_TTL,
+        stale_while_revalidate=settings.CACHE_STALE_GRACE,
+        headers=headers
+    )
 
 @router.get(
     "/sensors",
@@ -313,147 +257,145 @@ def calculate_relative_pressure(absolute_pressure: float, altitude: float, tempe
 async def get_sensor_data(request: Request):
     """
     Fetches current sensor data from Home Assistant.
-    Uses cache if data is less than 60 seconds old.
+    Uses cache if data is less than 60 seconds old and serves stale data
+    while revalidating within the configured grace window.
     """
-    update_analytics(request)
-    cached_data = get_cached_data()
-    if cached_data:
-        logger.info("🎯 CACHE: Serving cached data")
-        return cached_data
-        
-    logger.info("⚡ CACHE MISS: Fetching fresh data from Home Assistant")
-    headers = {
-        "Authorization": f"Bearer {settings.HASS_TOKEN}",
-        "Content-Type": "application/json",
-    }
+    analytics.record_visit(request)
     
     try:
-        async with httpx.AsyncClient() as client:
-            responses = []
-            sensor_ids = settings.sensor_list
-            
-            for sensor_id in sensor_ids:
-                try:
-                    url = f"{settings.HASS_URL}/api/states/{sensor_id}"
-                    response = await client.get(
-                        url,
-                        headers=headers,
-                        timeout=10.0
-                    )
-                    
-                    if response.status_code == 200:
-                        sensor_data = response.json()
-                        try:
-                            validated_data = SensorData(**sensor_data)
-                            if validated_data.validate_state():
-                                # If this is absolute pressure, calculate relative pressure
-                                if 'absolute_pressure' in sensor_id:
-                                    # Get temperature for calculation
-                                    temp_sensor = next(
-                                        (s for s in responses if 'temperature' in s['entity_id']),
-                                        None
-                                    )
-                                    temp = float(temp_sensor['state']) if temp_sensor else 15  # default temp if not found
-                                    
-                                    try:
-                                        abs_pressure = float(sensor_data['state'])
-                                        rel_pressure = calculate_relative_pressure(
-                                            abs_pressure,
-                                            float(settings.STATION_ALTITUDE),
-                                            temp
-                                        )
-                                        
-                                        # Add both pressures to attributes
-                                        sensor_data['attributes']['absolute_pressure'] = abs_pressure
-                                        sensor_data['attributes']['relative_pressure'] = rel_pressure
-                                        # Update the main state to show relative pressure
-                                        sensor_data['state'] = str(rel_pressure)
-                                    except (ValueError, TypeError) as e:
-                                        logger.error(f"Error calculating relative pressure: {e}")
-                                
-                                # Handle lightning sensor data formatting
-                                if 'lightning' in sensor_id:
-                                    if 'azimuth' in sensor_id:
-                                        # Format azimuth: show degrees or "No strikes"
-                                        if sensor_data['state'] in ['null', 'None', 'unknown', 'unavailable']:
-                                            sensor_data['state'] = 'No strikes'
-                                            sensor_data['attributes']['formatted_value'] = 'No strikes'
-                                        else:
-                                            try:
-                                                degrees = float(sensor_data['state'])
-                                                sensor_data['attributes']['formatted_value'] = f"{degrees}°"
-                                            except ValueError:
-                                                sensor_data['attributes']['formatted_value'] = sensor_data['state']
-                                    
-                                    elif 'distance' in sensor_id:
-                                        # Format distance: show km or "No strikes"
-                                        if sensor_data['state'] in ['null', 'None', 'unknown', 'unavailable']:
-                                            sensor_data['state'] = 'No strikes'
-                                            sensor_data['attributes']['formatted_value'] = 'No strikes'
-                                        else:
-                                            try:
-                                                km = float(sensor_data['state'])
-                                                sensor_data['attributes']['formatted_value'] = f"{km} km"
-                                            except ValueError:
-                                                sensor_data['attributes']['formatted_value'] = sensor_data['state']
-                                    
-                                    elif 'counter' in sensor_id:
-                                        # Counter is always a number, format nicely
-                                        try:
-                                            count = int(float(sensor_data['state']))
-                                            sensor_data['attributes']['formatted_value'] = f"{count} strikes"
-                                        except ValueError:
-                                            sensor_data['attributes']['formatted_value'] = sensor_data['state']
-                                
-                                responses.append(sensor_data)
-                            else:
-                                print(f"Invalid state value for sensor {sensor_id}: {sensor_data['state']}")
-                        except Exception as e:
-                            print(f"Validation error for sensor {sensor_id}: {e}")
-                    else:
-                        print(f"Error fetching sensor {sensor_id}: HTTP {response.status_code}")
-                except Exception as e:
-                    print(f"Request error for sensor {sensor_id}: {str(e)}")
-                    continue
-            
-            if not responses:
-                raise HTTPException(
-                    status_code=500, 
-                    detail="No valid sensor data retrieved. Check server logs for details."
-                )
-            
-            # Update cache with new data
-            update_cache(responses)
-            print(f"Successfully retrieved and cached {len(responses)} sensors")
-            
-            return responses
-            
+        data, age, freshness = await get_sensor_snapshot()
     except Exception as e:
-        print(f"Error in get_sensor_data: {str(e)}")
+        logger.error(f"Error in get_sensor_data: {str(e)}")
         raise HTTPException(
             status_code=500, 
             detail=f"Failed to fetch sensor data: {str(e)}"
         )
+    
+    # Serialized once per cache refresh; report freshness to the client
+    return respond_snapshot(request, get_payload('sensors', data), age, freshness)
+
+def parse_time_range(start: Optional[str], end: Optional[str], default_hours: int = 24) -> Tuple[datetime, datetime]:
+    """Parse ISO start/end query parameters; naive times are taken as server local time"""
+    try:
+        end_time = datetime.fromisoformat(end) if end else datetime.now()
+        end_time = end_time.astimezone() if end_time.tzinfo is None else end_time
+        start_time = datetime.fromisoformat(start) if start else end_time - timedelta(hours=default_hours)
+        start_time = start_time.astimezone() if start_time.tzinfo is None else start_time
+    except ValueError:
+        raise HTTPException(status_code=400, detail="start and end must be ISO 8601 timestamps")
+    
+    if start_time >= end_time:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    return start_time, end_time
+
+async def get_rollup_history(sensor_id: str, granularity: str, start_time: datetime,
+                             end_time: datetime, synced: bool) -> dict:
+    """History response built from precomputed rollup buckets"""
+    buckets = await history_store.query_rollups(sensor_id, granularity, start_time.timestamp(), end_time.timestamp())
+    if not buckets and not synced:
+        raise HTTPException(status_code=502, detail="Error fetching history")
+    
+    history = []
+    for bucket, v_min, v_max, mean, count, last in buckets:
+        timestamp = history_store.ts_to_iso(bucket)
+        history.append({
+            'entity_id': sensor_id,
+            'state': str(round(mean, 3)),
+            'last_changed': timestamp,
+            'last_updated': timestamp,
+            'min': v_min,
+            'max': v_max,
+            'mean': mean,
+            'count': count,
+            'last': last
+        })
+    
+    return {
+        'min': min(b[1] for b in buckets) if buckets else None,
+        'max': max(b[2] for b in buckets) if buckets else None,
+        'current': buckets[-1][5] if buckets else None,
+        'history': history,
+        'granularity': granularity,
+        # Buckets are aligned to UTC, so a '1d' bucket is a UTC day, not a local one
+        'bucket_timezone': 'UTC',
+        'start_time': start_time.isoformat(),
+        'end_time': end_time.isoformat(),
+        'has_more': bool(buckets)
+    }
+
+async def stream_sensor_history(sensor_id: str, start_time: datetime, end_time: datetime, synced: bool):
+    """NDJSON lines for stored samples, read in chunks; the last line holds the summary"""
+    count, total, v_min, v_max, current = 0, 0.0, None, None, None
+    async for times, values, states in series.iter_chunks(sensor_id, start_time.timestamp(), end_time.timestamp()):
+        lines = [
+            json.dumps({'entity_id': sensor_id, 'state': state, 'last_changed': timestamp, 'last_updated': timestamp})
+            for state, timestamp in zip(states.tolist(), history_store.ts_to_iso_array(times))
+        ]
+        yield '\n'.join(lines) + '\n'
+        
+        # Running statistics; percentiles would need the whole range in memory
+        count += len(values)
+        total += float(values.sum())
+        v_min = float(values.min()) if v_min is None else min(v_min, float(values.min()))
+        v_max = float(values.max()) if v_max is None else max(v_max, float(values.max()))
+        current = float(values[-1])
+    
+    yield json.dumps({'summary': {
+        'min': v_min,
+        'max': v_max,
+        'mean': total / count if count else None,
+        'current': current,
+        'count': count,
+        'start_time': start_time.isoformat(),
+        'end_time': end_time.isoformat(),
+        'complete': synced
+    }}) + '\n'
 
 @router.get("/sensors/{sensor_id}/history")
-async def get_sensor_history(sensor_id: str, request: Request, offset: int = 0):
-    """Returns 24 hours of data for a sensor with specified offset in days"""
+async def get_sensor_history(
+    sensor_id: str,
+    request: Request,
+    offset: int = 0,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    granularity: str = "raw",
+    points: Optional[int] = None,
+    resolution: Optional[str] = None,
+    format: str = "json"
+):
+    """
+    Returns 24 hours of data for a sensor with specified offset in days,
+    or an arbitrary start/end range.
+    With granularity 5m, 1h or 1d, precomputed rollups (min, max, mean,
+    count, last per bucket) are returned instead of raw samples.
+    With points= or resolution= (e.g. 5m) raw series are downsampled with LTTB;
+    min, max and current are always computed from the full data.
+    With format=ndjson raw samples are streamed one per line, followed by a
+    summary line, without loading the whole range into memory.
+    """
     try:
-        # Add headers for Home Assistant API
-        headers = {
-            "Authorization": f"Bearer {settings.HASS_TOKEN}",
-            "Content-Type": "application/json",
-        }
-        
-        # Calculate timestamps for the requested period
-        now = datetime.now()
+        if history_store.unknown_entities([sensor_id]):
+            raise HTTPException(status_code=404, detail="Unknown sensor")
         
         # Don't allow fetching future data
         if offset < 0:
             raise HTTPException(status_code=400, detail="Cannot fetch future data")
-            
-        end_time = now - timedelta(days=offset)
-        start_time = end_time - timedelta(hours=24)
+        
+        if granularity != "raw" and granularity not in history_store.ROLLUP_GRANULARITIES:
+            raise HTTPException(status_code=400, detail="Granularity must be 'raw', '5m', '1h' or '1d'")
+        
+        if format not in ("json", "ndjson"):
+            raise HTTPException(status_code=400, detail="Format must be 'json' or 'ndjson'")
+        if format == "ndjson" and (granularity != "raw" or points is not None or resolution is not None):
+            raise HTTPException(status_code=400, detail="format=ndjson streams raw samples only")
+        
+        # Calculate timestamps for the requested period
+        if start or end:
+            start_time, end_time = parse_time_range(start, end)
+        else:
+            now = datetime.now().astimezone()
+            end_time = now - timedelta(days=offset)
+            start_time = end_time - timedelta(hours=24)
         
         # Format timestamps in ISO format
         start_time_iso = start_time.isoformat()
@@ -461,90 +403,238 @@ async def get_sensor_history(sensor_id: str, request: Request, offset: int = 0):
         
         logger.info(f"Fetching history for {sensor_id} from {start_time_iso} to {end_time_iso}")
         
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{settings.HASS_URL}/api/history/period/{start_time_iso}",
-                headers=headers,
-                params={
-                    "filter_entity_id": sensor_id,
-                    "end_time": end_time_iso,
-                    "minimal_response": False
-                }
+        # Serve from the local store, syncing only what is missing from HA
+        synced = await history_store.sync_range(sensor_id, start_time.timestamp(), end_time.timestamp())
+        if format == "ndjson":
+            return StreamingResponse(
+                stream_sensor_history(sensor_id, start_time, end_time, synced),
+                media_type=NDJSON_MEDIA_TYPE
             )
+        if granularity != "raw":
+            return await get_rollup_history(sensor_id, granularity, start_time, end_time, synced)
+        # Columns of valid numeric samples; range rules come from the sensor registry
+        times, values, states = await series.load(sensor_id, start_time.timestamp(), end_time.timestamp())
+        
+        if not len(times) and not synced:
+            raise HTTPException(status_code=502, detail="Error fetching history")
+        
+        if len(times):
+            try:
+                target = downsample.target_points(points, resolution, end_time.timestamp() - start_time.timestamp())
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
             
-            if response.status_code == 200:
-                data = response.json()
-                if data and len(data) > 0:
-                    history = data[0]
-                    
-                    # Filter and validate values
-                    values = []
-                    filtered_history = []
-                    for item in history:
-                        try:
-                            if item['state'].replace('-', '').replace('.', '').isdigit():
-                                value = float(item['state'])
-                                if 'last_updated' not in item:
-                                    item['last_updated'] = item.get('last_changed')
-                                values.append(value)
-                                filtered_history.append(item)
-                        except (ValueError, AttributeError):
-                            continue
-                    
-                    if values:
-                        stats = {
-                            'min': min(values),
-                            'max': max(values),
-                            'current': values[-1],
-                            'history': filtered_history,
-                            'start_time': start_time_iso,
-                            'end_time': end_time_iso,
-                            'has_more': True
-                        }
-                        return stats
-                    
-                # Return empty data structure when no data is found
-                return {
-                    'min': None,
-                    'max': None,
-                    'current': None,
-                    'history': [],
-                    'start_time': start_time_iso,
-                    'end_time': end_time_iso,
-                    'has_more': False
+            selected_times, selected_states = times, states
+            if target is not None and target < len(times):
+                selected = downsample.lttb(times, values, target)
+                selected_times, selected_states = times[selected], states[selected]
+            
+            filtered_history = [
+                {
+                    'entity_id': sensor_id,
+                    'state': state,
+                    'last_changed': timestamp,
+                    'last_updated': timestamp
                 }
-                    
-            logger.error(f"Error fetching history: HTTP {response.status_code}")
-            raise HTTPException(status_code=response.status_code, detail="Error fetching history")
+                for state, timestamp in zip(selected_states.tolist(), history_store.ts_to_iso_array(selected_times))
+            ]
+            
+            # Statistics always cover the full data, not the downsampled points
+            stats = {
+                **series.summarize(values),
+                'history': filtered_history,
+                'start_time': start_time_iso,
+                'end_time': end_time_iso,
+                'has_more': True
+            }
+            
+            if target is not None:
+                stats['downsampling'] = {
+                    'method': 'lttb',
+                    'points': len(filtered_history),
+                    'raw_points': len(times)
+                }
+                # Min/max envelope keeps short extremes visible for temperature and pressure
+                if get_spec(sensor_id).sensor_type in ('temperature', 'pressure'):
+                    stats['envelope'] = [
+                        {
+                            'time': history_store.ts_to_iso(bucket['time']),
+                            'min': bucket['min'],
+                            'max': bucket['max']
+                        }
+                        for bucket in downsample.minmax_envelope(times, values, target)
+                    ]
+            return stats
             
+        # Return empty data structure when no data is found
+        return {
+            **series.summarize(values),
+            'history': [],
+            'start_time': start_time_iso,
+            'end_time': end_time_iso,
+            'has_more': False
+        }
+            
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in get_sensor_history: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@router.get("/stats")
-async def get_stats():
-    """Get site statistics"""
+@router.get("/history")
+async def get_batch_history(
+    request: Request,
+    ids: str,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    points: Optional[int] = None
+):
+    """
+    Returns history for several sensors on a single time axis.
+    Missing data is fetched from HA with one combined request; stored data is
+    read locally. Values are carried forward onto the shared axis, which is
+    either the union of all sample times or `points` evenly spaced times.
+    """
+    sensor_ids = list(dict.fromkeys(s.strip() for s in ids.split(',') if s.strip()))
+    if not sensor_ids:
+        raise HTTPException(status_code=400, detail="ids must list at least one sensor")
+    # The frontend asks for every configured sensor at once, so the limit never drops below that
+    max_ids = max(settings.HISTORY_BATCH_MAX_IDS, len(settings.sensor_list))
+    if len(sensor_ids) > max_ids:
+        raise HTTPException(status_code=400, detail=f"At most {max_ids} sensors per request")
+    unknown = history_store.unknown_entities(sensor_ids)
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"Unknown sensor: {', '.join(unknown)}")
+    
+    start_time, end_time = parse_time_range(start, end)
+    start_ts, end_ts = start_time.timestamp(), end_time.timestamp()
+    
     try:
-        # Calculate visits in last 24h
-        cutoff = datetime.now() - timedelta(hours=24)
-        last_24h_visits = sum(
-            count for timestamp, count in analytics_data['hourly_stats'].items()
-            if datetime.strptime(timestamp, '%Y-%m-%d %H:00') > cutoff
-        )
-        
-        # Calculate active sessions
-        current_time = time.time()
-        active_count = sum(1 for timestamp in active_sessions.values() 
-                         if current_time - timestamp <= SESSION_DURATION)
+        synced = await history_store.sync_entities(sensor_ids, start_ts, end_ts)
         
-        return {
-            'total_visits': analytics_data['total_visits'],
-            'unique_visitors': len(analytics_data['unique_visitors']),
-            'last_24h_visits': last_24h_visits,
-            'active_sessions': active_count,
-            'hourly_stats': dict(analytics_data['hourly_stats']),
-            'sensor_stats': dict(analytics_data['sensor_requests'])
+        # Valid numeric samples per sensor as contiguous arrays, plus the value in effect at start
+        columns = {}
+        for sensor_id in sensor_ids:
+            times, values, _ = await series.load(sensor_id, start_ts, end_ts, with_states=False)
+            columns[sensor_id] = (times, values, await series.last_before(sensor_id, start_ts))
+    except Exception as e:
+        logger.error(f"Error in get_batch_history: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    if not synced and not any(len(times) for times, _, _ in columns.values()):
+        raise HTTPException(status_code=502, detail="Error fetching history")
+    
+    # Shared time axis
+    if points is not None:
+        axis = np.linspace(start_ts, min(end_ts, time.time()), max(downsample.MIN_POINTS, min(downsample.MAX_POINTS, points)))
+    else:
+        axis = np.unique(np.concatenate([times for times, _, _ in columns.values()]))
+    
+    result = {}
+    for sensor_id, (times, values, seed) in columns.items():
+        # Last observation carried forward from the sample before start; None only
+        # before a sensor's first stored sample (a prefix of the sorted axis)
+        filled = series.carry_forward(times, values, axis, seed)
+        before = int(np.count_nonzero(np.isnan(filled)))
+        result[sensor_id] = {
+            'values': [None] * before + filled[before:].tolist(),
+            **series.summarize(values),
+            'count': int(len(values))
         }
+    
+    return {
+        'start_time': start_time.isoformat(),
+        'end_time': end_time.isoformat(),
+        'timestamps': history_store.ts_to_iso_array(axis),
+        'series': result
+    }
+
+@router.get("/derived")
+async def get_derived(request: Request):
+    """
+    Dew point, heat index, wind chill, feels-like and apparent temperature,
+    sea level pressure and 3h pressure tendency, computed once per sensor
+    update and cached with the sensor data.
+    """
+    try:
+        _, age, freshness = await get_sensor_snapshot()
+    except Exception as e:
+        logger.error(f"Error in get_derived: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to fetch sensor data: {str(e)}")
+    
+    return respond_snapshot(request, get_payload('derived', derived.latest), age, freshness)
+
+@router.get("/derived/{metric}/history")
+async def get_derived_history(
+    metric: str,
+    request: Request,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    points: int = 288
+):
+    """
+    A derived metric over time, computed with vectorized formulas from the
+    stored history of its input sensors on `points` evenly spaced times.
+    """
+    if metric not in derived.METRICS:
+        raise HTTPException(status_code=404, detail=f"Unknown metric, expected one of {', '.join(derived.METRICS)}")
+    unit, needed = derived.METRICS[metric]
+    missing = [role for role in needed if role not in derived.roles]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"No sensor configured for {', '.join(missing)}")
+    
+    start_time, end_time = parse_time_range(start, end)
+    start_ts, end_ts = start_time.timestamp(), end_time.timestamp()
+    # Pressure tendency at the window start needs readings from 3 hours before it
+    lookback = derived.TENDENCY_WINDOW + derived.TENDENCY_TOLERANCE if metric == 'pressure_tendency' else 0
+    entity_ids = [derived.roles[role] for role in needed]
+    
+    try:
+        synced = await history_store.sync_entities(entity_ids, start_ts - lookback, end_ts)
+        raw = {}
+        for role, entity_id in zip(needed, entity_ids):
+            times, values, _ = await series.load(entity_id, start_ts - lookback, end_ts, with_states=False)
+            # Start from the value in effect at the beginning of the window
+            seed = await series.last_before(entity_id, start_ts - lookback)
+            if seed is not None:
+                times, values = np.concatenate(([seed[0]], times)), np.concatenate(([seed[1]], values))
+            raw[role] = (times, values * derived.wind_factor() if role == 'wind_speed' else values)
+    except Exception as e:
+        logger.error(f"Error in get_derived_history: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    if not synced and not any(len(times) for times, _ in raw.values()):
+        raise HTTPException(status_code=502, detail="Error fetching history")
+    
+    axis = np.linspace(start_ts, min(end_ts, time.time()), max(downsample.MIN_POINTS, min(downsample.MAX_POINTS, points)))
+    
+    # Inputs carried forward onto the axis; NaN before the first stored sample
+    columns = {role: series.carry_forward(times, values, axis) for role, (times, values) in raw.items()}
+    
+    with np.errstate(invalid='ignore'):
+        result = derived.series(metric, axis, columns, raw.get('pressure'))
+    known = result[~np.isnan(result)]
+    
+    return {
+        'metric': metric,
+        'unit': unit,
+        'inputs': dict(zip(needed, entity_ids)),
+        'start_time': start_time.isoformat(),
+        'end_time': end_time.isoformat(),
+        'timestamps': history_store.ts_to_iso_array(axis),
+        'values': [None if np.isnan(v) else v for v in np.round(result, 2).tolist()],
+        'min': float(known.min()) if len(known) else None,
+        'max': float(known.max()) if len(known) else None,
+        'current': float(known[-1]) if len(known) else None
+    }
+
+@router.get("/stats")
+async def get_stats(request: Request):
+    """Get site statistics"""
+    try:
+        stats = await analytics.compute_stats()
+        payload = get_payload('stats', stats, analytics.stats_version(stats))
+        return respond(request, payload, CACHE_TTL, settings.CACHE_STALE_GRACE)
     except Exception as e:
         logger.error(f"Error getting stats: {e}")
         raise HTTPException(status_code=500, detail="Error retrieving statistics")
@@ -554,221 +644,76 @@ async def get_stats():
 async def get_user_location(request: Request):
     """Get user's country based on IP"""
     try:
-        # Get client IP from Cloudflare or fallback to direct IP
-        client_ip = request.headers.get('cf-connecting-ip') or request.headers.get('x-real-ip') or request.client.host
-        
-        # Use ip-api.com (free service) to get location
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f'http://ip-api.com/json/{client_ip}')
-            if response.status_code == 200:
-                data = response.json()
-                return {
-                    'country': data.get('country'),
-                    'countryCode': data.get('countryCode')
-                }
-            return {'country': 'Unknown', 'countryCode': 'UN'}
+        # CF-IPCountry when behind Cloudflare, otherwise the local GeoIP database
+        return geoip.locate(request, analytics.get_client_ip(request))
     except Exception as e:
         logger.error(f"Error getting location: {e}")
         return {'country': 'Unknown', 'countryCode': 'UN'}
 
-async def fetch_lightning_history_from_ha(hours: int, sensor_type: str = "all"):
-    """Fetch lightning history data from Home Assistant"""
+async def stream_lightning_history(hours: int, sensor_type: str):
+    """
+    NDJSON lines for lightning events: buffered ones first, then, if a sync
+    is due, new ones as they are parsed from Home Assistant's response. The
+    last line holds the event count per sensor.
+    """
+    start = time.time() - hours * 3600
+    wanted = {
+        sensor_id for sensor_id in lightning.lightning_sensor_ids()
+        if sensor_type == "all" or sensor_type in sensor_id
+    }
+    counts = dict.fromkeys(sorted(wanted), 0)
+    
+    lines = []
+    flushed = time.monotonic()
+    events = lightning.stream_events(start)
     try:
-        # Calculate timestamps
-        now = datetime.now().replace(tzinfo=None)
-        start_time = now - timedelta(hours=hours)
-        
-        # Get lightning sensor IDs
-        lightning_sensors = []
-        for sensor_id in settings.sensor_list:
-            if 'lightning' in sensor_id:
-                if sensor_type == "all" or sensor_type in sensor_id:
-                    lightning_sensors.append(sensor_id)
-        
-        if not lightning_sensors:
-            return None
-        
-        # Fetch historical data for each sensor
-        headers = {
-            "Authorization": f"Bearer {settings.HASS_TOKEN}",
-            "Content-Type": "application/json",
-        }
-        
-        history_data = {}
-        
-        async with httpx.AsyncClient() as client:
-            for sensor_id in lightning_sensors:
-                try:
-                    # Get history from Home Assistant
-                    response = await client.get(
-                        f"{settings.HASS_URL}/api/history/period/{start_time.isoformat()}",
-                        headers=headers,
-                        params={
-                            "filter_entity_id": sensor_id,
-                            "end_time": now.isoformat(),
-                            "minimal_response": False
-                        },
-                        timeout=15.0
-                    )
-                    
-                    if response.status_code == 200:
-                        data = response.json()
-                        if data and len(data) > 0:
-                            history = data[0]
-                            
-                            # Process history data
-                            processed_history = []
-                            for item in history:
-                                try:
-                                    state = item.get('state', '')
-                                    # Skip invalid states
-                                    if state in ['null', 'None', 'unknown', 'unavailable']:
-                                        continue
-                                    
-                                    # Parse numeric values
-                                    if 'counter' in sensor_id:
-                                        try:
-                                            value = int(float(state))
-                                            processed_history.append({
-                                                'timestamp': item.get('last_updated', item.get('last_changed')),
-                                                'value': value,
-                                                'formatted': f"{value} strikes"
-                                            })
-                                        except (ValueError, TypeError):
-                                            continue
-                                    else:
-                                        try:
-                                            value = float(state)
-                                            if 'azimuth' in sensor_id and 0 <= value <= 360:
-                                                processed_history.append({
-                                                    'timestamp': item.get('last_updated', item.get('last_changed')),
-                                                    'value': value,
-                                                    'formatted': f"{value}°"
-                                                })
-                                            elif 'distance' in sensor_id and value >= 0:
-                                                processed_history.append({
-                                                    'timestamp': item.get('last_updated', item.get('last_changed')),
-                                                    'value': value,
-                                                    'formatted': f"{value} km"
-                                                })
-                                        except (ValueError, TypeError):
-                                            continue
-                                except Exception as e:
-                                    logger.error(f"Error processing history item: {e}")
-                                    continue
-                            
-                            history_data[sensor_id] = {
-                                'sensor_id': sensor_id,
-                                'total_events': len(processed_history),
-                                'history': processed_history,
-                                'last_event': processed_history[-1] if processed_history else None
-                            }
-                        else:
-                            history_data[sensor_id] = {
-                                'sensor_id': sensor_id,
-                                'total_events': 0,
-                                'history': [],
-                                'last_event': None
-                            }
-                    else:
-                        logger.error(f"Failed to fetch history for {sensor_id}: {response.status_code}")
-                        history_data[sensor_id] = {
-                            'sensor_id': sensor_id,
-                            'total_events': 0,
-                            'history': [],
-                            'last_event': None
-                        }
-                        
-                except Exception as e:
-                    logger.error(f"Error fetching history for {sensor_id}: {e}")
-                    history_data[sensor_id] = {
-                        'sensor_id': sensor_id,
-                        'total_events': 0,
-                        'history': [],
-                        'last_event': None
-                    }
-        
-        return history_data
-        
-    except Exception as e:
-        logger.error(f"Error fetching lightning history from HA: {e}")
-        return None
+        async for sensor_id, event in events:
+            if sensor_id not in wanted:
+                continue
+            counts[sensor_id] += 1
+            lines.append(json.dumps({'sensor_id': sensor_id, **event}))
+            # Batched so a local replay is not one write per event, but
+            # events parsed from a slow upstream still go out promptly
+            if len(lines) >= 500 or time.monotonic() - flushed > 0.1:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+                flushed = time.monotonic()
+    finally:
+        await events.aclose()
+    if lines:
+        yield '\n'.join(lines) + '\n'
+    yield json.dumps({'summary': {'hours': hours, 'sensor_type': sensor_type, 'total_events': counts}}) + '\n'
 
 @router.get("/lightning-history")
-async def get_lightning_history(request: Request, hours: int = 24, sensor_type: str = "all"):
-    """Get historical lightning data for specified time period with caching"""
+async def get_lightning_history(request: Request, hours: int = 24, sensor_type: str = "all", format: str = "json"):
+    """
+    Get historical lightning data for specified time period from the rolling buffer.
+    With format=ndjson events are streamed one per line.
+    """
     try:
-        update_analytics(request)
+        analytics.record_visit(request)
         
         # Validate parameters
-        if hours < 1 or hours > 168:  # Max 1 week
+        if hours < 1 or hours > lightning.WINDOW_HOURS:  # Max 1 week
             raise HTTPException(status_code=400, detail="Hours must be between 1 and 168")
         
         if sensor_type not in ["all", "azimuth", "distance", "counter"]:
             raise HTTPException(status_code=400, detail="Sensor type must be 'all', 'azimuth', 'distance', or 'counter'")
         
-        # Check cache first
-        global lightning_history_cache, lightning_history_cache_time
-        current_time = time.time()
-        cache_key = f"{hours}_{sensor_type}"
+        if format not in ("json", "ndjson"):
+            raise HTTPException(status_code=400, detail="Format must be 'json' or 'ndjson'")
+        if format == "ndjson":
+            # First events go out before a cold 168h fetch from Home Assistant has finished
+            return StreamingResponse(stream_lightning_history(hours, sensor_type), media_type=NDJSON_MEDIA_TYPE)
         
-        # Check if cache is valid
-        if (lightning_history_cache.get(cache_key) and 
-            lightning_history_cache_time and 
-            current_time - lightning_history_cache_time < lightning_history_cache_duration):
-            
-            cached_data = lightning_history_cache[cache_key]
-            cache_age = int(current_time - lightning_history_cache_time)
-            
-            logger.info(f"Returning cached lightning history (age: {cache_age}s)")
-            
-            # Check for recent activity in cached data
-            now = datetime.now().replace(tzinfo=None)
-            has_recent_activity = any(
-                data.get('last_event') and 
-                (now - datetime.fromisoformat(data['last_event']['timestamp'].replace('Z', '+00:00').replace('+00:00', '')).replace(tzinfo=None)).total_seconds() < 3600
-                for data in cached_data.values()
-            )
-            
-            return {
-                "status": "success",
-                "period": {
-                    "start": (now - timedelta(hours=hours)).isoformat(),
-                    "end": now.isoformat(),
-                    "hours": hours
-                },
-                "sensor_type": sensor_type,
-                "data": cached_data,
-                "summary": {
-                    "total_sensors": len(cached_data),
-                    "total_events": sum(data['total_events'] for data in cached_data.values()),
-                    "has_recent_activity": has_recent_activity,
-                    "cache_info": {
-                        "cached": True,
-                        "cache_age": cache_age
-                    }
-                }
-            }
+        # One small incremental fetch per interval serves every hours/sensor_type combination
+        fetched = await lightning.sync()
         
-        # Cache miss or expired - fetch fresh data
-        logger.info("Cache miss for lightning history, fetching fresh data from HA")
-        
-        processed_data = await fetch_lightning_history_from_ha(hours, sensor_type)
+        processed_data = lightning.get_history(hours, sensor_type)
         if processed_data is None:
             raise HTTPException(status_code=500, detail="Failed to fetch lightning history data")
         
-        # Update cache
-        lightning_history_cache[cache_key] = processed_data
-        lightning_history_cache_time = current_time
-        
-        # Check for recent activity
         now = datetime.now().replace(tzinfo=None)
-        has_recent_activity = any(
-            data.get('last_event') and 
-            (now - datetime.fromisoformat(data['last_event']['timestamp'].replace('Z', '+00:00').replace('+00:00', '')).replace(tzinfo=None)).total_seconds() < 3600
-            for data in processed_data.values()
-        )
-        
         return {
             "status": "success",
             "period": {
@@ -781,108 +726,204 @@ async def get_lightning_history(request: Request, hours: int = 24, sensor_type:
             "summary": {
                 "total_sensors": len(processed_data),
                 "total_events": sum(data['total_events'] for data in processed_data.values()),
-                "has_recent_activity": has_recent_activity,
+                "has_recent_activity": lightning.has_recent_activity(list(processed_data)),
                 "cache_info": {
-                    "cached": False,
-                    "cache_age": None
+                    "cached": not fetched,
+                    "cache_age": lightning.cache_age()
                 }
             }
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in lightning history: {e}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
-@router.get("/lightning-status")
-async def get_lightning_status(request: Request):
-    """Get current lightning detection status and statistics"""
+@router.get("/lightning-analysis")
+async def get_lightning_analysis(request: Request):
+    """Storm analytics: strike rates, approach speed and ETA, dominant direction"""
     try:
-        update_analytics(request)
-        
-        # Get current sensor data
-        cached_data = get_cached_data()
-        if not cached_data:
-            # Fetch fresh data if cache is empty
-            headers = {
-                "Authorization": f"Bearer {settings.HASS_TOKEN}",
-                "Content-Type": "application/json",
+        analytics.record_visit(request)
+        await lightning.sync()
+        interval = settings.LIGHTNING_SYNC_INTERVAL
+        return respond(request, get_payload('lightning-analysis', lightning.get_analysis()), interval, interval)
+    except Exception as e:
+        logger.error(f"Error in lightning analysis: {e}")
+        raise HTTPException(status_code=500, detail=f"Error computing lightning analysis: {str(e)}")
+
+def build_lightning_status(sensor_data: list) -> dict:
+    """Summarize lightning detection status from current sensor data"""
+    # Filter lightning sensors
+    lightning_sensors = [s for s in sensor_data if 'lightning' in s.get('entity_id', '')]
+    
+    if not lightning_sensors:
+        return {
+            'status': 'no_lightning_sensors',
+            'message': 'No lightning sensors configured',
+            'data': {}
+        }
+    
+    # Process lightning data
+    lightning_data = {}
+    for sensor in lightning_sensors:
+        sensor_id = sensor['entity_id']
+        
+        if 'azimuth' in sensor_id:
+            lightning_data['azimuth'] = {
+                'value': sensor['state'],
+                'unit': 'degrees',
+                'has_strikes': sensor['state'] not in ['null', 'None', 'unknown', 'unavailable', 'No strikes']
             }
-            
-            async with httpx.AsyncClient() as client:
-                responses = []
-                sensor_ids = settings.sensor_list
-                
-                for sensor_id in sensor_ids:
-                    if 'lightning' in sensor_id:
-                        try:
-                            url = f"{settings.HASS_URL}/api/states/{sensor_id}"
-                            response = await client.get(
-                                url,
-                                headers=headers,
-                                timeout=10.0
-                            )
-                            
-                            if response.status_code == 200:
-                                responses.append(response.json())
-                        except Exception as e:
-                            logger.error(f"Error fetching lightning sensor {sensor_id}: {e}")
-                            continue
-                
-                cached_data = responses
-        
-        # Filter lightning sensors
-        lightning_sensors = [s for s in cached_data if 'lightning' in s.get('entity_id', '')]
-        
-        if not lightning_sensors:
-            return {
-                'status': 'no_lightning_sensors',
-                'message': 'No lightning sensors configured',
-                'data': {}
+        elif 'distance' in sensor_id:
+            lightning_data['distance'] = {
+                'value': sensor['state'],
+                'unit': 'kilometers',
+                'has_strikes': sensor['state'] not in ['null', 'None', 'unknown', 'unavailable', 'No strikes']
             }
-        
-        # Process lightning data
-        lightning_data = {}
-        for sensor in lightning_sensors:
-            sensor_id = sensor['entity_id']
-            
-            if 'azimuth' in sensor_id:
-                lightning_data['azimuth'] = {
-                    'value': sensor['state'],
-                    'unit': 'degrees',
-                    'has_strikes': sensor['state'] not in ['null', 'None', 'unknown', 'unavailable', 'No strikes']
-                }
-            elif 'distance' in sensor_id:
-                lightning_data['distance'] = {
-                    'value': sensor['state'],
-                    'unit': 'kilometers',
-                    'has_strikes': sensor['state'] not in ['null', 'None', 'unknown', 'unavailable', 'No strikes']
-                }
-            elif 'counter' in sensor_id:
-                lightning_data['counter'] = {
-                    'value': sensor['state'],
-                    'unit': 'strikes',
-                    'total_strikes': int(float(sensor['state'])) if sensor['state'].replace('.', '').isdigit() else 0
-                }
-        
-        # Determine overall lightning status
-        has_active_strikes = any(
-            sensor.get('state') not in ['null', 'None', 'unknown', 'unavailable', 'No strikes', '0']
-            for sensor in lightning_sensors
-        )
-        
-        status = 'active' if has_active_strikes else 'inactive'
-        
-        return {
-            'status': status,
-            'timestamp': datetime.now().isoformat(),
-            'data': lightning_data,
-            'summary': {
-                'has_lightning': has_active_strikes,
-                'sensor_count': len(lightning_sensors),
-                'last_update': max(s.get('last_updated', '') for s in lightning_sensors) if lightning_sensors else None
+        elif 'counter' in sensor_id:
+            lightning_data['counter'] = {
+                'value': sensor['state'],
+                'unit': 'strikes',
+                'total_strikes': int(history_store.parse_value(sensor['state']) or 0)
             }
+    
+    # Determine overall lightning status
+    has_active_strikes = any(
+        sensor.get('state') not in ['null', 'None', 'unknown', 'unavailable', 'No strikes', '0']
+        for sensor in lightning_sensors
+    )
+    
+    status = 'active' if has_active_strikes else 'inactive'
+    
+    return {
+        'status': status,
+        'timestamp': datetime.now().isoformat(),
+        'data': lightning_data,
+        'summary': {
+            'has_lightning': has_active_strikes,
+            'sensor_count': len(lightning_sensors),
+            'last_update': max(s.get('last_updated', '') for s in lightning_sensors) if lightning_sensors else None
         }
+    }
+
+# Lightning status and the sensor data it was built from
+lightning_status_cache: Tuple[Optional[list], Optional[dict]] = (None, None)
+
+def get_cached_lightning_status(sensor_data: list) -> dict:
+    """Lightning status, rebuilt only when the sensor cache was refreshed"""
+    global lightning_status_cache
+    source, status = lightning_status_cache
+    if source is not sensor_data:
+        status = build_lightning_status(sensor_data)
+        lightning_status_cache = (sensor_data, status)
+    return status
+
+@router.get("/lightning-status")
+async def get_lightning_status(request: Request):
+    """Get current lightning detection status and statistics"""
+    try:
+        analytics.record_visit(request)
+        
+        # Get current sensor data (shares the sensor cache and its in-flight refresh)
+        cached_data, age, freshness = await get_sensor_snapshot()
+        return respond_snapshot(
+            request,
+            get_payload('lightning-status', get_cached_lightning_status(cached_data)),
+            age,
+            freshness
+        )
         
     except Exception as e:
         logger.error(f"Error getting lightning status: {e}")
-        raise HTTPException(status_code=500, detail=f"Error retrieving lightning status: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Error retrieving lightning status: {str(e)}")
+
+# Last published values, used to send only what changed to stream clients
+last_published: Dict[str, dict] = {'sensors': {}, 'stats': {}, 'lightning': {}}
+
+async def publish_updates() -> None:
+    """Publish changed sensors, stats and lightning status to stream clients"""
+    sensor_data, _, _ = await get_sensor_snapshot()
+    
+    # Sensors: only entities whose state or timestamp changed
+    changed_sensors = {
+        sensor['entity_id']: sensor
+        for sensor in sensor_data
+        if last_published['sensors'].get(sensor['entity_id']) != sensor
+    }
+    last_published['sensors'].update(changed_sensors)
+    broadcaster.publish('sensors', changed_sensors)
+    
+    # Stats: only fields whose value changed
+    stats = await analytics.compute_stats()
+    stats_delta = {k: v for k, v in stats.items() if last_published['stats'].get(k) != v}
+    last_published['stats'].update(stats_delta)
+    broadcaster.publish('stats', stats_delta)
+    
+    # Lightning: whole status when anything but the timestamp changed
+    lightning = build_lightning_status(sensor_data)
+    comparable = {k: v for k, v in lightning.items() if k != 'timestamp'}
+    if comparable != last_published['lightning']:
+        last_published['lightning'] = comparable
+        broadcaster.publish('lightning', lightning)
+
+async def run_stream_publisher() -> None:
+    """Background loop feeding /api/stream from the sensor cache or WebSocket store"""
+    while True:
+        version = ha_websocket.store_version
+        try:
+            if broadcaster.subscribers:
+                await publish_updates()
+        except Exception as e:
+            logger.error(f"Error publishing stream updates: {e}")
+        
+        # Wake up early on pushed state changes when the WebSocket store is live
+        if ha_websocket.is_live():
+            await ha_websocket.wait_for_update(version, settings.STREAM_INTERVAL)
+        else:
+            await asyncio.sleep(settings.STREAM_INTERVAL)
+
+@router.get("/stream")
+async def stream_updates(request: Request):
+    """Server-Sent Events stream of changed sensors, stats and lightning status"""
+    analytics.record_visit(request)
+    
+    if len(broadcaster.subscribers) >= settings.STREAM_MAX_CLIENTS:
+        raise HTTPException(status_code=503, detail="Too many stream clients")
+    
+    if not broadcaster.subscribers:
+        # Publisher was idle, so bring the snapshot up to date first
+        try:
+            await publish_updates()
+        except Exception as e:
+            logger.error(f"Error preparing stream snapshot: {e}")
+    
+    subscriber = broadcaster.subscribe()
+    
+    async def event_source():
+        try:
+            # Tell EventSource how long to wait before reconnecting
+            yield f"retry: {settings.STREAM_RETRY_MS}\n\n".encode()
+            last_visit = time.monotonic()
+            while True:
+                messages = await broadcaster.next_messages(subscriber, settings.STREAM_HEARTBEAT)
+                if time.monotonic() - last_visit >= settings.STREAM_HEARTBEAT:
+                    # An open tab stays an active session, as it did while polling
+                    analytics.record_visit(request)
+                    last_visit = time.monotonic()
+                if not messages:
+                    # Comment line keeps proxies from closing an idle connection
+                    yield b": keep-alive\n\n"
+                for message in messages:
+                    yield message
+        finally:
+            broadcaster.unsubscribe(subscriber)
+    
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"  # Disable Nginx buffering for this response
+        }
+    )
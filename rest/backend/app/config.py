@@ -1,6 +1,6 @@
 from pydantic_settings import BaseSettings
 from pydantic import Field
-from typing import Union, List
+from typing import Union, List, Optional
 
 class Settings(BaseSettings):
     HASS_URL: str
@@ -9,6 +9,64 @@ class Settings(BaseSettings):
     ENVIRONMENT: str = "development"  # default value
     STATION_ALTITUDE: float = Field(default=230.0)  # Simplified field definition
 
+    # Home Assistant client
+    HA_MAX_CONNECTIONS: int = 20  # Connection pool size
+    HA_KEEPALIVE_EXPIRY: float = 30.0  # Seconds an idle connection is kept open
+    HA_HTTP2: bool = True  # Used only when the h2 package is installed
+    HA_CONCURRENCY: int = 10  # Max parallel per-sensor requests
+    HA_BULK_STATES: bool = False  # Fetch all states with one /api/states call
+    HA_BULK_MAX_BYTES: int = 5_000_000  # Fall back to per-entity fetches above this size
+    HA_REQUEST_BUDGET: float = 10.0  # Max seconds one API request may spend waiting on Home Assistant
+    HA_BREAKER_FAILURES: int = 5  # Consecutive failures before calls fail fast
+    HA_BREAKER_RESET: float = 30.0  # Seconds between probe calls while failing fast
+    HA_HEDGE_DELAY: float = 2.0  # Send a second history request if the first is this slow (0 disables)
+    HA_LAST_GOOD_MAX_AGE: int = 900  # Max seconds a failed entity is filled in with its last good state
+
+    # Home Assistant WebSocket subscription (push-based sensor store)
+    HA_WEBSOCKET: bool = False  # Keep sensors current from subscribe_entities events
+    HASS_WS_URL: Optional[str] = None  # Defaults to HASS_URL + /api/websocket
+    HA_WS_MAX_BACKOFF: float = 60.0  # Max seconds between reconnect attempts
+    HA_WS_MAX_MESSAGE_BYTES: int = 16 * 1024 * 1024  # Max size of one message, e.g. the initial snapshot
+
+    # Logging
+    LOG_FORMAT: str = "json"  # "json" (one object per line) or "text"
+    LOG_LEVEL: str = "INFO"
+    LOG_SAMPLE_RATE: float = 1.0  # Fraction of successful requests logged; errors are always logged
+
+    # Local GeoIP for /api/user-location (used when CF-IPCountry is absent)
+    GEOIP_DB: Optional[str] = None  # .mmdb file, or CSV of start,end,country / cidr,country rows (.csv or .csv.gz)
+    GEOIP_CACHE_SIZE: int = 10_000  # Looked-up IPs kept in the LRU cache
+
+    # Per-client rate limiting (token bucket keyed on the visitor IP)
+    RATE_LIMIT_PER_MINUTE: float = 60  # Tokens refilled per minute
+    RATE_LIMIT_BURST: int = 60  # Bucket size
+    RATE_LIMIT_MAX_CLIENTS: int = 10_000  # Least recently seen clients are evicted beyond this
+
+    # Sensor cache
+    CACHE_STALE_GRACE: int = 60  # Seconds after expiry stale data is served while refreshing
+
+    # Local history store (data/history.db)
+    HISTORY_SYNC_INTERVAL: int = 60  # Min seconds between incremental syncs of recent data
+    HISTORY_RETENTION_DAYS: int = 400  # Older samples are pruned at startup
+    HISTORY_CHUNK_HOURS: int = 24  # Max span of one history request to HA; longer syncs are split
+    HISTORY_BATCH_MAX_IDS: int = 30  # Sensors per /api/history request (never fewer than SENSOR_IDS)
+
+    # Lightning history buffer
+    LIGHTNING_SYNC_INTERVAL: int = 60  # Min seconds between incremental lightning syncs
+
+    # Visitor analytics (aggregated off the request path)
+    ANALYTICS_FLUSH_INTERVAL: float = 1.0  # Seconds between batches of queued visits
+    ANALYTICS_SAVE_INTERVAL: float = 30.0  # Min seconds between writes of analytics.json
+    ANALYTICS_QUEUE_SIZE: int = 100_000  # Queued visits kept if the worker falls behind
+    ANALYTICS_BACKEND: str = "file"  # "file" (one worker) or "sqlite" (data/analytics.db, shared by workers)
+
+    # /api/stream (Server-Sent Events)
+    STREAM_INTERVAL: float = 5.0  # Seconds between publisher checks for changes
+    STREAM_HEARTBEAT: float = 15.0  # Seconds between keep-alive comments
+    STREAM_RETRY_MS: int = 5000  # Client reconnect delay
+    STREAM_MAX_CLIENTS: int = 5000  # Concurrent stream connections
+    STREAM_CLIENT_BUFFER: int = 20  # Queued messages before a slow client is coalesced
+
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
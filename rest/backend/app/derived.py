@@ -0,0 +1,284 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from app.config import settings
+from app import history_store, series as stored_series
+from app.sensors import INVALID_STATES, classify, get_spec
+
+# Get the FastAPI logger
+logger = logging.getLogger("main")
+
+# Formulas below take floats or NumPy arrays; inputs are °C, % and m/s
+
+def sea_level_pressure(pressure, temperature, altitude: float):
+    """Mean sea level pressure (hPa) from station pressure, as calculate_relative_pressure"""
+    fraction = (0.0065 * altitude) / (np.asarray(temperature, dtype=np.float64) + 0.0065 * altitude + 273.15)
+    return np.asarray(pressure, dtype=np.float64) * (1 - fraction) ** -5.257
+
+def vapour_pressure(temperature, humidity):
+    """Water vapour pressure (hPa)"""
+    temperature = np.asarray(temperature, dtype=np.float64)
+    return np.asarray(humidity, dtype=np.float64) / 100 * 6.105 * np.exp(17.27 * temperature / (237.7 + temperature))
+
+def dew_point(temperature, humidity):
+    """Dew point (°C), Magnus formula"""
+    temperature = np.asarray(temperature, dtype=np.float64)
+    # ln(0) is undefined; 1% is below anything a station reports outdoors
+    gamma = np.log(np.clip(humidity, 1, 100) / 100) + 17.62 * temperature / (243.12 + temperature)
+    return 243.12 * gamma / (17.62 - gamma)
+
+def heat_index(temperature, humidity):
+    """Heat index (°C), NWS Rothfusz regression; equals the temperature below 26.7 °C"""
+    temperature = np.asarray(temperature, dtype=np.float64)
+    humidity = np.asarray(humidity, dtype=np.float64)
+    t = temperature * 9 / 5 + 32
+    rh = humidity
+    hi = (-42.379 + 2.04901523 * t + 10.14333127 * rh - 0.22475541 * t * rh
+          - 6.83783e-3 * t * t - 5.481717e-2 * rh * rh + 1.22874e-3 * t * t * rh
+          + 8.5282e-4 * t * rh * rh - 1.99e-6 * t * t * rh * rh)
+    # NWS adjustments for dry heat and for humid, moderate heat
+    hi = np.where((rh < 13) & (t >= 80) & (t <= 112),
+                  hi - (13 - rh) / 4 * np.sqrt(np.clip(17 - np.abs(t - 95), 0, None) / 17), hi)
+    hi = np.where((rh > 85) & (t >= 80) & (t <= 87), hi + (rh - 85) / 10 * (87 - t) / 5, hi)
+    return np.where(temperature >= 26.7, (hi - 32) * 5 / 9, temperature)
+
+def wind_chill(temperature, wind_speed):
+    """Wind chill (°C), JAG/TI formula; equals the temperature above 10 °C or below 4.8 km/h"""
+    temperature = np.asarray(temperature, dtype=np.float64)
+    kmh = np.asarray(wind_speed, dtype=np.float64) * 3.6
+    v = np.power(kmh, 0.16)
+    chill = 13.12 + 0.6215 * temperature - 11.37 * v + 0.3965 * temperature * v
+    return np.where((temperature <= 10) & (kmh > 4.8), chill, temperature)
+
+def apparent_temperature(temperature, humidity, wind_speed):
+    """Apparent temperature (°C), Steadman's formula as used by the Australian BoM"""
+    temperature = np.asarray(temperature, dtype=np.float64)
+    return temperature + 0.33 * vapour_pressure(temperature, humidity) - 0.70 * np.asarray(wind_speed) - 4.00
+
+def feels_like(temperature, humidity, wind_speed):
+    """Wind chill when cold, heat index when hot, otherwise the temperature"""
+    temperature = np.asarray(temperature, dtype=np.float64)
+    return np.where(temperature <= 10, wind_chill(temperature, wind_speed), heat_index(temperature, humidity))
+
+# Pressure tendency is the change over this window (WMO synoptic convention)
+TENDENCY_WINDOW = 3 * 3600
+# How far the reading at the window start may be from exactly 3 hours ago
+TENDENCY_TOLERANCE = 15 * 60
+
+# Upper bound of |change| in hPa per 3h for each description (Met Office wording)
+TENDENCY_TRENDS = [(0.1, 'steady'), (1.5, 'slowly'), (3.5, ''), (6.0, 'quickly')]
+
+def pressure_tendency(times: np.ndarray, values: np.ndarray, at: np.ndarray) -> np.ndarray:
+    """
+    Change (hPa) between the last reading at or before each time in `at` and
+    the last reading TENDENCY_WINDOW earlier; NaN where either is missing.
+    """
+    if len(times) == 0:
+        return np.full(len(at), np.nan)
+    now_idx = np.searchsorted(times, at, side='right') - 1
+    then_idx = np.searchsorted(times, at - TENDENCY_WINDOW, side='right') - 1
+    valid = (now_idx >= 0) & (then_idx >= 0)
+    now_idx, then_idx = np.maximum(now_idx, 0), np.maximum(then_idx, 0)
+    valid &= (at - TENDENCY_WINDOW - times[then_idx]) <= TENDENCY_TOLERANCE
+    return np.where(valid, values[now_idx] - values[then_idx], np.nan)
+
+def describe_tendency(change: float) -> str:
+    """e.g. 'steady', 'rising slowly', 'falling quickly'"""
+    direction = 'rising' if change > 0 else 'falling'
+    for bound, speed in TENDENCY_TRENDS:
+        if abs(change) < bound:
+            return 'steady' if speed == 'steady' else f"{direction} {speed}".strip()
+    return f"{direction} very rapidly"
+
+# Sensor roles that feed the derived metrics
+ROLES = ('temperature', 'humidity', 'wind_speed', 'pressure')
+
+# Derived metric -> (unit, roles it needs)
+METRICS: Dict[str, Tuple[str, Tuple[str, ...]]] = {
+    'sea_level_pressure': ('hPa', ('pressure', 'temperature')),
+    'dew_point': ('°C', ('temperature', 'humidity')),
+    'heat_index': ('°C', ('temperature', 'humidity')),
+    'wind_chill': ('°C', ('temperature', 'wind_speed')),
+    'feels_like': ('°C', ('temperature', 'humidity', 'wind_speed')),
+    'apparent_temperature': ('°C', ('temperature', 'humidity', 'wind_speed')),
+    'pressure_tendency': ('hPa/3h', ('pressure',)),
+}
+
+# Wind speed unit -> factor to m/s; HA's metric default is km/h
+WIND_UNITS = {'m/s': 1.0, 'km/h': 1 / 3.6, 'mph': 0.44704, 'kn': 0.514444, 'ft/s': 0.3048}
+
+# Role -> entity ID, resolved from SENSOR_IDS at startup
+roles: Dict[str, str] = {}
+
+# Wind speed unit of the configured entity, from its latest state
+wind_unit = 'km/h'
+
+# Stored station pressure reading (timestamp, hPa) from TENDENCY_WINDOW before
+# the last lookup; the live tendency is the current reading minus this one
+pressure_reference: Optional[Tuple[float, float]] = None
+REFERENCE_INTERVAL = 60  # Min seconds between lookups
+_reference_checked = 0.0
+_reference_task: Optional[asyncio.Task] = None
+
+# Latest derived metrics, recomputed on every sensor data update
+latest: Optional[dict] = None
+
+def _pick(candidates: List[str]) -> Optional[str]:
+    """Prefer an outdoor entity, then any that is not indoor"""
+    for preferred in ('outdoor', 'outside'):
+        match = next((c for c in candidates if preferred in c), None)
+        if match:
+            return match
+    return next((c for c in candidates if 'indoor' not in c and 'inside' not in c), None)
+
+def compile_roles(entity_ids: Iterable[str]) -> None:
+    """Assign configured entities to the roles derived metrics need, independent of their order"""
+    by_type: Dict[str, List[str]] = {}
+    for entity_id in entity_ids:
+        by_type.setdefault(classify(entity_id), []).append(entity_id)
+
+    found = {
+        'temperature': _pick(by_type.get('temperature', [])),
+        'humidity': _pick(by_type.get('humidity', [])),
+        'wind_speed': _pick([e for e in by_type.get('wind', []) if 'speed' in e]),
+        'pressure': _pick([e for e in by_type.get('pressure', []) if 'absolute' in e]),
+    }
+    roles.clear()
+    roles.update({role: entity_id for role, entity_id in found.items() if entity_id})
+    missing = [role for role in ROLES if role not in roles]
+    logger.info(f"Derived metrics: inputs {roles}" + (f", no sensor for {missing}" if missing else ""))
+
+def wind_factor() -> float:
+    return WIND_UNITS.get(wind_unit, WIND_UNITS['km/h'])
+
+def read_inputs(states: Dict[str, dict]) -> Dict[str, float]:
+    """Valid numeric input per role from raw Home Assistant states (wind in m/s)"""
+    global wind_unit
+    inputs = {}
+    for role, entity_id in roles.items():
+        state = states.get(entity_id)
+        if state is None or state['state'] in INVALID_STATES or not get_spec(entity_id).validate(state['state']):
+            continue
+        value = float(state['state'])
+        if role == 'wind_speed':
+            wind_unit = state.get('attributes', {}).get('unit_of_measurement') or wind_unit
+            value *= wind_factor()
+        inputs[role] = value
+    return inputs
+
+def _rounded(value) -> Optional[float]:
+    value = float(value)
+    return None if np.isnan(value) else round(value, 1)
+
+def compute(inputs: Dict[str, float], altitude: float) -> Dict[str, Optional[float]]:
+    """Every derived metric whose inputs are present; None for the rest"""
+    t, rh, wind, p = (inputs.get(role) for role in ROLES)
+    values: Dict[str, Optional[float]] = dict.fromkeys(METRICS)
+    if p is not None and t is not None:
+        values['sea_level_pressure'] = _rounded(sea_level_pressure(p, t, altitude))
+    if t is not None and rh is not None:
+        values['dew_point'] = _rounded(dew_point(t, rh))
+        values['heat_index'] = _rounded(heat_index(t, rh))
+    if t is not None and wind is not None:
+        values['wind_chill'] = _rounded(wind_chill(t, wind))
+    if t is not None and rh is not None and wind is not None:
+        values['feels_like'] = _rounded(feels_like(t, rh, wind))
+        values['apparent_temperature'] = _rounded(apparent_temperature(t, rh, wind))
+    return values
+
+async def refresh_pressure_reference(now: float) -> None:
+    """
+    Look up the station pressure from TENDENCY_WINDOW ago in the history
+    store, syncing the recent pressure history first. The store is shared by
+    all workers and survives restarts, unlike readings kept in memory.
+    """
+    global pressure_reference
+    entity_id = roles.get('pressure')
+    if entity_id is None:
+        return
+    target = now - TENDENCY_WINDOW
+    await history_store.sync_range(entity_id, target - TENDENCY_TOLERANCE, now)
+    times, values, _ = await stored_series.load(entity_id, target - TENDENCY_TOLERANCE, target, with_states=False)
+    pressure_reference = (float(times[-1]), float(values[-1])) if len(times) else None
+
+def _on_reference_done(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception():
+        logger.error(f"Derived metrics: pressure reference lookup failed: {task.exception()}")
+
+def start_reference_refresh(now: float) -> None:
+    """Refresh the pressure reference in the background, at most once per REFERENCE_INTERVAL"""
+    global _reference_checked, _reference_task
+    if now - _reference_checked < REFERENCE_INTERVAL or (_reference_task and not _reference_task.done()):
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    _reference_checked = now
+    _reference_task = loop.create_task(refresh_pressure_reference(now))
+    _reference_task.add_done_callback(_on_reference_done)
+
+def live_tendency(pressure: Optional[float], now: float) -> Optional[dict]:
+    """Pressure tendency from the current station pressure and the stored reference"""
+    if pressure is None or pressure_reference is None:
+        return None
+    then, reference = pressure_reference
+    if now - TENDENCY_WINDOW - then > TENDENCY_TOLERANCE:
+        return None
+    # Altitude reduction barely changes a 3h difference, as in series()
+    change = _rounded(pressure - reference)
+    return {'change': change, 'trend': describe_tendency(change)}
+
+def update(states: Dict[str, dict], now: Optional[float] = None) -> Dict[str, float]:
+    """
+    Recompute the derived metrics from one sensor data update.
+
+    Returns the parsed inputs, which the sensor transforms share (e.g. the
+    temperature used for relative pressure).
+    """
+    global latest
+    now = time.time() if now is None else now
+    inputs = read_inputs(states)
+    values = compute(inputs, float(settings.STATION_ALTITUDE))
+    values['pressure_tendency'] = live_tendency(inputs.get('pressure'), now)
+    start_reference_refresh(now)
+
+    latest = {
+        'metrics': values,
+        'units': {name: unit for name, (unit, _) in METRICS.items()},
+        'inputs': dict(roles),
+        'updated': datetime.fromtimestamp(now, timezone.utc).isoformat()
+    }
+    return inputs
+
+def series(metric: str, axis: np.ndarray, columns: Dict[str, np.ndarray],
+           pressure: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> np.ndarray:
+    """
+    A derived metric over a time axis. columns holds each input role's
+    values aligned to the axis (NaN where unknown, wind in m/s); pressure
+    tendency also needs the raw (times, hPa) station pressure series.
+    """
+    altitude = float(settings.STATION_ALTITUDE)
+    t = columns.get('temperature')
+    if metric == 'sea_level_pressure':
+        return sea_level_pressure(columns['pressure'], t, altitude)
+    if metric == 'dew_point':
+        return dew_point(t, columns['humidity'])
+    if metric == 'heat_index':
+        return heat_index(t, columns['humidity'])
+    if metric == 'wind_chill':
+        return wind_chill(t, columns['wind_speed'])
+    if metric == 'feels_like':
+        return feels_like(t, columns['humidity'], columns['wind_speed'])
+    if metric == 'apparent_temperature':
+        return apparent_temperature(t, columns['humidity'], columns['wind_speed'])
+    if metric == 'pressure_tendency':
+        times, values = pressure
+        # Altitude reduction barely changes a 3h difference; station temperature is not needed
+        return pressure_tendency(times, values, axis)
+    raise KeyError(metric)
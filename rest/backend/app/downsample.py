@@ -0,0 +1,85 @@
+import re
+from typing import List, Optional
+
+import numpy as np
+
+# Bounds for the number of points a client may ask for
+MIN_POINTS = 3
+MAX_POINTS = 5000
+
+_DURATION_RE = re.compile(r'^(\d+)([smhd])$')
+_DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+def parse_duration(value: str) -> int:
+    """Parse a duration such as '30s', '5m', '1h' or '1d' into seconds"""
+    match = _DURATION_RE.match(value.strip().lower())
+    if not match or int(match.group(1)) == 0:
+        raise ValueError(f"Invalid duration '{value}', expected e.g. 5m, 1h or 1d")
+    return int(match.group(1)) * _DURATION_UNITS[match.group(2)]
+
+def target_points(points: Optional[int], resolution: Optional[str], span: float) -> Optional[int]:
+    """
+    Number of output points requested via points= or resolution=.
+
+    resolution is a bucket width (e.g. '5m'); the result is clamped to
+    [MIN_POINTS, MAX_POINTS]. None means no downsampling was requested.
+    """
+    if points is None and resolution is None:
+        return None
+    if points is None:
+        points = int(span // parse_duration(resolution)) + 1
+    return max(MIN_POINTS, min(MAX_POINTS, points))
+
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets downsampling.
+
+    Returns the indices of the n_out points that best preserve the visual
+    shape of the series. The first and last points are always kept.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # Bucket boundaries for the interior points
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], max(edges[i + 1], edges[i] + 1)
+
+        # Average of the next bucket (or the last point for the final bucket)
+        next_start, next_end = end, edges[i + 2] if i + 2 < len(edges) else n
+        if next_end <= next_start:
+            next_end = next_start + 1
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+
+        # Triangle area between the last selected point, each candidate and the average
+        area = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+
+    return selected
+
+def minmax_envelope(x: np.ndarray, y: np.ndarray, n_buckets: int) -> List[dict]:
+    """Min and max of y per equal-width time bucket, skipping empty buckets"""
+    if len(x) == 0:
+        return []
+
+    edges = np.linspace(x[0], x[-1], n_buckets + 1)
+    starts = np.unique(np.searchsorted(x, edges[:-1], side='left'))
+    starts = starts[starts < len(x)]
+
+    mins = np.minimum.reduceat(y, starts)
+    maxs = np.maximum.reduceat(y, starts)
+    return [
+        {'time': float(x[start]), 'min': float(lo), 'max': float(hi)}
+        for start, lo, hi in zip(starts, mins, maxs)
+    ]
@@ -0,0 +1,170 @@
+import asyncio
+import csv
+import gzip
+import logging
+from array import array
+from bisect import bisect_right
+from functools import lru_cache
+from ipaddress import ip_address, ip_network
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import Request
+
+from app.config import settings
+from app.countries import country_name
+
+# Get the FastAPI logger
+logger = logging.getLogger("main")
+
+# MMDB files need the optional maxminddb package (pip install maxminddb)
+try:
+    import maxminddb
+    MAXMINDDB_AVAILABLE = True
+except ImportError:
+    MAXMINDDB_AVAILABLE = False
+
+UNKNOWN = {'country': 'Unknown', 'countryCode': 'UN'}
+
+# CF-IPCountry values that do not name a country (unknown, Tor)
+CF_NON_COUNTRIES = {'XX', 'T1'}
+
+class RangeTable:
+    """Sorted, non-overlapping IP ranges mapped to country codes, searched with bisect"""
+
+    def __init__(self, starts: List[int], ends: List[int], code_ids: List[int], typecode: Optional[str]):
+        # IPv4 fits in compact unsigned arrays; IPv6 needs Python ints
+        self.starts = array(typecode, starts) if typecode else starts
+        self.ends = array(typecode, ends) if typecode else ends
+        self.code_ids = array('H', code_ids)
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def find(self, ip: int) -> Optional[int]:
+        """Index of the country code for ip, or None"""
+        i = bisect_right(self.starts, ip) - 1
+        if i >= 0 and ip <= self.ends[i]:
+            return self.code_ids[i]
+        return None
+
+class RangeDatabase:
+    """IPv4 and IPv6 range tables loaded from a CSV file"""
+
+    def __init__(self, path: Path):
+        self.codes: List[str] = []
+        code_index: Dict[str, int] = {}
+        rows: Dict[int, List[Tuple[int, int, int]]] = {4: [], 6: []}
+
+        opener = gzip.open if path.suffix == '.gz' else open
+        with opener(path, 'rt', newline='') as f:
+            for row in csv.reader(f):
+                parsed = self._parse_row(row)
+                if parsed is None:
+                    continue
+                version, start, end, code = parsed
+                if code not in code_index:
+                    code_index[code] = len(self.codes)
+                    self.codes.append(code)
+                rows[version].append((start, end, code_index[code]))
+
+        self.tables = {}
+        for version, typecode in ((4, 'L'), (6, None)):
+            ranges = sorted(rows[version])
+            self.tables[version] = RangeTable(
+                [r[0] for r in ranges], [r[1] for r in ranges], [r[2] for r in ranges], typecode
+            )
+
+    @staticmethod
+    def _parse_row(row: List[str]) -> Optional[Tuple[int, int, int, str]]:
+        """(version, start, end, country code) from 'start,end,code' or 'cidr,code' rows"""
+        try:
+            if len(row) >= 3 and '/' not in row[0]:
+                start, end = ip_address(row[0].strip()), ip_address(row[1].strip())
+                code = row[2]
+            elif len(row) >= 2:
+                network = ip_network(row[0].strip(), strict=False)
+                start, end, code = network[0], network[-1], row[1]
+            else:
+                return None
+        except ValueError:
+            # Header line or malformed row
+            return None
+        code = code.strip().upper()
+        if len(code) != 2 or start.version != end.version:
+            return None
+        return start.version, int(start), int(end), code
+
+    def lookup(self, ip: str) -> Optional[Dict[str, str]]:
+        address = ip_address(ip)
+        code_id = self.tables[address.version].find(int(address))
+        if code_id is None:
+            return None
+        code = self.codes[code_id]
+        # Range files carry only the code
+        return {'country': country_name(code), 'countryCode': code}
+
+    def __len__(self) -> int:
+        return sum(len(table) for table in self.tables.values())
+
+class MaxMindDatabase:
+    """Country lookups in a MaxMind/DB-IP .mmdb file"""
+
+    def __init__(self, path: Path):
+        self.reader = maxminddb.open_database(str(path))
+
+    def lookup(self, ip: str) -> Optional[Dict[str, str]]:
+        record = self.reader.get(ip)
+        country = (record or {}).get('country')
+        if not country or 'iso_code' not in country:
+            return None
+        return {
+            'country': country.get('names', {}).get('en', country_name(country['iso_code'])),
+            'countryCode': country['iso_code']
+        }
+
+    def __len__(self) -> int:
+        return self.reader.metadata().node_count
+
+_database = None
+
+def _load_database(path: Path):
+    if path.suffix == '.mmdb':
+        if not MAXMINDDB_AVAILABLE:
+            raise RuntimeError("Reading .mmdb files needs the maxminddb package")
+        return MaxMindDatabase(path)
+    return RangeDatabase(path)
+
+async def load() -> None:
+    """Load GEOIP_DB, if configured, without blocking the event loop"""
+    global _database
+    if not settings.GEOIP_DB:
+        logger.info("GeoIP: no GEOIP_DB configured, relying on CF-IPCountry")
+        return
+    path = Path(settings.GEOIP_DB)
+    try:
+        _database = await asyncio.to_thread(_load_database, path)
+        lookup_ip.cache_clear()
+        logger.info(f"GeoIP: loaded {path.name} ({len(_database)} entries)")
+    except Exception as e:
+        logger.error(f"GeoIP: failed to load {path}: {e}")
+
+@lru_cache(maxsize=settings.GEOIP_CACHE_SIZE)
+def lookup_ip(ip: str) -> Dict[str, str]:
+    """Country of an IP from the local database, cached per IP"""
+    if _database is None:
+        return UNKNOWN
+    try:
+        address = ip_address(ip)
+        if not address.is_global:
+            return UNKNOWN
+        return _database.lookup(ip) or UNKNOWN
+    except ValueError:
+        return UNKNOWN
+
+def locate(request: Request, client_ip: str) -> Dict[str, str]:
+    """Visitor country: Cloudflare's CF-IPCountry header if present, else a local lookup"""
+    cf_country = request.headers.get('cf-ipcountry', '').strip().upper()
+    if len(cf_country) == 2 and cf_country not in CF_NON_COUNTRIES:
+        return {'country': country_name(cf_country), 'countryCode': cf_country}
+    return lookup_ip(client_ip)
@@ -0,0 +1,251 @@
+import asyncio
+import copy
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import AsyncIterator, Dict, FrozenSet, List, Optional, Tuple
+
+import httpx
+
+from app.config import settings
+from app.telemetry import timed
+from app import metrics, resilience
+from app.resilience import CircuitOpenError, ha_breaker
+
+# Get the FastAPI logger
+logger = logging.getLogger("main")
+
+# HTTP/2 needs the optional h2 package (pip install httpx[http2])
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Application-lifetime client, created in the FastAPI lifespan hook
+_client: Optional[httpx.AsyncClient] = None
+
+# Last successfully fetched raw state per entity, served when a fetch fails
+last_good_states: Dict[str, Tuple[dict, float]] = {}
+
+def ha_headers() -> Dict[str, str]:
+    """Headers for authenticated Home Assistant API calls"""
+    return {
+        "Authorization": f"Bearer {settings.HASS_TOKEN}",
+        "Content-Type": "application/json",
+    }
+
+def _create_client(transport: Optional[httpx.AsyncBaseTransport] = None) -> httpx.AsyncClient:
+    """Create a pooled keep-alive client for Home Assistant (transport replaces the network, e.g. in benchmarks)"""
+    limits = httpx.Limits(
+        max_connections=settings.HA_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.HA_MAX_CONNECTIONS,
+        keepalive_expiry=settings.HA_KEEPALIVE_EXPIRY,
+    )
+    return httpx.AsyncClient(
+        base_url=settings.HASS_URL,
+        headers=ha_headers(),
+        limits=limits,
+        http2=settings.HA_HTTP2 and HTTP2_AVAILABLE,
+        timeout=httpx.Timeout(10.0),
+        transport=transport,
+    )
+
+async def start_client(transport: Optional[httpx.AsyncBaseTransport] = None) -> None:
+    """Open the shared Home Assistant client"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _create_client(transport)
+        logger.info(
+            f"HA client started (pool={settings.HA_MAX_CONNECTIONS}, "
+            f"http2={settings.HA_HTTP2 and HTTP2_AVAILABLE})"
+        )
+
+async def close_client() -> None:
+    """Close the shared Home Assistant client"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+        logger.info("HA client closed")
+
+def get_client() -> httpx.AsyncClient:
+    """Return the shared client, creating it lazily if the lifespan hook did not run"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _create_client()
+    return _client
+
+def _record_response(endpoint: str, start: float, response: httpx.Response) -> None:
+    """Feed a Home Assistant response into the metrics and the circuit breaker"""
+    metrics.observe_upstream(endpoint, start, response)
+    if response.status_code >= 500:
+        ha_breaker.record_failure()
+    else:
+        ha_breaker.record_success()
+
+def _record_error(endpoint: str, start: float, error: Exception) -> None:
+    """Feed a failed Home Assistant call into the metrics and the circuit breaker"""
+    if isinstance(error, CircuitOpenError):
+        metrics.UPSTREAM_ERRORS.inc(endpoint, 'circuit_open')
+    elif isinstance(error, resilience.DeadlineExceeded):
+        metrics.UPSTREAM_ERRORS.inc(endpoint, 'deadline')
+    else:
+        metrics.observe_upstream(endpoint, start, error=error)
+        ha_breaker.record_failure()
+
+async def ha_get(endpoint: str, path: str, default_timeout: float, **kwargs) -> httpx.Response:
+    """
+    GET from Home Assistant through the circuit breaker, with the timeout
+    capped by the current request's time budget.
+    """
+    start = time.perf_counter()
+    try:
+        ha_breaker.check()
+        async with resilience.within_deadline():
+            response = await get_client().get(path, timeout=resilience.timeout(default_timeout), **kwargs)
+    except Exception as e:
+        _record_error(endpoint, start, e)
+        raise
+    _record_response(endpoint, start, response)
+    return response
+
+@asynccontextmanager
+async def ha_stream(endpoint: str, path: str, default_timeout: float, **kwargs) -> AsyncIterator[httpx.Response]:
+    """
+    ha_get for reading the body as it arrives (response.aiter_bytes()).
+    Callers bound the body read with resilience.within_deadline().
+    """
+    start = time.perf_counter()
+    try:
+        ha_breaker.check()
+        request = get_client().stream("GET", path, timeout=resilience.timeout(default_timeout), **kwargs)
+        response = await request.__aenter__()
+    except Exception as e:
+        _record_error(endpoint, start, e)
+        raise
+    try:
+        _record_response(endpoint, start, response)
+        yield response
+    except httpx.TransportError as e:
+        # Connection lost or timed out while reading the body
+        _record_error(endpoint, start, e)
+        raise
+    finally:
+        await request.__aexit__(None, None, None)
+
+async def fetch_state(sensor_id: str, semaphore: asyncio.Semaphore) -> Optional[dict]:
+    """Fetch a single entity state, returning None on any failure"""
+    async with semaphore:
+        try:
+            response = await ha_get('state', f"/api/states/{sensor_id}", 10.0)
+        except Exception as e:
+            logger.error(f"Request error for sensor {sensor_id}: {e}")
+            return None
+
+    if response.status_code != 200:
+        logger.error(f"Error fetching sensor {sensor_id}: HTTP {response.status_code}")
+        return None
+    return response.json()
+
+async def fetch_states_individually(sensor_ids: List[str]) -> Dict[str, dict]:
+    """
+    Fetch states for the given entities with one request per entity.
+
+    At most HA_CONCURRENCY requests are in flight at once. The returned dict
+    keeps the order of sensor_ids and only contains entities that were fetched
+    successfully.
+    """
+    semaphore = asyncio.Semaphore(settings.HA_CONCURRENCY)
+    results = await asyncio.gather(
+        *(fetch_state(sensor_id, semaphore) for sensor_id in sensor_ids)
+    )
+    return {
+        sensor_id: state
+        for sensor_id, state in zip(sensor_ids, results)
+        if state is not None
+    }
+
+@lru_cache(maxsize=32)
+def _entity_id_set(sensor_ids: Tuple[str, ...]) -> FrozenSet[str]:
+    """Precomputed lookup set for a configured list of entity IDs"""
+    return frozenset(sensor_ids)
+
+async def fetch_states_bulk(sensor_ids: List[str]) -> Optional[Dict[str, dict]]:
+    """
+    Fetch all states with a single /api/states call and keep only sensor_ids.
+
+    Returns None when the call fails or the body exceeds HA_BULK_MAX_BYTES,
+    so the caller can fall back to per-entity requests.
+    """
+    max_bytes = settings.HA_BULK_MAX_BYTES
+    try:
+        async with resilience.within_deadline(), ha_stream('states', "/api/states", 10.0) as response:
+            if response.status_code != 200:
+                logger.warning(f"Bulk state fetch failed: HTTP {response.status_code}")
+                return None
+            
+            declared = response.headers.get("content-length")
+            if declared and int(declared) > max_bytes:
+                logger.warning(f"Bulk state fetch too large ({declared} bytes)")
+                return None
+            
+            body = bytearray()
+            async for chunk in response.aiter_bytes():
+                body.extend(chunk)
+                if len(body) > max_bytes:
+                    logger.warning(f"Bulk state fetch exceeded {max_bytes} bytes")
+                    return None
+        
+        states = json.loads(body)
+    except Exception as e:
+        logger.warning(f"Bulk state fetch error: {e}")
+        return None
+    
+    wanted = _entity_id_set(tuple(sensor_ids))
+    found = {state['entity_id']: state for state in states if state.get('entity_id') in wanted}
+    return {sensor_id: found[sensor_id] for sensor_id in sensor_ids if sensor_id in found}
+
+async def fetch_states(sensor_ids: List[str]) -> Dict[str, dict]:
+    """
+    Fetch states for the given entities, keyed by entity ID in configured order.
+
+    Uses one bulk /api/states request when HA_BULK_STATES is enabled and falls
+    back to per-entity requests if the bulk call fails or returns too much.
+    Raises UpstreamUnavailable if no entity could be fetched, so callers keep
+    what they have instead of treating last-good copies as a refresh.
+    """
+    with timed('ha'):
+        states = None
+        if settings.HA_BULK_STATES:
+            states = await fetch_states_bulk(sensor_ids)
+            if states is None:
+                logger.info("Falling back to per-entity state fetches")
+        if states is None:
+            states = await fetch_states_individually(sensor_ids)
+    if sensor_ids and not states:
+        raise resilience.UpstreamUnavailable("No sensor states could be fetched from Home Assistant")
+    return with_last_good_states(sensor_ids, states)
+
+def with_last_good_states(sensor_ids: List[str], states: Dict[str, dict]) -> Dict[str, dict]:
+    """
+    Remember fetched states and fill in entities whose fetch failed with their
+    last good state, marked "stale": true, if it is at most HA_LAST_GOOD_MAX_AGE
+    seconds old. Keeps the order of sensor_ids.
+    """
+    now = time.time()
+    result = {}
+    for sensor_id in sensor_ids:
+        state = states.get(sensor_id)
+        if state is not None:
+            # Copied because responses are formatted in place
+            last_good_states[sensor_id] = (copy.deepcopy(state), now)
+            result[sensor_id] = state
+        elif sensor_id in last_good_states:
+            good, fetched_at = last_good_states[sensor_id]
+            if now - fetched_at > settings.HA_LAST_GOOD_MAX_AGE:
+                continue
+            result[sensor_id] = {**copy.deepcopy(good), 'stale': True, 'stale_age': int(now - fetched_at)}
+    return result
@@ -0,0 +1,211 @@
+import asyncio
+import copy
+import json
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import websockets
+
+from app.config import settings
+
+# Get the FastAPI logger
+logger = logging.getLogger("main")
+
+# Always-current raw states of the configured entities, fed by subscribe_entities events
+sensor_store: Dict[str, dict] = {}
+store_version = 0  # Incremented on every change so readers can detect updates
+store_live = False  # True only while connected and resynced
+
+_task: Optional[asyncio.Task] = None
+_update_event: Optional[asyncio.Event] = None
+
+# Message ID of the subscribe_entities command sent after authentication
+SUBSCRIBE_ID = 1
+
+def websocket_url() -> str:
+    """WebSocket endpoint of Home Assistant, derived from HASS_URL unless overridden"""
+    if settings.HASS_WS_URL:
+        return settings.HASS_WS_URL
+    base = settings.HASS_URL.rstrip('/')
+    if base.startswith('https://'):
+        base = 'wss://' + base[len('https://'):]
+    elif base.startswith('http://'):
+        base = 'ws://' + base[len('http://'):]
+    return f"{base}/api/websocket"
+
+def is_live() -> bool:
+    """Whether the store is connected and can be read instead of polling REST"""
+    return store_live and bool(sensor_store)
+
+def get_states(sensor_ids: List[str]) -> Dict[str, dict]:
+    """Copies of the stored states for sensor_ids, in the given order"""
+    return {
+        sensor_id: copy.deepcopy(sensor_store[sensor_id])
+        for sensor_id in sensor_ids
+        if sensor_id in sensor_store
+    }
+
+async def wait_for_update(since_version: int, timeout: float) -> bool:
+    """Wait until the store changes past since_version; False on timeout"""
+    if store_version != since_version:
+        return True
+    if _update_event is None:
+        await asyncio.sleep(timeout)
+        return False
+    try:
+        await asyncio.wait_for(_update_event.wait(), timeout)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+def _notify() -> None:
+    """Bump the store version and wake up waiters"""
+    global store_version, _update_event
+    store_version += 1
+    if _update_event is not None:
+        _update_event.set()
+        # Fresh event for the next round of waiters
+        _update_event = asyncio.Event()
+
+def _iso(timestamp: float) -> str:
+    """Epoch seconds from a compressed state as an ISO timestamp, as in REST states"""
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+def _expand_state(entity_id: str, compressed: dict) -> dict:
+    """
+    Full state, as /api/states returns it, from subscribe_entities' compressed
+    form: s(tate), a(ttributes), lc (last changed) and lu (last updated, only
+    sent when it differs from lc).
+    """
+    last_changed = _iso(compressed['lc'])
+    return {
+        'entity_id': entity_id,
+        'state': compressed['s'],
+        'attributes': compressed.get('a', {}),
+        'last_changed': last_changed,
+        'last_updated': _iso(compressed['lu']) if 'lu' in compressed else last_changed
+    }
+
+def _apply_diff(state: dict, diff: dict) -> None:
+    """Apply a compressed change ('+' for added or changed fields, '-' for removed attributes)"""
+    additions = diff.get('+', {})
+    if 's' in additions:
+        state['state'] = additions['s']
+    if 'lc' in additions:
+        # A new last_changed is also the new last_updated
+        state['last_changed'] = state['last_updated'] = _iso(additions['lc'])
+    elif 'lu' in additions:
+        state['last_updated'] = _iso(additions['lu'])
+    removed = diff.get('-', {}).get('a', [])
+    if 'a' in additions or removed:
+        attributes = {**state['attributes'], **additions.get('a', {})}
+        for name in removed:
+            attributes.pop(name, None)
+        state['attributes'] = attributes
+
+def _resync(added: Dict[str, dict]) -> None:
+    """Replace the store with the snapshot the subscription starts with"""
+    global sensor_store, store_live
+    sensor_store = {entity_id: _expand_state(entity_id, compressed) for entity_id, compressed in added.items()}
+    store_live = True
+    _notify()
+    logger.info(f"🔌 HA websocket: resynced {len(sensor_store)} entities")
+
+def _apply_changes(event: dict) -> None:
+    """Apply a subscribe_entities event: a(dded), c(hanged) and r(emoved) entities"""
+    for entity_id, compressed in event.get('a', {}).items():
+        sensor_store[entity_id] = _expand_state(entity_id, compressed)
+    for entity_id, diff in event.get('c', {}).items():
+        if entity_id in sensor_store:
+            _apply_diff(sensor_store[entity_id], diff)
+    for entity_id in event.get('r', []):
+        # Entity was removed from Home Assistant
+        sensor_store.pop(entity_id, None)
+    _notify()
+
+async def _authenticate(ws) -> None:
+    """Run the Home Assistant WebSocket auth handshake"""
+    message = json.loads(await ws.recv())
+    if message.get('type') != 'auth_required':
+        raise ConnectionError(f"Unexpected handshake message: {message.get('type')}")
+
+    await ws.send(json.dumps({'type': 'auth', 'access_token': settings.HASS_TOKEN}))
+    message = json.loads(await ws.recv())
+    if message.get('type') != 'auth_ok':
+        raise ConnectionError(f"Authentication failed: {message.get('message', message.get('type'))}")
+
+async def _run_session(ws) -> None:
+    """Authenticate, subscribe to the configured entities and apply their changes until the socket closes"""
+    await _authenticate(ws)
+
+    # Home Assistant filters on its side and starts with a snapshot of the
+    # entities, so the store resyncs without get_states and nothing is missed
+    await ws.send(json.dumps({
+        'id': SUBSCRIBE_ID,
+        'type': 'subscribe_entities',
+        'entity_ids': settings.sensor_list
+    }))
+
+    synced = False
+    async for raw in ws:
+        message = json.loads(raw)
+        message_type = message.get('type')
+
+        if message_type == 'event':
+            event = message.get('event', {})
+            if synced:
+                _apply_changes(event)
+            else:
+                _resync(event.get('a', {}))
+                synced = True
+        elif message_type == 'result' and not message.get('success'):
+            raise ConnectionError(f"Command {message.get('id')} failed: {message.get('error')}")
+
+async def run_subscription() -> None:
+    """Keep a WebSocket subscription to Home Assistant alive, reconnecting with backoff"""
+    global store_live
+    backoff = 1.0
+    url = websocket_url()
+
+    while True:
+        try:
+            async with websockets.connect(
+                url,
+                max_size=settings.HA_WS_MAX_MESSAGE_BYTES,
+                ping_interval=20,
+                ping_timeout=20
+            ) as ws:
+                logger.info(f"🔌 HA websocket: connected to {url}")
+                backoff = 1.0
+                await _run_session(ws)
+            logger.warning("🔌 HA websocket: connection closed")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"🔌 HA websocket: {e}")
+        finally:
+            # Readers fall back to REST polling until the next resync
+            store_live = False
+
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, settings.HA_WS_MAX_BACKOFF)
+
+def start() -> None:
+    """Start the background subscription task"""
+    global _task, _update_event
+    if _task is None or _task.done():
+        _update_event = asyncio.Event()
+        _task = asyncio.create_task(run_subscription())
+
+async def stop() -> None:
+    """Cancel the background subscription task"""
+    global _task, store_live
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+    store_live = False
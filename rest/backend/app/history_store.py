@@ -0,0 +1,533 @@
+import asyncio
+import logging
+import math
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.config import settings
+from app import resilience
+from app.ha_client import ha_stream
+from app.jsonstream import ArrayItemParser
+from app.sensors import get_spec
+from app.telemetry import timed
+
+# Get the FastAPI logger
+logger = logging.getLogger("main")
+
+# Embedded time-series store for sensor history
+HISTORY_DB = Path(__file__).parent.parent / 'data' / 'history.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    entity_id TEXT NOT NULL,
+    ts REAL NOT NULL,
+    state TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (entity_id, ts)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    entity_id TEXT PRIMARY KEY,
+    synced_from REAL NOT NULL,
+    synced_to REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS rollups (
+    entity_id TEXT NOT NULL,
+    granularity INTEGER NOT NULL,
+    bucket REAL NOT NULL,
+    v_min REAL NOT NULL,
+    v_max REAL NOT NULL,
+    v_sum REAL NOT NULL,
+    v_count INTEGER NOT NULL,
+    v_last REAL NOT NULL,
+    last_ts REAL NOT NULL,
+    PRIMARY KEY (entity_id, granularity, bucket)
+) WITHOUT ROWID;
+"""
+
+# Rollup bucket widths in seconds, by granularity name (buckets are aligned to UTC)
+ROLLUP_GRANULARITIES = {'5m': 300, '1h': 3600, '1d': 86400}
+
+# 5 minute rollups are pruned with raw samples; hourly and daily ones are kept
+PRUNED_GRANULARITIES = (300,)
+
+UPSERT_ROLLUP = """
+INSERT INTO rollups (entity_id, granularity, bucket, v_min, v_max, v_sum, v_count, v_last, last_ts)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(entity_id, granularity, bucket) DO UPDATE SET
+    v_min = MIN(v_min, excluded.v_min),
+    v_max = MAX(v_max, excluded.v_max),
+    v_sum = v_sum + excluded.v_sum,
+    v_count = v_count + excluded.v_count,
+    v_last = CASE WHEN excluded.last_ts >= last_ts THEN excluded.v_last ELSE v_last END,
+    last_ts = MAX(last_ts, excluded.last_ts)
+"""
+
+# Rollups of one entity rebuilt from its samples at or after :start, within the sensor's
+# valid range as series.load() applies it. SQLite returns the bare value column from the
+# row holding MAX(ts)
+REBUILD_ROLLUPS = """
+INSERT INTO rollups (entity_id, granularity, bucket, v_min, v_max, v_sum, v_count, v_last, last_ts)
+SELECT entity_id, :g, CAST(ts / :g AS INTEGER) * :g,
+       MIN(value), MAX(value), SUM(value), COUNT(value), value, MAX(ts)
+FROM samples
+WHERE entity_id = :entity_id AND ts >= :start AND value IS NOT NULL
+  AND (:low IS NULL OR value >= :low) AND (:high IS NULL OR value <= :high)
+GROUP BY CAST(ts / :g AS INTEGER)
+"""
+
+# Stored in PRAGMA user_version; rollups are rebuilt once when it is raised
+# (1: out-of-range values excluded)
+ROLLUP_VERSION = 1
+
+# A sample row: (epoch seconds, raw state, numeric value or None)
+Sample = Tuple[float, str, Optional[float]]
+
+# A rollup row: (bucket start, min, max, mean, count, last value)
+Rollup = Tuple[float, float, float, float, int, float]
+
+# Numeric samples as columns: epoch seconds, values, raw states (object array), oldest first
+Columns = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+# Rows per chunk when stored samples are streamed to a client
+STREAM_CHUNK_ROWS = 5000
+
+_conn: Optional[sqlite3.Connection] = None
+_db_lock = threading.Lock()
+_sync_locks: Dict[str, asyncio.Lock] = {}
+
+def _connect() -> sqlite3.Connection:
+    """Open the store in WAL mode so readers never block the writer"""
+    HISTORY_DB.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(HISTORY_DB, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+def get_connection() -> sqlite3.Connection:
+    """Shared connection, opened on first use"""
+    global _conn
+    if _conn is None:
+        _conn = _connect()
+    return _conn
+
+def close_store() -> None:
+    """Close the shared connection"""
+    global _conn
+    with _db_lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+
+def parse_timestamp(value: str) -> float:
+    """Convert a Home Assistant ISO timestamp to epoch seconds"""
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+def ts_to_iso(ts: float) -> str:
+    """Convert epoch seconds to an ISO timestamp in UTC, as Home Assistant reports them"""
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat()
+
+def ts_to_iso_array(times: np.ndarray) -> List[str]:
+    """ts_to_iso for a whole array of epoch seconds"""
+    times = np.asarray(times, dtype=np.float64)
+    # Round the fraction on its own, as datetime.fromtimestamp does
+    seconds = np.floor(times)
+    stamps = (seconds.astype(np.int64) * 1_000_000 + np.round((times - seconds) * 1e6).astype(np.int64)).astype('datetime64[us]')
+    text = np.datetime_as_string(stamps, unit='us')
+    # isoformat() leaves out the fraction for whole seconds
+    whole = stamps.astype(np.int64) % 1_000_000 == 0
+    if whole.any():
+        text = text.astype(object)
+        text[whole] = np.datetime_as_string(stamps[whole], unit='s')
+    return [f"{t}+00:00" for t in text.tolist()]
+
+def parse_value(state: str) -> Optional[float]:
+    """Numeric value of a state, or None for non-numeric states"""
+    try:
+        value = float(state)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+def _accumulate_rollups(entity_id: str, samples: List[Sample]) -> List[tuple]:
+    """Aggregate newly inserted numeric samples within the sensor's valid range into per-bucket rollup rows"""
+    spec = get_spec(entity_id)
+    buckets: Dict[Tuple[int, float], list] = {}
+    for ts, _, value in samples:
+        if value is None or not spec.in_range(value):
+            continue
+        for granularity in ROLLUP_GRANULARITIES.values():
+            key = (granularity, (ts // granularity) * granularity)
+            agg = buckets.get(key)
+            if agg is None:
+                buckets[key] = [value, value, value, 1, value, ts]
+                continue
+            agg[0] = min(agg[0], value)
+            agg[1] = max(agg[1], value)
+            agg[2] += value
+            agg[3] += 1
+            if ts >= agg[5]:
+                agg[4], agg[5] = value, ts
+    return [(entity_id, g, bucket, *agg) for (g, bucket), agg in buckets.items()]
+
+def _store_samples(entity_id: str, samples: List[Sample], synced_from: float, synced_to: float) -> int:
+    """Insert samples, update rollups for new ones and record the covered range in one transaction"""
+    with _db_lock:
+        conn = get_connection()
+        with conn:
+            inserted = []
+            for ts, state, value in samples:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO samples (entity_id, ts, state, value) VALUES (?, ?, ?, ?)",
+                    (entity_id, ts, state, value)
+                )
+                if cursor.rowcount:
+                    inserted.append((ts, state, value))
+            # Only samples we did not have yet, so re-synced windows are never counted twice
+            conn.executemany(UPSERT_ROLLUP, _accumulate_rollups(entity_id, inserted))
+            conn.execute(
+                "INSERT INTO sync_state (entity_id, synced_from, synced_to) VALUES (?, ?, ?) "
+                "ON CONFLICT(entity_id) DO UPDATE SET "
+                "synced_from = excluded.synced_from, synced_to = excluded.synced_to",
+                (entity_id, synced_from, synced_to)
+            )
+    return len(inserted)
+
+def _query_columns(entity_id: str, start_ts: float, end_ts: float, with_states: bool) -> Columns:
+    # Reading the state strings costs about as much as the rest; skip them when only values are needed
+    with _db_lock:
+        rows = get_connection().execute(
+            f"SELECT ts, value{', state' if with_states else ''} FROM samples "
+            "WHERE entity_id = ? AND ts >= ? AND ts <= ? AND value IS NOT NULL ORDER BY ts",
+            (entity_id, start_ts, end_ts)
+        ).fetchall()
+    if not rows:
+        return np.empty(0), np.empty(0), np.empty(0, dtype=object)
+    if not with_states:
+        columns = np.array(rows, dtype=np.float64)
+        return columns[:, 0].copy(), columns[:, 1].copy(), np.empty(0, dtype=object)
+    # Transpose in C rather than building each column with a Python loop
+    times, values, states = zip(*rows)
+    return np.array(times, dtype=np.float64), np.array(values, dtype=np.float64), np.array(states, dtype=object)
+
+def _query_columns_after(entity_id: str, after_ts: float, end_ts: float, limit: int) -> Columns:
+    """Up to limit numeric samples with after_ts < ts <= end_ts (keyset pagination)"""
+    with _db_lock:
+        rows = get_connection().execute(
+            "SELECT ts, value, state FROM samples "
+            "WHERE entity_id = ? AND ts > ? AND ts <= ? AND value IS NOT NULL ORDER BY ts LIMIT ?",
+            (entity_id, after_ts, end_ts, limit)
+        ).fetchall()
+    if not rows:
+        return np.empty(0), np.empty(0), np.empty(0, dtype=object)
+    times, values, states = zip(*rows)
+    return np.array(times, dtype=np.float64), np.array(values, dtype=np.float64), np.array(states, dtype=object)
+
+def _query_columns_before(entity_id: str, before_ts: float, limit: int) -> Columns:
+    """Up to limit numeric samples with ts < before_ts, newest first"""
+    with _db_lock:
+        rows = get_connection().execute(
+            "SELECT ts, value FROM samples "
+            "WHERE entity_id = ? AND ts < ? AND value IS NOT NULL ORDER BY ts DESC LIMIT ?",
+            (entity_id, before_ts, limit)
+        ).fetchall()
+    if not rows:
+        return np.empty(0), np.empty(0), np.empty(0, dtype=object)
+    columns = np.array(rows, dtype=np.float64)
+    return columns[:, 0].copy(), columns[:, 1].copy(), np.empty(0, dtype=object)
+
+def _query_rollups(entity_id: str, granularity: int, start_ts: float, end_ts: float) -> List[Rollup]:
+    with _db_lock:
+        return get_connection().execute(
+            "SELECT bucket, v_min, v_max, v_sum / v_count, v_count, v_last FROM rollups "
+            "WHERE entity_id = ? AND granularity = ? AND bucket >= ? AND bucket <= ? ORDER BY bucket",
+            (entity_id, granularity, (start_ts // granularity) * granularity, end_ts)
+        ).fetchall()
+
+def retention_cutoff() -> float:
+    """Raw samples older than this are not stored"""
+    return time.time() - settings.HISTORY_RETENTION_DAYS * 86400
+
+def _prune(cutoff: float) -> None:
+    """Drop samples older than cutoff and shrink the recorded ranges"""
+    with _db_lock:
+        conn = get_connection()
+        with conn:
+            conn.execute("DELETE FROM samples WHERE ts < ?", (cutoff,))
+            for granularity in PRUNED_GRANULARITIES:
+                conn.execute(
+                    "DELETE FROM rollups WHERE granularity = ? AND bucket < ?",
+                    (granularity, cutoff)
+                )
+            conn.execute(
+                "UPDATE sync_state SET synced_from = ? WHERE synced_from < ?",
+                (cutoff, cutoff)
+            )
+
+def _rebuild_rollups(conn: sqlite3.Connection, entity_id: str, keep_first_bucket: bool) -> None:
+    """Replace an entity's rollups with ones computed from its stored samples"""
+    first_ts = conn.execute("SELECT MIN(ts) FROM samples WHERE entity_id = ?", (entity_id,)).fetchone()[0]
+    if first_ts is None:
+        return
+    low, high = get_spec(entity_id).bounds or (None, None)
+    for granularity in ROLLUP_GRANULARITIES.values():
+        start = (first_ts // granularity) * granularity
+        if keep_first_bucket and start < first_ts:
+            # Older samples of that bucket may have been pruned; only its rollup still counts them
+            start += granularity
+        conn.execute(
+            "DELETE FROM rollups WHERE entity_id = ? AND granularity = ? AND bucket >= ?",
+            (entity_id, granularity, start)
+        )
+        conn.execute(REBUILD_ROLLUPS, {
+            'g': granularity, 'entity_id': entity_id, 'start': start, 'low': low, 'high': high
+        })
+
+def _update_rollups() -> None:
+    """
+    Build rollups from existing samples for stores created before rollups
+    existed, and rebuild them once when ROLLUP_VERSION changes
+    """
+    with _db_lock:
+        conn = get_connection()
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= ROLLUP_VERSION:
+            return
+        has_rollups = conn.execute("SELECT 1 FROM rollups LIMIT 1").fetchone() is not None
+        entity_ids = [row[0] for row in conn.execute("SELECT DISTINCT entity_id FROM samples")]
+        with conn:
+            for entity_id in entity_ids:
+                _rebuild_rollups(conn, entity_id, keep_first_bucket=has_rollups)
+            conn.execute(f"PRAGMA user_version = {ROLLUP_VERSION}")
+    if entity_ids:
+        logger.info("History store: rebuilt rollups from stored samples")
+
+async def init_store() -> None:
+    """Open the store, build missing rollups and apply the retention period"""
+    await asyncio.to_thread(_update_rollups)
+    await asyncio.to_thread(_prune, retention_cutoff())
+    logger.info(f"History store ready at {HISTORY_DB}")
+
+def _history_sample(item: dict) -> Optional[Tuple[str, Sample]]:
+    """(entity_id, sample) from one Home Assistant history state, or None if unusable"""
+    timestamp = item.get('last_updated') or item.get('last_changed')
+    state = item.get('state')
+    if not timestamp or state is None:
+        return None
+    try:
+        ts = parse_timestamp(timestamp)
+    except ValueError:
+        return None
+    return item.get('entity_id'), (ts, state, parse_value(state))
+
+async def iter_history_from_ha(entity_ids: List[str], start_ts: float, end_ts: float) -> AsyncIterator[Tuple[str, Sample]]:
+    """
+    Stream raw history for several entities from one Home Assistant request.
+
+    The body is parsed as it arrives and each state is reduced to a sample
+    straight away, so neither the body nor HA's state objects are held in
+    memory. Raises if the request fails.
+    """
+    wanted = set(entity_ids)
+    params = {
+        "filter_entity_id": ",".join(entity_ids),
+        "end_time": ts_to_iso(end_ts),
+        "minimal_response": False,
+        "no_attributes": True
+    }
+    async with ha_stream('history', f"/api/history/period/{ts_to_iso(start_ts)}", 30.0, params=params) as response:
+        response.raise_for_status()
+        parser = ArrayItemParser(depth=2)
+        async for chunk in response.aiter_bytes():
+            for item in parser.feed(chunk):
+                sample = _history_sample(item)
+                if sample is not None and sample[0] in wanted:
+                    yield sample
+        parser.close()
+
+async def _collect_history(entity_ids: List[str], start_ts: float, end_ts: float) -> Dict[str, List[Sample]]:
+    result: Dict[str, List[Sample]] = {entity_id: [] for entity_id in entity_ids}
+    samples = iter_history_from_ha(entity_ids, start_ts, end_ts)
+    try:
+        async with resilience.within_deadline():
+            async for entity_id, sample in samples:
+                result[entity_id].append(sample)
+    finally:
+        # Close the request promptly when a hedged duplicate wins
+        await samples.aclose()
+    return result
+
+async def fetch_history_from_ha(entity_ids: List[str], start_ts: float, end_ts: float,
+                                hedge: bool = False) -> Optional[Dict[str, List[Sample]]]:
+    """
+    Fetch raw history for several entities with one Home Assistant request.
+
+    With hedge, a slow request is duplicated after HA_HEDGE_DELAY (history
+    reads are idempotent). Returns samples per entity, or None if the request failed.
+    """
+    try:
+        with timed('ha'):
+            return await resilience.hedged(
+                lambda: _collect_history(entity_ids, start_ts, end_ts),
+                settings.HA_HEDGE_DELAY if hedge else 0
+            )
+    except Exception as e:
+        logger.error(f"Error fetching history for {entity_ids}: {e}")
+        return None
+
+def _get_sync_states(entity_ids: List[str]) -> Dict[str, Tuple[float, float]]:
+    with _db_lock:
+        rows = get_connection().execute(
+            f"SELECT entity_id, synced_from, synced_to FROM sync_state "
+            f"WHERE entity_id IN ({','.join('?' * len(entity_ids))})",
+            entity_ids
+        ).fetchall()
+    return {row[0]: (row[1], row[2]) for row in rows}
+
+# A window to fetch from HA: (start, end, appends to the stored range)
+Window = Tuple[float, float, bool]
+
+def _plan_windows(state: Optional[Tuple[float, float]], start_ts: float, end_ts: float,
+                  now: float) -> List[Window]:
+    """Windows an entity is missing for [start_ts, end_ts], the live edge first"""
+    if state is None:
+        return [(start_ts, end_ts, False)]
+
+    synced_from, synced_to = state
+    windows: List[Window] = []
+
+    live_edge = end_ts >= now - settings.HISTORY_SYNC_INTERVAL
+    if end_ts > synced_to and not (live_edge and now - synced_to < settings.HISTORY_SYNC_INTERVAL):
+        # Always extend to now so the live edge stays contiguous
+        windows.append((synced_to, now, True))
+
+    if start_ts < synced_from:
+        windows.append((start_ts, synced_from, False))
+
+    return windows
+
+def _chunks(window: Window) -> List[Tuple[float, float]]:
+    """
+    A window split into requests of at most HISTORY_CHUNK_HOURS, ordered so
+    each one borders the range already stored: oldest first when appending,
+    newest first when backfilling (or for an entity with nothing stored).
+    """
+    start, end, appending = window
+    size = settings.HISTORY_CHUNK_HOURS * 3600
+    chunks = []
+    if appending:
+        while start < end:
+            chunks.append((start, min(start + size, end)))
+            start += size
+    else:
+        while end > start:
+            chunks.append((max(end - size, start), end))
+            end -= size
+    return chunks
+
+def unknown_entities(entity_ids: List[str]) -> List[str]:
+    """Entities not in SENSOR_IDS; only configured sensors are synced and stored"""
+    configured = set(settings.sensor_list)
+    return [entity_id for entity_id in entity_ids if entity_id not in configured]
+
+async def sync_entities(entity_ids: List[str], start_ts: float, end_ts: float) -> bool:
+    """
+    Make sure [start_ts, end_ts] is stored locally for all entities, fetching only what is missing.
+
+    The stored range per entity is kept contiguous: older windows are
+    backfilled before it and newer data is appended after it, at most once
+    per HISTORY_SYNC_INTERVAL for the live edge. Entities missing the same
+    window share Home Assistant requests of at most HISTORY_CHUNK_HOURS. Returns False if any needed
+    request failed. Raises ValueError for entities that are not configured.
+    """
+    unknown = unknown_entities(entity_ids)
+    if unknown:
+        raise ValueError(f"Not a configured sensor: {', '.join(unknown)}")
+    # Lock in a fixed order so overlapping batches cannot deadlock
+    locks = [_sync_locks.setdefault(entity_id, asyncio.Lock()) for entity_id in sorted(set(entity_ids))]
+    for lock in locks:
+        await lock.acquire()
+    try:
+        now = time.time()
+        end_ts = min(end_ts, now)
+        # Raw data beyond retention is not kept; older ranges come from rollups only
+        start_ts = max(start_ts, retention_cutoff())
+        if start_ts >= end_ts:
+            return True
+        coverage = await asyncio.to_thread(_get_sync_states, entity_ids)
+
+        # Group entities by the exact window they are missing
+        groups: Dict[Window, List[str]] = {}
+        for entity_id in entity_ids:
+            for window in _plan_windows(coverage.get(entity_id), start_ts, end_ts, now):
+                groups.setdefault(window, []).append(entity_id)
+
+        # Each chunk is stored as soon as it arrives and extends the recorded
+        # coverage, so a long backfill cut short by the budget resumes where it
+        # stopped instead of starting over
+        inserted: Dict[str, int] = {}
+        failed = set()
+        for window, group in sorted(groups.items(), key=lambda item: not item[0][2]):
+            for chunk_start, chunk_end in _chunks(window):
+                # Only the small request at the live edge is hedged; a duplicate of a
+                # backfill chunk would double the load on Home Assistant
+                live = window[2] and chunk_end == window[1]
+                fetched = await fetch_history_from_ha(group, chunk_start, chunk_end, hedge=live)
+                if fetched is None:
+                    # Later chunks would leave a gap in the coverage
+                    failed.update(group)
+                    break
+                for entity_id in group:
+                    entity_samples = fetched[entity_id]
+                    if window[2]:
+                        # HA repeats the state valid at the chunk start; we already have it
+                        entity_samples = [s for s in entity_samples if s[0] > chunk_start]
+                    covered = coverage.get(entity_id, (chunk_start, chunk_end))
+                    coverage[entity_id] = (min(covered[0], chunk_start), max(covered[1], chunk_end))
+                    inserted[entity_id] = inserted.get(entity_id, 0) + await asyncio.to_thread(
+                        _store_samples, entity_id, entity_samples, *coverage[entity_id]
+                    )
+
+        for entity_id, count in inserted.items():
+            logger.info(f"History store: synced {count} new samples for {entity_id}")
+
+        return not failed
+    finally:
+        for lock in locks:
+            lock.release()
+
+async def sync_range(entity_id: str, start_ts: float, end_ts: float) -> bool:
+    """Make sure [start_ts, end_ts] is stored locally for a single entity"""
+    return await sync_entities([entity_id], start_ts, end_ts)
+
+async def query_columns(entity_id: str, start_ts: float, end_ts: float, with_states: bool = True) -> Columns:
+    """Stored numeric samples for an entity within [start_ts, end_ts] as columns (states empty unless with_states)"""
+    return await asyncio.to_thread(_query_columns, entity_id, start_ts, end_ts, with_states)
+
+async def query_columns_before(entity_id: str, before_ts: float, limit: int) -> Columns:
+    """The last stored numeric samples before before_ts, newest first (states empty)"""
+    return await asyncio.to_thread(_query_columns_before, entity_id, before_ts, limit)
+
+async def iter_columns(entity_id: str, start_ts: float, end_ts: float) -> AsyncIterator[Columns]:
+    """Stored numeric samples in chunks of STREAM_CHUNK_ROWS, so a long range is never loaded at once"""
+    after = np.nextafter(start_ts, -np.inf)
+    while True:
+        chunk = await asyncio.to_thread(_query_columns_after, entity_id, after, end_ts, STREAM_CHUNK_ROWS)
+        if len(chunk[0]):
+            yield chunk
+        if len(chunk[0]) < STREAM_CHUNK_ROWS:
+            return
+        after = float(chunk[0][-1])
+
+async def query_rollups(entity_id: str, granularity: str, start_ts: float, end_ts: float) -> List[Rollup]:
+    """Rollup buckets for an entity within [start_ts, end_ts], oldest first"""
+    return await asyncio.to_thread(
+        _query_rollups, entity_id, ROLLUP_GRANULARITIES[granularity], start_ts, end_ts
+    )
@@ -0,0 +1,59 @@
+import codecs
+import json
+from typing import Any, List
+
+# Whitespace and separators skipped between array items
+_SKIP = frozenset(' \t\r\n,')
+
+class ArrayItemParser:
+    """
+    Incremental parser for JSON documents made of nested arrays, such as
+    Home Assistant's history ([[state, ...], [state, ...]]).
+
+    Bytes are fed as they arrive; every object found `depth` arrays deep is
+    returned as soon as it is complete. Only the unfinished tail of the
+    input is buffered, so memory does not grow with the document. (Bare
+    numbers as items could be cut at a chunk boundary; HA never sends them.)
+    """
+
+    def __init__(self, depth: int = 2, max_item_bytes: int = 1_000_000):
+        self.depth = depth
+        self.max_item_bytes = max_item_bytes
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self._buffer = ''
+        self._level = 0
+
+    def feed(self, chunk: bytes) -> List[Any]:
+        """Parse a chunk; returns the items completed by it"""
+        buffer = self._buffer + self._decoder.decode(chunk)
+        items = []
+        pos, end = 0, len(buffer)
+        while pos < end:
+            char = buffer[pos]
+            if char in _SKIP:
+                pos += 1
+            elif char == ']':
+                self._level -= 1
+                pos += 1
+            elif char == '[' and self._level < self.depth:
+                self._level += 1
+                pos += 1
+            elif self._level == self.depth:
+                try:
+                    item, pos = self._json.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    # Item not complete yet; keep the tail for the next chunk
+                    break
+                items.append(item)
+            else:
+                raise ValueError(f"Unexpected {char!r} at nesting level {self._level}")
+        self._buffer = buffer[pos:]
+        if len(self._buffer) > self.max_item_bytes:
+            raise ValueError(f"JSON item larger than {self.max_item_bytes} bytes")
+        return items
+
+    def close(self) -> None:
+        """Check that the document ended cleanly"""
+        if self._buffer.strip() or self._level != 0:
+            raise ValueError("Truncated JSON document")
@@ -0,0 +1,382 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from app.config import settings
+from app import history_store, resilience
+from app.metrics import CACHE_REQUESTS
+from app.telemetry import timed
+
+# Get the FastAPI logger
+logger = logging.getLogger("main")
+
+# Longest period /api/lightning-history can serve
+WINDOW_HOURS = 168
+
+INVALID_STATES = ['null', 'None', 'unknown', 'unavailable']
+
+# Windows for strike rates, in minutes
+RATE_WINDOWS = (5, 15, 60)
+
+# Distance samples used for the approach/retreat regression
+TREND_WINDOW_MINUTES = 30
+TREND_MIN_SAMPLES = 3
+STATIONARY_KMH = 2.0  # Slower trends are reported as stationary
+
+# Azimuth sectors, 45° wide, centred on the compass points
+SECTORS = ['N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW']
+SECTOR_WINDOW_MINUTES = 60
+
+def process_lightning_state(sensor_id: str, state: str, timestamp: str) -> Optional[dict]:
+    """Turn one raw lightning state into an event, or None if it is not a valid reading"""
+    # Skip invalid states
+    if state in INVALID_STATES:
+        return None
+
+    try:
+        # Parse numeric values
+        if 'counter' in sensor_id:
+            value = int(float(state))
+            return {'timestamp': timestamp, 'value': value, 'formatted': f"{value} strikes"}
+
+        value = float(state)
+        if 'azimuth' in sensor_id and 0 <= value <= 360:
+            return {'timestamp': timestamp, 'value': value, 'formatted': f"{value}°"}
+        if 'distance' in sensor_id and value >= 0:
+            return {'timestamp': timestamp, 'value': value, 'formatted': f"{value} km"}
+    except (ValueError, TypeError):
+        pass
+    return None
+
+class LightningBuffer:
+    """Rolling WINDOW_HOURS buffer of events for one lightning entity, sorted by time"""
+
+    def __init__(self, sensor_id: str):
+        self.sensor_id = sensor_id
+        self.times: List[float] = []
+        self.values: List[float] = []
+        self.events: List[dict] = []
+        # Running strike total from counter deltas (counter entities only)
+        self.cumulative: List[float] = []
+        self.version = 0
+
+    def extend(self, samples: List[history_store.Sample]) -> int:
+        """Append samples newer than the last stored event; returns the number added"""
+        last = self.times[-1] if self.times else float('-inf')
+        added = 0
+        for ts, state, _ in samples:
+            if ts <= last:
+                continue
+            event = process_lightning_state(self.sensor_id, state, history_store.ts_to_iso(ts))
+            if event is None:
+                continue
+            self.times.append(ts)
+            self.events.append(event)
+            if 'counter' in self.sensor_id:
+                self._extend_cumulative(event['value'])
+            self.values.append(float(event['value']))
+            last = ts
+            added += 1
+        if added:
+            self.version += 1
+        return added
+
+    def _extend_cumulative(self, value: float) -> None:
+        """Add the strikes since the previous counter reading to the running total"""
+        if not self.values:
+            self.cumulative.append(0.0)
+            return
+        delta = value - self.values[-1]
+        if delta < 0:
+            # Counter was reset; everything since the reset is new
+            delta = value
+        self.cumulative.append(self.cumulative[-1] + delta)
+
+    def trim(self, cutoff: float) -> None:
+        """Drop events older than cutoff"""
+        i = bisect_left(self.times, cutoff)
+        if i:
+            del self.times[:i]
+            del self.values[:i]
+            del self.events[:i]
+            del self.cumulative[:i]
+            self.version += 1
+
+    def since(self, start: float) -> List[dict]:
+        """Events at or after start, found with a binary search"""
+        return self.events[bisect_left(self.times, start):]
+
+    def arrays_since(self, start: float):
+        """Times and values at or after start as NumPy arrays"""
+        i = bisect_left(self.times, start)
+        return np.asarray(self.times[i:], dtype=np.float64), np.asarray(self.values[i:], dtype=np.float64)
+
+    def strikes_since(self, start: float) -> int:
+        """Strikes counted after start, from the running total of counter deltas"""
+        if not self.cumulative:
+            return 0
+        i = bisect_left(self.times, start)
+        if i >= len(self.cumulative):
+            return 0
+        # Deltas of samples at or after start; the first one is relative to the sample before it
+        base = self.cumulative[i - 1] if i > 0 else self.cumulative[0]
+        return int(self.cumulative[-1] - base)
+
+# One buffer per configured lightning entity
+buffers: Dict[str, LightningBuffer] = {}
+synced_to: Optional[float] = None
+last_sync: Optional[float] = None
+# Created on first use: on Python 3.9 a lock binds to the loop current at creation
+_sync_lock: Optional[asyncio.Lock] = None
+
+def lightning_sensor_ids() -> List[str]:
+    """Configured lightning entities"""
+    return [sensor_id for sensor_id in settings.sensor_list if 'lightning' in sensor_id]
+
+def get_sync_lock() -> asyncio.Lock:
+    """The lock serializing syncs, created inside the running loop"""
+    global _sync_lock
+    if _sync_lock is None:
+        _sync_lock = asyncio.Lock()
+    return _sync_lock
+
+def sync_due() -> bool:
+    """Whether the next sync() would fetch from Home Assistant"""
+    return last_sync is None or time.time() - last_sync >= settings.LIGHTNING_SYNC_INTERVAL
+
+async def _sync_into(queue: "asyncio.Queue[Optional[Tuple[str, dict]]]", since: Optional[float]) -> None:
+    """
+    Extend all buffers with events since the last sync, at most once per
+    LIGHTNING_SYNC_INTERVAL. All lightning entities share one HA request.
+
+    Puts (sensor_id, event) on the queue for each new event as soon as it is
+    parsed, then None. With since, only events at or after it are put, and the
+    buffered ones are replayed first (under the sync lock, so nothing is missed
+    or repeated). The queue is unbounded and only holds references to buffered
+    events, so the lock never waits on whoever reads it.
+    """
+    global synced_to, last_sync
+    try:
+        async with get_sync_lock():
+            if since is not None:
+                for sensor_id, buffer in list(buffers.items()):
+                    for event in buffer.since(since):
+                        queue.put_nowait((sensor_id, event))
+
+            now = time.time()
+            if last_sync is not None and now - last_sync < settings.LIGHTNING_SYNC_INTERVAL:
+                CACHE_REQUESTS.inc('lightning', 'hit')
+                return
+            CACHE_REQUESTS.inc('lightning', 'miss')
+
+            sensor_ids = lightning_sensor_ids()
+            if not sensor_ids:
+                return
+
+            window_start = now - WINDOW_HOURS * 3600
+            start = max(synced_to, window_start) if synced_to is not None else window_start
+            added = 0
+            samples = history_store.iter_history_from_ha(sensor_ids, start, now)
+            try:
+                with timed('ha'):
+                    async with resilience.within_deadline():
+                        async for sensor_id, sample in samples:
+                            if synced_to is not None and sample[0] <= start:
+                                # HA repeats the state valid at the window start; it is not a new event
+                                continue
+                            buffer = buffers.setdefault(sensor_id, LightningBuffer(sensor_id))
+                            if buffer.extend([sample]):
+                                added += 1
+                                if since is None or sample[0] >= since:
+                                    queue.put_nowait((sensor_id, buffer.events[-1]))
+            except Exception as e:
+                # Serve what we have; retry on the next request after the interval.
+                # Events already added are kept; the next sync skips them.
+                logger.error(f"Lightning buffer: sync failed: {e}")
+                last_sync = now
+                return
+            finally:
+                await samples.aclose()
+
+            for buffer in buffers.values():
+                buffer.trim(window_start)
+            synced_to = now
+            last_sync = now
+            logger.info(f"Lightning buffer: synced {added} new events")
+    finally:
+        queue.put_nowait(None)
+
+# Running syncs, referenced so they finish even if their reader goes away
+_sync_tasks: Set[asyncio.Task] = set()
+
+async def stream_sync(since: Optional[float] = None) -> AsyncIterator[Tuple[str, dict]]:
+    """
+    Yields the events of _sync_into as they arrive. The sync runs in its own
+    task, so a slow or disconnected reader never keeps the sync lock held.
+    """
+    queue: "asyncio.Queue[Optional[Tuple[str, dict]]]" = asyncio.Queue()
+    task = asyncio.create_task(_sync_into(queue, since))
+    _sync_tasks.add(task)
+    task.add_done_callback(_sync_tasks.discard)
+    while (item := await queue.get()) is not None:
+        yield item
+    await task
+
+async def stream_events(since: float) -> AsyncIterator[Tuple[str, dict]]:
+    """Buffered events since `since`, then new ones as they arrive if a sync is due"""
+    if not sync_due():
+        for sensor_id, buffer in list(buffers.items()):
+            for event in buffer.since(since):
+                yield sensor_id, event
+        return
+    # Replayed under the sync lock so events added concurrently are neither lost nor repeated
+    events = stream_sync(since)
+    try:
+        async for item in events:
+            yield item
+    finally:
+        await events.aclose()
+
+async def sync() -> bool:
+    """
+    Run stream_sync to completion.
+    Returns True if this call fetched from Home Assistant.
+    """
+    before = synced_to
+    events = stream_sync()
+    try:
+        async for _ in events:
+            pass
+    finally:
+        await events.aclose()
+    return synced_to != before
+
+def cache_age() -> Optional[int]:
+    """Seconds since the buffers were last synced"""
+    return int(time.time() - last_sync) if last_sync is not None else None
+
+def get_history(hours: int, sensor_type: str = "all") -> Optional[Dict[str, dict]]:
+    """Lightning history for the last `hours`, sliced from the buffers"""
+    sensor_ids = [
+        sensor_id for sensor_id in lightning_sensor_ids()
+        if sensor_type == "all" or sensor_type in sensor_id
+    ]
+    if not sensor_ids:
+        return None
+
+    start = time.time() - hours * 3600
+    history_data = {}
+    for sensor_id in sensor_ids:
+        buffer = buffers.get(sensor_id)
+        events = buffer.since(start) if buffer else []
+        history_data[sensor_id] = {
+            'sensor_id': sensor_id,
+            'total_events': len(events),
+            'history': events,
+            'last_event': events[-1] if events else None
+        }
+    return history_data
+
+def has_recent_activity(sensor_ids: List[str], seconds: int = 3600) -> bool:
+    """Whether any of the buffers has an event within the last `seconds`"""
+    cutoff = time.time() - seconds
+    return any(
+        buffers[sensor_id].times and buffers[sensor_id].times[-1] >= cutoff
+        for sensor_id in sensor_ids
+        if sensor_id in buffers
+    )
+
+def _sensor_of_type(sensor_type: str) -> Optional[LightningBuffer]:
+    """Buffer of the first configured lightning entity of a type"""
+    for sensor_id in lightning_sensor_ids():
+        if sensor_type in sensor_id:
+            return buffers.get(sensor_id)
+    return None
+
+def _distance_trend(buffer: Optional[LightningBuffer], now: float) -> dict:
+    """Approach/retreat speed and ETA from a linear fit over recent distances"""
+    result = {
+        'current_km': None,
+        'trend': 'unknown',
+        'speed_kmh': None,
+        'eta_minutes': None,
+        'samples': 0
+    }
+    if buffer is None:
+        return result
+
+    times, distances = buffer.arrays_since(now - TREND_WINDOW_MINUTES * 60)
+    result['samples'] = int(len(times))
+    if len(times):
+        result['current_km'] = float(distances[-1])
+    if len(times) < TREND_MIN_SAMPLES or np.ptp(times) == 0:
+        return result
+
+    # Least-squares slope in km per hour; negative means the storm is approaching
+    hours = (times - times[-1]) / 3600
+    slope = float(np.polyfit(hours, distances, 1)[0])
+    result['speed_kmh'] = round(abs(slope), 1)
+
+    if abs(slope) < STATIONARY_KMH:
+        result['trend'] = 'stationary'
+    elif slope < 0:
+        result['trend'] = 'approaching'
+        result['eta_minutes'] = round(float(distances[-1]) / -slope * 60, 1)
+    else:
+        result['trend'] = 'retreating'
+    return result
+
+def _azimuth_sectors(buffer: Optional[LightningBuffer], now: float) -> dict:
+    """Strike directions over the last hour, counted per 45° compass sector"""
+    counts = np.zeros(len(SECTORS), dtype=np.int64)
+    if buffer is not None:
+        _, azimuths = buffer.arrays_since(now - SECTOR_WINDOW_MINUTES * 60)
+        if len(azimuths):
+            sectors = (((azimuths + 22.5) % 360) // 45).astype(np.int64)
+            counts = np.bincount(sectors, minlength=len(SECTORS))
+
+    return {
+        'dominant_sector': SECTORS[int(np.argmax(counts))] if counts.any() else None,
+        'sector_counts': dict(zip(SECTORS, (int(c) for c in counts)))
+    }
+
+# Last computed analysis and the buffer versions it was computed from
+_analysis: Optional[dict] = None
+_analysis_key: Optional[tuple] = None
+_analysis_time = 0.0
+
+def get_analysis() -> dict:
+    """
+    Storm analytics over the buffers: strike rates, distance trend and
+    dominant direction. Running totals are maintained as samples arrive, and
+    the result is reused until a buffer changes or the windows slide by a minute.
+    """
+    global _analysis, _analysis_key, _analysis_time
+    now = time.time()
+    key = tuple(buffer.version for buffer in buffers.values())
+    if _analysis is not None and key == _analysis_key and now - _analysis_time < 60:
+        return _analysis
+
+    counter = _sensor_of_type('counter')
+    strike_rate = {
+        f"{minutes}m": counter.strikes_since(now - minutes * 60) if counter else 0
+        for minutes in RATE_WINDOWS
+    }
+    distance = _distance_trend(_sensor_of_type('distance'), now)
+
+    _analysis = {
+        'status': 'success',
+        'timestamp': datetime.now().isoformat(),
+        'storm_active': strike_rate['60m'] > 0,
+        'strike_rate': strike_rate,
+        'distance': distance,
+        'direction': _azimuth_sectors(_sensor_of_type('azimuth'), now)
+    }
+    _analysis_key = key
+    _analysis_time = now
+    return _analysis
@@ -0,0 +1,146 @@
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import httpx
+
+# Default latency buckets in seconds (same as the Prometheus client libraries)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = Tuple[str, ...]
+
+# Every metric, in registration order
+REGISTRY: List['Metric'] = []
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class Metric:
+    """Base class: a named metric with optional labels, registered on creation"""
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        REGISTRY.append(self)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.kind}',
+            *self.samples()
+        ]
+
+class Counter(Metric):
+    """Monotonically increasing count per label combination"""
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1.0) -> None:
+        self.values[label_values] = self.values.get(label_values, 0.0) + amount
+
+    def samples(self) -> List[str]:
+        return [
+            f'{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}'
+            for labels, value in self.values.items()
+        ]
+
+class Gauge(Metric):
+    """Current value, read from a callback when metrics are collected"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float]):
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def samples(self) -> List[str]:
+        return [f'{self.name} {_format_value(self.callback())}']
+
+class Histogram(Metric):
+    """Observations counted into fixed buckets, plus their sum and count"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Per label combination: [count per bucket (last is +Inf)], sum
+        self.values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = entry
+        # Buckets are upper bounds (le); the first bucket >= value gets the observation
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        names = self.label_names + ('le',)
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(names, labels + (_format_value(bound),))} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.label_names, labels)} {_format_value(total[0])}')
+            lines.append(f'{self.name}_count{_format_labels(self.label_names, labels)} {cumulative}')
+        return lines
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format"""
+    lines: List[str] = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+# Request latency by route template (not raw path, to bound the number of series)
+HTTP_DURATION = Histogram(
+    'http_request_duration_seconds', 'Request latency by route',
+    ('route', 'method', 'status')
+)
+
+# Cache lookups: hit, miss or stale (served while revalidating)
+CACHE_REQUESTS = Counter(
+    'cache_requests_total', 'Cache lookups by cache and result', ('cache', 'result')
+)
+
+# Home Assistant calls by endpoint type (state, states, history)
+UPSTREAM_DURATION = Histogram(
+    'upstream_request_duration_seconds', 'Home Assistant request latency by endpoint type and HTTP status',
+    ('endpoint', 'status')
+)
+UPSTREAM_ERRORS = Counter(
+    'upstream_errors_total', 'Home Assistant requests that failed without a response', ('endpoint', 'error')
+)
+
+# Requests rejected by the per-client rate limiter, by route cost class
+RATE_LIMITED = Counter(
+    'rate_limited_total', 'Requests rejected by the rate limiter', ('route_class',)
+)
+
+def observe_upstream(endpoint: str, start: float, response: Optional[httpx.Response] = None,
+                     error: Optional[Exception] = None) -> None:
+    """Record one Home Assistant call started at start (a perf_counter value)"""
+    if error is not None:
+        UPSTREAM_ERRORS.inc(endpoint, 'timeout' if isinstance(error, httpx.TimeoutException) else 'error')
+        return
+    UPSTREAM_DURATION.observe(time.perf_counter() - start, endpoint, str(response.status_code))
@@ -0,0 +1,105 @@
+import gzip
+import hashlib
+import json
+from typing import Any, Dict, Hashable, Optional
+
+from fastapi import Request, Response
+
+from app.telemetry import timed
+from app.metrics import CACHE_REQUESTS
+
+# Brotli needs the optional brotli package (pip install brotli)
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+# Bodies smaller than this are not worth compressing
+MIN_COMPRESS_BYTES = 512
+
+class Payload:
+    """A JSON response serialized once, with compressed variants and an ETag"""
+
+    def __init__(self, data: Any, version: Optional[Hashable] = None):
+        self.data = data
+        self.version = version
+        with timed('serialize'):
+            # Same encoding as FastAPI's JSONResponse
+            self.body = json.dumps(
+                data, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+            ).encode("utf-8")
+            self.etag = f'"{hashlib.blake2b(self.body, digest_size=16).hexdigest()}"'
+
+            self.encoded: Dict[str, bytes] = {}
+            if len(self.body) >= MIN_COMPRESS_BYTES:
+                self.encoded['gzip'] = gzip.compress(self.body, compresslevel=6, mtime=0)
+                if BROTLI_AVAILABLE:
+                    self.encoded['br'] = brotli.compress(self.body, quality=5)
+
+    def matches(self, if_none_match: Optional[str]) -> bool:
+        """Whether an If-None-Match header covers this payload"""
+        if not if_none_match:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        # Weak comparison, as required for If-None-Match
+        return '*' in tags or any(tag.removeprefix('W/') == self.etag for tag in tags)
+
+    def choose_encoding(self, accept_encoding: str) -> Optional[str]:
+        """Best available encoding the client accepts (br, then gzip), or None"""
+        accepted = set()
+        for item in accept_encoding.lower().split(','):
+            name, _, params = item.strip().partition(';')
+            if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                continue
+            accepted.add(name.strip())
+        for encoding in ('br', 'gzip'):
+            if encoding in self.encoded and encoding in accepted:
+                return encoding
+        return None
+
+# Payloads by cache name, rebuilt only when the data they were built from changes
+_payloads: Dict[str, Payload] = {}
+
+def get_payload(name: str, data: Any, version: Optional[Hashable] = None) -> Payload:
+    """
+    Cached payload for data. With version, it is reused while the version is
+    unchanged, without looking at data; otherwise while data is the same
+    object or an equal value.
+    """
+    payload = _payloads.get(name)
+    if version is not None:
+        current = payload is not None and payload.version == version
+    else:
+        current = payload is not None and (payload.data is data or payload.data == data)
+    if not current:
+        CACHE_REQUESTS.inc('payload', 'miss')
+        payload = Payload(data, version)
+        _payloads[name] = payload
+    else:
+        CACHE_REQUESTS.inc('payload', 'hit')
+    return payload
+
+def cache_control(max_age: float, stale_while_revalidate: float) -> str:
+    return f"public, max-age={max(0, int(max_age))}, stale-while-revalidate={max(0, int(stale_while_revalidate))}"
+
+def respond(request: Request, payload: Payload, max_age: float, stale_while_revalidate: float,
+            headers: Optional[Dict[str, str]] = None) -> Response:
+    """
+    Send a payload without re-serializing it: 304 if the client already has
+    it, otherwise the best pre-compressed variant.
+    """
+    response_headers = {
+        'ETag': payload.etag,
+        'Cache-Control': cache_control(max_age, stale_while_revalidate),
+        'Vary': 'Accept-Encoding',
+        **(headers or {})
+    }
+    if payload.matches(request.headers.get('if-none-match')):
+        return Response(status_code=304, headers=response_headers)
+
+    encoding = payload.choose_encoding(request.headers.get('accept-encoding', ''))
+    if encoding is None:
+        return Response(payload.body, media_type='application/json', headers=response_headers)
+    response_headers['Content-Encoding'] = encoding
+    return Response(payload.encoded[encoding], media_type='application/json', headers=response_headers)
@@ -0,0 +1,77 @@
+import math
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from app.config import settings
+
+# Token cost per route class; requests that may reach Home Assistant cost more
+ROUTE_COSTS = {
+    'cached': 1,
+    'analysis': 2,
+    'history': 5,
+}
+
+# Cost actually kept for a request that was served without calling Home Assistant
+SERVED_FROM_CACHE_COST = 1
+
+def route_class(path: str) -> str:
+    """Cost class of a request path"""
+    if path == '/api/history' or (path.endswith('/history') and path.startswith(('/api/sensors/', '/api/derived/'))):
+        return 'history'
+    if path == '/api/lightning-history':
+        return 'history'
+    if path == '/api/lightning-analysis':
+        return 'analysis'
+    return 'cached'
+
+class TokenBucketLimiter:
+    """
+    Token buckets per client key, refilled continuously at `rate` tokens per
+    second up to `burst`. At most `max_clients` buckets are kept; the least
+    recently used one is evicted first (it would have refilled anyway).
+    """
+
+    def __init__(self, rate: float, burst: float, max_clients: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        # key -> [tokens, last refill time]
+        self.buckets: "OrderedDict[str, List[float]]" = OrderedDict()
+
+    def _bucket(self, key: str, now: float) -> List[float]:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket
+
+    def acquire(self, key: str, cost: float, now: Optional[float] = None) -> Tuple[bool, float]:
+        """Take cost tokens; returns (allowed, seconds until enough tokens if not)"""
+        now = time.monotonic() if now is None else now
+        bucket = self._bucket(key, now)
+        if bucket[0] >= cost:
+            bucket[0] -= cost
+            return True, 0.0
+        return False, (cost - bucket[0]) / self.rate
+
+    def refund(self, key: str, tokens: float) -> None:
+        """Give back tokens for a request that turned out to be cheap"""
+        bucket = self.buckets.get(key)
+        if bucket is not None:
+            bucket[0] = min(self.burst, bucket[0] + tokens)
+
+    @staticmethod
+    def retry_after(seconds: float) -> str:
+        return str(max(1, math.ceil(seconds)))
+
+limiter = TokenBucketLimiter(
+    rate=settings.RATE_LIMIT_PER_MINUTE / 60,
+    burst=settings.RATE_LIMIT_BURST,
+    max_clients=settings.RATE_LIMIT_MAX_CLIENTS
+)
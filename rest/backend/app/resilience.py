@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Awaitable, Callable, Optional, TypeVar
+
+from app import metrics
+from app.config import settings
+
+# Get the FastAPI logger
+logger = logging.getLogger("main")
+
+T = TypeVar('T')
+
+class CircuitOpenError(Exception):
+    """Home Assistant is considered down; the call was not attempted"""
+
+class DeadlineExceeded(Exception):
+    """The request's time budget for upstream calls is used up"""
+
+class UpstreamUnavailable(Exception):
+    """Home Assistant returned nothing usable"""
+
+class CircuitBreaker:
+    """
+    Fails fast after `failure_threshold` consecutive failures. While open, one
+    probe call is let through every `reset_timeout` seconds; a success closes
+    the circuit again.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        """Whether a call may be attempted now"""
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at >= self.reset_timeout:
+            # Let this call through as a probe; the next one waits another period
+            self.opened_at = now
+            return True
+        return False
+
+    def check(self) -> None:
+        """Raise CircuitOpenError unless a call may be attempted"""
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} circuit is open")
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            logger.info(f"Circuit {self.name}: closed, upstream recovered")
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.opened_at is None and self.failures >= self.failure_threshold:
+            logger.warning(f"Circuit {self.name}: open after {self.failures} consecutive failures")
+            self.opened_at = time.monotonic()
+
+# Shared breaker for every Home Assistant REST call
+ha_breaker = CircuitBreaker('home_assistant', settings.HA_BREAKER_FAILURES, settings.HA_BREAKER_RESET)
+metrics.Gauge('upstream_circuit_open', 'Whether Home Assistant calls are failing fast (1) or not (0)',
+              lambda: int(ha_breaker.is_open))
+
+# Absolute time (time.monotonic) by which the current request's upstream calls must finish
+_deadline: ContextVar[Optional[float]] = ContextVar('deadline', default=None)
+
+def start_deadline(seconds: float) -> None:
+    """Give the current request a total budget for upstream calls"""
+    _deadline.set(time.monotonic() + seconds)
+
+def timeout(default: float) -> float:
+    """
+    Timeout for the next upstream call: the per-call default, capped by what
+    is left of the request's budget. Raises DeadlineExceeded when nothing is left.
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return default
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded("Upstream time budget exhausted")
+    return min(default, remaining)
+
+@asynccontextmanager
+async def within_deadline() -> AsyncIterator[None]:
+    """
+    Cancel the enclosed upstream calls, body reads included, when the
+    request's budget runs out; raises DeadlineExceeded. httpx timeouts
+    apply per phase only, so a slowly trickling body would not stop.
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        yield
+        return
+    loop = asyncio.get_running_loop()
+    when = loop.time() + deadline - time.monotonic()
+    if hasattr(asyncio, 'timeout_at'):
+        timer = asyncio.timeout_at(when)
+        try:
+            async with timer:
+                yield
+        except TimeoutError:
+            if timer.expired():
+                raise DeadlineExceeded("Upstream time budget exhausted") from None
+            raise
+        return
+
+    # Python < 3.11: the same with call_at and cancel(), which cannot be undone (no uncancel())
+    task = asyncio.current_task()
+    expired = False
+    delivered = False
+
+    def expire() -> None:
+        nonlocal expired
+        expired = True
+        task.cancel()
+
+    handle = loop.call_at(when, expire)
+    try:
+        yield
+    except asyncio.CancelledError:
+        if expired:
+            delivered = True
+            raise DeadlineExceeded("Upstream time budget exhausted") from None
+        raise
+    finally:
+        handle.cancel()
+        if expired and not delivered:
+            # The timer fired after the block's last await; the block finished, so
+            # take the cancellation we requested here rather than in the caller
+            try:
+                await asyncio.sleep(0)
+            except asyncio.CancelledError:
+                pass
+
+async def hedged(call: Callable[[], Awaitable[T]], delay: float) -> T:
+    """
+    Run an idempotent call; if it has not finished after `delay` seconds,
+    start a second identical call and return whichever succeeds first.
+    """
+    if delay <= 0:
+        return await call()
+
+    tasks = [asyncio.ensure_future(call())]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            tasks.append(asyncio.ensure_future(call()))
+
+        pending = set(tasks)
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
@@ -0,0 +1,215 @@
+import logging
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+from app.config import settings
+
+# Get the FastAPI logger
+logger = logging.getLogger("main")
+
+INVALID_STATES = frozenset(['null', 'None', 'unknown', 'unavailable'])
+
+# Entity ID substring -> sensor type, checked in order
+SENSOR_TYPES = [
+    ('temperature', 'temperature'),
+    ('humidity', 'humidity'),
+    ('pressure', 'pressure'),
+    ('wind', 'wind'),
+    ('uv', 'uv'),
+    ('solar', 'solar'),
+    ('rain', 'rain'),
+    ('lightning', 'lightning'),
+]
+
+# Valid (min, max) state per sensor type; None means unbounded
+Bounds = Tuple[Optional[float], Optional[float]]
+RANGES: Dict[str, Bounds] = {
+    'temperature': (-50, 60),
+    'humidity': (0, 100),
+    'pressure': (900, 1100),
+    'wind': (0, None),
+    'uv': (0, 20),
+    'solar': (0, None),
+    'rain': (0, None),
+}
+WIND_DIRECTION_RANGE: Bounds = (0, 360)
+LIGHTNING_RANGES: Dict[str, Bounds] = {
+    'counter': (0, None),
+    'azimuth': (0, 360),
+    'distance': (0, None),
+}
+
+# Inputs of one refresh shared between entities (see derived.read_inputs), e.g. the temperature for relative pressure
+Context = Dict[str, float]
+Transform = Callable[[dict, Context], None]
+
+def classify(entity_id: str) -> str:
+    """Sensor type of an entity, from the first matching substring"""
+    for substring, sensor_type in SENSOR_TYPES:
+        if substring in entity_id:
+            return sensor_type
+    return 'unknown'
+
+def lightning_kind(entity_id: str) -> Optional[str]:
+    """'counter', 'azimuth' or 'distance' for lightning entities"""
+    return next((kind for kind in LIGHTNING_RANGES if kind in entity_id), None)
+
+def range_validator(bounds: Optional[Bounds], allow_invalid: bool = False) -> Callable[[str], bool]:
+    """Validator accepting numeric states within bounds (any number if bounds is None)"""
+    low, high = bounds or (None, None)
+
+    def validate(state: str) -> bool:
+        if allow_invalid and state in INVALID_STATES:
+            return True
+        try:
+            value = float(state)
+        except ValueError:
+            return False
+        return (low is None or value >= low) and (high is None or value <= high)
+
+    return validate
+
+def calculate_relative_pressure(absolute_pressure: float, altitude: float, temperature: float) -> float:
+    """
+    Calculate mean sea level pressure using the International Standard Atmosphere formula:
+    P0 = P1 (1 - (0.0065h/ (T + 0.0065h + 273.15)))-5.257
+
+    Parameters:
+    - absolute_pressure: Station pressure (P1) in hPa
+    - altitude: Station elevation (h) in meters
+    - temperature: Temperature (T) in Celsius
+
+    Returns:
+    - Mean sea level pressure (P0) in hPa
+    """
+    try:
+        # P0 = P1 (1 - (0.0065h/ (T + 0.0065h + 273.15)))-5.257
+        P1 = float(absolute_pressure)
+        h = float(altitude)
+        T = float(temperature)
+
+        denominator = T + (0.0065 * h) + 273.15
+        fraction = (0.0065 * h) / denominator
+
+        P0 = P1 * pow(1 - fraction, -5.257)
+
+        return round(P0, 1)
+    except Exception as e:
+        logger.error(f"Error calculating sea level pressure: {e}")
+        return absolute_pressure
+
+def relative_pressure(sensor_data: dict, context: Context) -> None:
+    """Replace absolute pressure with sea level pressure, keeping both in attributes"""
+    # Outdoor temperature of this update, whatever the order of SENSOR_IDS
+    temp = context.get('temperature', 15)  # default temp if not found
+    try:
+        abs_pressure = float(sensor_data['state'])
+        rel_pressure = calculate_relative_pressure(
+            abs_pressure,
+            float(settings.STATION_ALTITUDE),
+            temp
+        )
+
+        # Add both pressures to attributes
+        sensor_data['attributes']['absolute_pressure'] = abs_pressure
+        sensor_data['attributes']['relative_pressure'] = rel_pressure
+        # Update the main state to show relative pressure
+        sensor_data['state'] = str(rel_pressure)
+    except (ValueError, TypeError) as e:
+        logger.error(f"Error calculating relative pressure: {e}")
+
+def lightning_formatter(unit_format: Callable[[str], str], no_strikes: bool) -> Transform:
+    """Set attributes.formatted_value; invalid states become 'No strikes' if no_strikes"""
+    def transform(sensor_data: dict, context: Context) -> None:
+        state = sensor_data['state']
+        if no_strikes and state in INVALID_STATES:
+            sensor_data['state'] = 'No strikes'
+            sensor_data['attributes']['formatted_value'] = 'No strikes'
+            return
+        try:
+            sensor_data['attributes']['formatted_value'] = unit_format(state)
+        except ValueError:
+            sensor_data['attributes']['formatted_value'] = state
+
+    return transform
+
+LIGHTNING_FORMATTERS: Dict[str, Transform] = {
+    # Azimuth and distance: show degrees/km or "No strikes"
+    'azimuth': lightning_formatter(lambda state: f"{float(state)}°", no_strikes=True),
+    'distance': lightning_formatter(lambda state: f"{float(state)} km", no_strikes=True),
+    # Counter is always a number, format nicely
+    'counter': lightning_formatter(lambda state: f"{int(float(state))} strikes", no_strikes=False),
+}
+
+class SensorSpec:
+    """How one entity is classified, validated and formatted, resolved once per entity"""
+
+    def __init__(self, entity_id: str, sensor_type: str, validate: Callable[[str], bool],
+                 transform: Optional[Transform] = None, bounds: Optional[Bounds] = None):
+        self.entity_id = entity_id
+        self.sensor_type = sensor_type
+        self.validate = validate
+        self.transform = transform
+        self.bounds = bounds
+
+    def valid_mask(self, values: np.ndarray) -> np.ndarray:
+        """validate() for a whole array of numeric values at once"""
+        mask = np.isfinite(values)
+        low, high = self.bounds or (None, None)
+        if low is not None:
+            mask &= values >= low
+        if high is not None:
+            mask &= values <= high
+        return mask
+
+    def in_range(self, value: float) -> bool:
+        """valid_mask() for a single finite value"""
+        low, high = self.bounds or (None, None)
+        return (low is None or value >= low) and (high is None or value <= high)
+
+    def process(self, sensor_data: dict, context: Context) -> bool:
+        """Validate the state and apply the transform in place; False if the state is invalid"""
+        if not self.validate(sensor_data['state']):
+            return False
+        if self.transform is not None:
+            self.transform(sensor_data, context)
+        return True
+
+def compile_spec(entity_id: str) -> SensorSpec:
+    """Resolve type, validator and transform for an entity"""
+    sensor_type = classify(entity_id)
+
+    if sensor_type == 'lightning':
+        # Lightning sensors can be null or unknown between storms
+        kind = lightning_kind(entity_id)
+        if kind is None:
+            return SensorSpec(entity_id, sensor_type, lambda state: True)
+        validate = range_validator(LIGHTNING_RANGES[kind], allow_invalid=True)
+        return SensorSpec(entity_id, sensor_type, validate, LIGHTNING_FORMATTERS[kind], LIGHTNING_RANGES[kind])
+
+    bounds = RANGES.get(sensor_type)
+    if sensor_type == 'wind' and 'direction' in entity_id:
+        bounds = WIND_DIRECTION_RANGE
+
+    transform = None
+    if 'absolute_pressure' in entity_id:
+        transform = relative_pressure
+    return SensorSpec(entity_id, sensor_type, range_validator(bounds), transform, bounds)
+
+# Entity ID -> spec, compiled from SENSOR_IDS at startup
+registry: Dict[str, SensorSpec] = {}
+
+def compile_registry(entity_ids: Iterable[str]) -> None:
+    """Compile specs for the configured entities"""
+    registry.clear()
+    for entity_id in entity_ids:
+        registry[entity_id] = compile_spec(entity_id)
+    logger.info(f"Sensor registry: compiled {len(registry)} entities")
+
+def get_spec(entity_id: str) -> SensorSpec:
+    """Spec for an entity, compiled on first use if it was not configured at startup"""
+    spec = registry.get(entity_id)
+    if spec is None:
+        spec = registry[entity_id] = compile_spec(entity_id)
+    return spec
@@ -0,0 +1,66 @@
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+import numpy as np
+
+from app import history_store
+from app.sensors import get_spec
+
+# Percentiles reported with history statistics
+PERCENTILES = (5, 25, 50, 75, 95)
+# Stored samples searched for a valid value before the start of a range
+SEED_LOOKBACK_ROWS = 16
+
+async def load(entity_id: str, start_ts: float, end_ts: float, with_states: bool = True) -> history_store.Columns:
+    """Stored samples of an entity as columns, keeping only values within the sensor's valid range"""
+    times, values, states = await history_store.query_columns(entity_id, start_ts, end_ts, with_states)
+    mask = get_spec(entity_id).valid_mask(values)
+    if mask.all():
+        return times, values, states
+    return times[mask], values[mask], (states[mask] if with_states else states)
+
+async def iter_chunks(entity_id: str, start_ts: float, end_ts: float) -> AsyncIterator[history_store.Columns]:
+    """load() in chunks of history_store.STREAM_CHUNK_ROWS samples"""
+    spec = get_spec(entity_id)
+    async for times, values, states in history_store.iter_columns(entity_id, start_ts, end_ts):
+        mask = spec.valid_mask(values)
+        if mask.all():
+            yield times, values, states
+        elif mask.any():
+            yield times[mask], values[mask], states[mask]
+
+async def last_before(entity_id: str, ts: float) -> Optional[Tuple[float, float]]:
+    """The last valid stored sample before ts as (time, value), i.e. the value in effect when a range starts"""
+    times, values, _ = await history_store.query_columns_before(entity_id, ts, SEED_LOOKBACK_ROWS)
+    valid = np.flatnonzero(get_spec(entity_id).valid_mask(values))
+    if not len(valid):
+        return None
+    return float(times[valid[0]]), float(values[valid[0]])
+
+def carry_forward(times: np.ndarray, values: np.ndarray, axis: np.ndarray,
+                  seed: Optional[Tuple[float, float]] = None) -> np.ndarray:
+    """
+    values at each axis point as the last sample at or before it (NaN before
+    the first). seed, from last_before(), is the value in effect before times[0].
+    """
+    if seed is not None:
+        times = np.concatenate(([seed[0]], times))
+        values = np.concatenate(([seed[1]], values))
+    if not len(times):
+        return np.full(len(axis), np.nan)
+    idx = np.searchsorted(times, axis, side='right') - 1
+    return np.where(idx >= 0, values[np.maximum(idx, 0)], np.nan)
+
+def summarize(values: np.ndarray) -> Dict[str, Optional[float]]:
+    """min, max, mean, percentiles and current (last) value of a series"""
+    if len(values) == 0:
+        return {'min': None, 'max': None, 'mean': None, 'percentiles': None, 'current': None}
+    return {
+        'min': float(values.min()),
+        'max': float(values.max()),
+        'mean': float(values.mean()),
+        'percentiles': dict(zip(
+            (f'p{p}' for p in PERCENTILES),
+            np.percentile(values, PERCENTILES).tolist()
+        )),
+        'current': float(values[-1])
+    }
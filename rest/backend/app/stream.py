@@ -0,0 +1,89 @@
+import asyncio
+import json
+from collections import deque
+from typing import Dict, List, Optional, Set
+
+from app.config import settings
+from app import metrics
+
+def format_event(event: str, data: dict) -> bytes:
+    """Encode a Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode()
+
+class Subscriber:
+    """Bounded per-client buffer of already-encoded messages"""
+
+    def __init__(self, max_messages: int):
+        self.messages: deque = deque()
+        self.max_messages = max_messages
+        # Start with a full snapshot so the client has complete state
+        self.needs_snapshot = True
+        self.ready = asyncio.Event()
+        self.ready.set()
+
+    def push(self, message: bytes) -> None:
+        """Queue a message; a client that falls behind is coalesced to one snapshot"""
+        if self.needs_snapshot:
+            # The pending snapshot already includes this change
+            return
+        if len(self.messages) >= self.max_messages:
+            self.messages.clear()
+            self.needs_snapshot = True
+        else:
+            self.messages.append(message)
+        self.ready.set()
+
+class Broadcaster:
+    """Fans each published update out to all subscribed clients"""
+
+    def __init__(self):
+        self.subscribers: Set[Subscriber] = set()
+        self.snapshot: Dict[str, dict] = {}
+        self._snapshot_messages: Optional[List[bytes]] = None
+
+    def subscribe(self) -> Subscriber:
+        subscriber = Subscriber(settings.STREAM_CLIENT_BUFFER)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        self.subscribers.discard(subscriber)
+
+    def publish(self, event: str, changes: dict) -> None:
+        """Merge changes into the snapshot and send them, encoded once, to every client"""
+        if not changes:
+            return
+        self.snapshot.setdefault(event, {}).update(changes)
+        self._snapshot_messages = None
+        message = format_event(event, changes)
+        for subscriber in self.subscribers:
+            subscriber.push(message)
+
+    def snapshot_messages(self) -> List[bytes]:
+        """Full current state as one message per event type, encoded once per change"""
+        if self._snapshot_messages is None:
+            self._snapshot_messages = [
+                format_event(event, data) for event, data in self.snapshot.items()
+            ]
+        return self._snapshot_messages
+
+    async def next_messages(self, subscriber: Subscriber, timeout: float) -> List[bytes]:
+        """Wait for messages for a subscriber; an empty list means the wait timed out"""
+        try:
+            await asyncio.wait_for(subscriber.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        subscriber.ready.clear()
+
+        if subscriber.needs_snapshot:
+            subscriber.needs_snapshot = False
+            subscriber.messages.clear()
+            return list(self.snapshot_messages())
+
+        messages = list(subscriber.messages)
+        subscriber.messages.clear()
+        return messages
+
+# Shared broadcaster for /api/stream
+broadcaster = Broadcaster()
+metrics.Gauge('stream_clients', 'Connected /api/stream clients', lambda: len(broadcaster.subscribers))
@@ -0,0 +1,123 @@
+import json
+import logging
+import queue
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+from app.config import settings
+
+# Server-Timing metrics of the current request, in milliseconds
+_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar('timings', default=None)
+
+# Order and descriptions of the Server-Timing metrics
+TIMING_METRICS = {
+    'cache': 'Cache lookup',
+    'ha': 'Upstream Home Assistant',
+    'validate': 'Validation',
+    'serialize': 'Serialization',
+}
+
+# Loggers uvicorn gives their own stream handlers; they are routed through the queue instead
+UVICORN_LOGGERS = ('uvicorn', 'uvicorn.error', 'uvicorn.access')
+
+# Standard LogRecord attributes; anything else passed via extra= is logged as a field
+# (except uvicorn's color_message, a copy of the message with ANSI colours)
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'taskName', 'color_message'}
+
+_listener: Optional[QueueListener] = None
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, including fields passed via extra="""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def setup_logging() -> None:
+    """
+    Route all logging through a queue; a listener thread formats and writes
+    the records, so request handlers never block on log output.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    handler = logging.StreamHandler()
+    if settings.LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(log_queue)]
+    root.setLevel(settings.LOG_LEVEL)
+    # uvicorn's handlers write to the stream directly from the event loop
+    for name in UVICORN_LOGGERS:
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers = []
+        uvicorn_logger.propagate = True
+    # One line per upstream call is noise at INFO; request logs carry the timings
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    _listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+
+def stop_logging() -> None:
+    """Flush queued records and stop the listener thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def should_log_success() -> bool:
+    """Sample successful request logs at LOG_SAMPLE_RATE"""
+    rate = settings.LOG_SAMPLE_RATE
+    return rate >= 1 or random.random() < rate
+
+def start_timings() -> Dict[str, float]:
+    """Start collecting Server-Timing metrics for the current request"""
+    timings: Dict[str, float] = {}
+    _timings.set(timings)
+    return timings
+
+def current_timings() -> Optional[Dict[str, float]]:
+    """Server-Timing metrics collected so far for the current request"""
+    return _timings.get()
+
+@contextmanager
+def timed(metric: str):
+    """Add the time spent in the block to a Server-Timing metric of the current request"""
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[metric] = timings.get(metric, 0.0) + (time.perf_counter() - start) * 1000
+
+def server_timing_header(timings: Dict[str, float], total_ms: float) -> str:
+    """Format collected metrics and the total as a Server-Timing header value"""
+    parts = [
+        f'{metric};desc="{desc}";dur={timings[metric]:.1f}'
+        for metric, desc in TIMING_METRICS.items()
+        if metric in timings
+    ]
+    parts.append(f'total;dur={total_ms:.1f}')
+    return ', '.join(parts)
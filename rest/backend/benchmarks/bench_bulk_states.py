@@ -0,0 +1,74 @@
+"""
+Per-entity vs bulk /api/states retrieval for 10, 50 and 200 sensors.
+
+Home Assistant is simulated with httpx.MockTransport: every request waits
+LATENCY seconds and /api/states returns the configured sensors among
+OTHER_ENTITIES unrelated ones. Run from rest/backend:
+
+    python -m benchmarks.bench_bulk_states
+"""
+import asyncio
+import json
+import os
+import time
+
+os.environ.setdefault("HASS_URL", "http://homeassistant.local:8123")
+os.environ.setdefault("HASS_TOKEN", "benchmark")
+os.environ.setdefault("SENSOR_IDS", "sensor.benchmark")
+
+import httpx
+
+from app import ha_client
+from app.config import settings
+
+SENSOR_COUNTS = (10, 50, 200)
+OTHER_ENTITIES = 1000  # A typical instance has far more entities than the proxy exposes
+LATENCY = 0.005  # Seconds per Home Assistant request
+ROUNDS = 5
+
+def state(entity_id: str) -> dict:
+    return {
+        "entity_id": entity_id,
+        "state": "21.5",
+        "attributes": {"unit_of_measurement": "°C", "friendly_name": entity_id},
+        "last_changed": "2026-01-01T00:00:00+00:00",
+        "last_updated": "2026-01-01T00:00:00+00:00",
+    }
+
+def make_transport(sensor_ids) -> httpx.MockTransport:
+    all_states = [state(entity_id) for entity_id in sensor_ids]
+    all_states += [state(f"sensor.other_{i}") for i in range(OTHER_ENTITIES)]
+    bulk_body = json.dumps(all_states).encode()
+    by_id = {s["entity_id"]: json.dumps(s).encode() for s in all_states}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(LATENCY)
+        if request.url.path == "/api/states":
+            return httpx.Response(200, content=bulk_body)
+        return httpx.Response(200, content=by_id[request.url.path.rsplit("/", 1)[-1]])
+
+    return httpx.MockTransport(handler)
+
+async def best_of(fetch, sensor_ids) -> float:
+    best = float("inf")
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        states = await fetch(sensor_ids)
+        best = min(best, time.perf_counter() - start)
+        assert states is not None and len(states) == len(sensor_ids)
+    return best
+
+async def main() -> None:
+    print(f"{OTHER_ENTITIES} other entities, {LATENCY * 1000:.0f} ms per request, "
+          f"HA_CONCURRENCY={settings.HA_CONCURRENCY}, best of {ROUNDS}")
+    print(f"{'sensors':>8} {'per-entity':>12} {'bulk':>10}")
+    for count in SENSOR_COUNTS:
+        sensor_ids = [f"sensor.station_{i}" for i in range(count)]
+        await ha_client.start_client(transport=make_transport(sensor_ids))
+        individual = await best_of(ha_client.fetch_states_individually, sensor_ids)
+        bulk = await best_of(ha_client.fetch_states_bulk, sensor_ids)
+        print(f"{count:>8} {individual * 1000:>10.1f}ms {bulk * 1000:>8.1f}ms")
+        await ha_client.close_client()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,141 @@
+"""
+Columnar history pipeline vs the previous per-item processing, on a week
+of 1-minute samples for 20 entities. Samples are written to a temporary
+SQLite store; the per-item loop runs over the same data as Home Assistant
+history items. Run from rest/backend:
+
+    python -m benchmarks.bench_history_columns
+"""
+import asyncio
+import os
+import random
+import tempfile
+import time
+from pathlib import Path
+
+os.environ.setdefault("HASS_URL", "http://homeassistant.local:8123")
+os.environ.setdefault("HASS_TOKEN", "benchmark")
+os.environ.setdefault("SENSOR_IDS", "sensor.benchmark")
+
+import numpy as np
+
+from app import history_store, series
+
+ENTITIES = [f"sensor.station_outdoor_temperature_{i}" for i in range(20)]
+DAYS = 7
+ROUNDS = 3
+
+def previous_loop(history: list) -> dict:
+    """Statistics as get_sensor_history computed them per item, plus mean and percentiles"""
+    values = []
+    for item in history:
+        try:
+            if item['state'].replace('-', '').replace('.', '').isdigit():
+                values.append(float(item['state']))
+        except (ValueError, AttributeError):
+            continue
+    ordered = sorted(values)
+    return {
+        'min': min(values),
+        'max': max(values),
+        'mean': sum(values) / len(values),
+        'percentiles': [ordered[int(p / 100 * (len(ordered) - 1))] for p in series.PERCENTILES],
+        'current': values[-1]
+    }
+
+def columnar_stats(sensor_id: str, values: np.ndarray) -> dict:
+    """The same statistics from a value column: range mask, then vectorized reductions"""
+    return series.summarize(values[series.get_spec(sensor_id).valid_mask(values)])
+
+def previous_rows(sensor_id: str, start: float, end: float) -> dict:
+    """History response from the store as built before: row tuples, per-row timestamps"""
+    with history_store._db_lock:
+        rows = history_store.get_connection().execute(
+            "SELECT ts, state, value FROM samples WHERE entity_id = ? AND ts >= ? AND ts <= ? "
+            "AND value IS NOT NULL ORDER BY ts",
+            (sensor_id, start, end)
+        ).fetchall()
+    values = [row[2] for row in rows]
+    history = []
+    for ts, state, _ in rows:
+        timestamp = history_store.ts_to_iso(ts)
+        history.append({'entity_id': sensor_id, 'state': state, 'last_changed': timestamp, 'last_updated': timestamp})
+    return {'min': min(values), 'max': max(values), 'current': values[-1], 'history': history}
+
+async def columnar(sensor_id: str, start: float, end: float, with_history: bool = True) -> dict:
+    """get_sensor_history's columnar path: masked columns, vectorized stats and timestamps"""
+    times, values, states = await series.load(sensor_id, start, end, with_states=with_history)
+    result = series.summarize(values)
+    if with_history:
+        result['history'] = [
+            {'entity_id': sensor_id, 'state': state, 'last_changed': timestamp, 'last_updated': timestamp}
+            for state, timestamp in zip(states.tolist(), history_store.ts_to_iso_array(times))
+        ]
+    return result
+
+def generate(start: float):
+    """Samples per entity, with about 1% of states unavailable"""
+    random.seed(1)
+    data = {}
+    for entity_id in ENTITIES:
+        samples = []
+        for k in range(DAYS * 1440):
+            ts = start + k * 60 + random.random()
+            state = f"{20 + 5 * np.sin(k / 200) + random.random():.2f}" if random.random() > 0.01 else "unavailable"
+            samples.append((ts, state, history_store.parse_value(state)))
+        data[entity_id] = samples
+    return data
+
+async def best_of(name: str, run) -> float:
+    best = float('inf')
+    for _ in range(ROUNDS):
+        t = time.perf_counter()
+        for entity_id in ENTITIES:
+            await run(entity_id)
+        best = min(best, time.perf_counter() - t)
+    print(f"{name:50s} {best * 1000:8.1f} ms")
+    return best
+
+async def main() -> None:
+    end = time.time()
+    start = end - DAYS * 86400
+    data = generate(start)
+    ha_items = {
+        entity_id: [
+            {'entity_id': entity_id, 'state': state, 'last_changed': history_store.ts_to_iso(ts),
+             'last_updated': history_store.ts_to_iso(ts), 'attributes': {}}
+            for ts, state, _ in samples
+        ]
+        for entity_id, samples in data.items()
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        history_store.HISTORY_DB = Path(directory) / 'history.db'
+        for entity_id, samples in data.items():
+            history_store._store_samples(entity_id, samples, start, end)
+
+        print(f"{len(ENTITIES)} entities x {DAYS * 1440} samples, best of {ROUNDS}")
+        columns = {entity_id: history_store._query_columns(entity_id, start, end, False)[1] for entity_id in ENTITIES}
+
+        async def loop_stats(entity_id):
+            return previous_loop(ha_items[entity_id])
+
+        async def vector_stats(entity_id):
+            return columnar_stats(entity_id, columns[entity_id])
+
+        async def rows(entity_id):
+            return previous_rows(entity_id, start, end)
+
+        print("Statistics over values in memory")
+        before = await best_of("  per-item loop (isdigit, Python min/max/mean/sort)", loop_stats)
+        after = await best_of("  columnar (range mask, NumPy reductions)", vector_stats)
+        print(f"  speedup {before / after:.0f}x")
+        print("History response from the store")
+        before = await best_of("  row tuples, per-row timestamps", rows)
+        after = await best_of("  columnar, incl. percentiles", lambda e: columnar(e, start, end))
+        print(f"  speedup {before / after:.1f}x")
+        await best_of("  columnar, statistics only", lambda e: columnar(e, start, end, False))
+        history_store.close_store()
+
+if __name__ == "__main__":
+    asyncio.run(main())
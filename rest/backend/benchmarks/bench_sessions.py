@@ -0,0 +1,63 @@
+"""
+Per-visit cost of session tracking and per-request cost of /api/stats at 1k,
+10k and 100k active sessions, against the previous full scan of active
+sessions on every visit. Run from rest/backend:
+
+    python -m benchmarks.bench_sessions
+"""
+import asyncio
+import os
+import time
+
+os.environ.setdefault("HASS_URL", "http://homeassistant.local:8123")
+os.environ.setdefault("HASS_TOKEN", "benchmark")
+os.environ.setdefault("SENSOR_IDS", "sensor.benchmark")
+
+from app import analytics
+
+ACTIVE_SESSIONS = (1_000, 10_000, 100_000)
+REQUESTS = 10_000
+SCAN_REQUESTS = 100  # The previous scan is too slow for more at 100k sessions
+
+def scan_is_new_session(active_sessions: dict, client_ip: str, now: float) -> bool:
+    """The previous implementation: expire by scanning every session"""
+    expired = [ip for ip, timestamp in active_sessions.items() if now - timestamp > analytics.SESSION_DURATION]
+    for ip in expired:
+        del active_sessions[ip]
+    is_new = client_ip not in active_sessions
+    active_sessions[client_ip] = now
+    return is_new
+
+async def per_request_us(n: int) -> tuple:
+    start = time.time()
+    analytics.sessions = analytics.SessionTracker(analytics.SESSION_DURATION)
+    analytics.apply_visits([(f"10.{i >> 16}.{(i >> 8) & 255}.{i & 255}", start + i * 1e-6) for i in range(n)])
+
+    # New visits as the worker applies them, then /api/stats reads between batches
+    visits = [(f"new-{i}", start + 1) for i in range(REQUESTS)]
+    t = time.perf_counter()
+    analytics.apply_visits(visits)
+    visit = (time.perf_counter() - t) / REQUESTS * 1e6
+    assert analytics.sessions.active(start + 1) == n + REQUESTS
+
+    await analytics.compute_stats()
+    t = time.perf_counter()
+    for _ in range(REQUESTS):
+        await analytics.compute_stats()
+    stats = (time.perf_counter() - t) / REQUESTS * 1e6
+
+    active = {f"10.{i >> 16}.{(i >> 8) & 255}.{i & 255}": start for i in range(n)}
+    t = time.perf_counter()
+    for i in range(SCAN_REQUESTS):
+        scan_is_new_session(active, f"new-{i}", start + 1)
+    scanned = (time.perf_counter() - t) / SCAN_REQUESTS * 1e6
+    return visit, stats, scanned
+
+async def main() -> None:
+    print(f"{'sessions':>9} {'visit':>10} {'stats':>10} {'previous scan':>15}")
+    for n in ACTIVE_SESSIONS:
+        visit, stats, scanned = await per_request_us(n)
+        print(f"{n:>9} {visit:>7.1f} us {stats:>7.1f} us {scanned:>12.1f} us")
+
+if __name__ == "__main__":
+    asyncio.run(main())
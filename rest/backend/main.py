@@ -1,22 +1,43 @@
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.errors import RateLimitExceeded
-from slowapi.util import get_remote_address
-from app.api import router
+from fastapi.responses import JSONResponse, Response
+from app.api import router, run_stream_publisher
 from app.config import settings
+from app.ha_client import start_client, close_client
+from app.analytics import get_client_ip
+from app.ratelimit import ROUTE_COSTS, SERVED_FROM_CACHE_COST, limiter, route_class
+from app import analytics, derived, geoip, ha_websocket, history_store, metrics, resilience, sensors, telemetry
+from contextlib import asynccontextmanager
+import asyncio
 import time
 import os
 import logging
 from pathlib import Path
+from typing import AsyncIterator
 
 # Create data directory if it doesn't exist
 data_dir = Path(__file__).parent / 'data'
 data_dir.mkdir(exist_ok=True)
 
-# Create limiter instance
-limiter = Limiter(key_func=get_remote_address)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    sensors.compile_registry(settings.sensor_list)
+    derived.compile_roles(settings.sensor_list)
+    # Shared Home Assistant client for the whole application lifetime
+    await start_client()
+    await history_store.init_store()
+    await geoip.load()
+    if settings.HA_WEBSOCKET:
+        ha_websocket.start()
+    await analytics.start()
+    stream_publisher = asyncio.create_task(run_stream_publisher())
+    yield
+    stream_publisher.cancel()
+    await ha_websocket.stop()
+    await analytics.stop()
+    await close_client()
+    history_store.close_store()
+    telemetry.stop_logging()
 
 app = FastAPI(
     title="Home Assistant Sensor Proxy",
@@ -24,13 +45,10 @@ app = FastAPI(
     version="1.0.0",
     docs_url="/api/docs",  # Always enable docs for now
     redoc_url="/api/redoc",
-    openapi_url="/api/openapi.json"  # Important for Swagger to work
+    openapi_url="/api/openapi.json",  # Important for Swagger to work
+    lifespan=lifespan
 )
 
-# Rate limiting
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
-
 # Basic CORS - Nginx will handle the rest
 app.add_middleware(
     CORSMiddleware,
@@ -41,31 +59,82 @@ app.add_middleware(
 )
 
 # Add this after creating the FastAPI app
-logging.basicConfig(level=logging.INFO)
+telemetry.setup_logging()
 logger = logging.getLogger(__name__)
 
-# Request logging middleware
+# Per-client rate limit, keyed on the visitor IP forwarded by Cloudflare/Nginx.
+# Registered first so it runs inside log_requests and sees the request timings.
 @app.middleware("http")
-async def log_requests(request: Request, call_next):
-    # Get real IP from Nginx headers
-    forwarded_for = request.headers.get("X-Forwarded-For")
-    real_ip = forwarded_for.split(",")[0] if forwarded_for else request.client.host
+async def rate_limit(request: Request, call_next):
+    path = request.url.path
+    if not path.startswith("/api/"):
+        return await call_next(request)
     
-    logger.info(f"Incoming request: {request.method} {request.url.path}")
-    logger.info(f"Headers: {request.headers}")
+    client_ip = get_client_ip(request)
+    cost_class = route_class(path)
+    cost = ROUTE_COSTS[cost_class]
+    allowed, wait = limiter.acquire(client_ip, cost)
+    if not allowed:
+        metrics.RATE_LIMITED.inc(cost_class)
+        return JSONResponse(
+            status_code=429,
+            content={"detail": "Rate limit exceeded"},
+            headers={"Retry-After": limiter.retry_after(wait)}
+        )
     
-    start_time = time.time()
     response = await call_next(request)
-    duration = time.time() - start_time
     
-    logger.info(f"{real_ip} - {request.method} {request.url.path} - {response.status_code} - {duration:.2f}s")
+    # Streamed bodies (format=ndjson) call Home Assistant while they are sent,
+    # so whether a request was cheap is only known once its body is done
+    if cost > SERVED_FROM_CACHE_COST:
+        # The request's own dict (still empty here), filled in while the body is produced
+        timings = telemetry.current_timings()
+        if timings is None:
+            timings = {}
+        response.body_iterator = refund_if_cached(response.body_iterator, timings, client_ip, cost)
     return response
 
-# Global rate limit - using X-Forwarded-For for proper IP behind proxy
+async def refund_if_cached(body: AsyncIterator[bytes], timings: dict, client_ip: str, cost: float) -> AsyncIterator[bytes]:
+    """Pass the body through; if it was served without calling Home Assistant, keep only the base cost"""
+    async for chunk in body:
+        yield chunk
+    if "ha" not in timings:
+        limiter.refund(client_ip, cost - SERVED_FROM_CACHE_COST)
+
+# Request logging middleware
 @app.middleware("http")
-@limiter.limit("60/minute")
-async def global_rate_limit(request: Request, call_next):
+async def log_requests(request: Request, call_next):
+    # Get real IP from Nginx headers
+    forwarded_for = request.headers.get("X-Forwarded-For")
+    real_ip = forwarded_for.split(",")[0] if forwarded_for else request.client.host
+    
+    timings = telemetry.start_timings()
+    resilience.start_deadline(settings.HA_REQUEST_BUDGET)
+    start_time = time.perf_counter()
     response = await call_next(request)
+    duration = time.perf_counter() - start_time
+    
+    # Where the time went, visible in the browser's network panel
+    response.headers["Server-Timing"] = telemetry.server_timing_header(timings, duration * 1000)
+    
+    # Route template (e.g. /api/sensors/{sensor_id}/history), not the raw path
+    route = request.scope.get("route")
+    metrics.HTTP_DURATION.observe(
+        duration, route.path if route else "unmatched", request.method, str(response.status_code)
+    )
+    
+    if response.status_code >= 400 or telemetry.should_log_success():
+        logger.info(
+            f"{real_ip} - {request.method} {request.url.path} - {response.status_code} - {duration:.2f}s",
+            extra={
+                'client_ip': real_ip,
+                'method': request.method,
+                'path': request.url.path,
+                'status': response.status_code,
+                'duration_ms': round(duration * 1000, 1),
+                'timings_ms': {metric: round(ms, 1) for metric, ms in timings.items()}
+            }
+        )
     return response
 
 # Error handlers
@@ -78,6 +147,11 @@ async def global_exception_handler(request: Request, exc: Exception):
 
 app.include_router(router)
 
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Prometheus metrics; Nginx only allows this from localhost"""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 if __name__ == "__main__":
     import uvicorn
     
@@ -88,7 +162,11 @@ if __name__ == "__main__":
         "app": "main:app",
         "host": "127.0.0.1",  # Only listen on localhost since Nginx proxies
         "port": 8000,
-        "reload": is_dev
+        "reload": is_dev,
+        # Logging is set up by telemetry.setup_logging(), including uvicorn's loggers
+        "log_config": None,
+        # The request logging middleware already writes one (sampled) line per request
+        "access_log": False
     }
     
     uvicorn.run(**config) 
\ No newline at end of file
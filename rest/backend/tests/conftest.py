@@ -0,0 +1,10 @@
+import os
+import sys
+from pathlib import Path
+
+# Settings are read when app.config is imported; tests never reach a real Home Assistant
+os.environ.setdefault("HASS_URL", "http://homeassistant.test:8123")
+os.environ.setdefault("HASS_TOKEN", "test-token")
+os.environ.setdefault("SENSOR_IDS", "sensor.test_outdoor_temperature")
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
@@ -0,0 +1,68 @@
+import asyncio
+import json
+from typing import Dict, List, Optional, Tuple
+
+import websockets
+
+class FakeHomeAssistant:
+    """
+    Minimal Home Assistant WebSocket API: the auth handshake and
+    subscribe_entities with compressed states, enough for app.ha_websocket.
+    """
+
+    def __init__(self, token: str, states: Dict[str, dict]):
+        self.token = token
+        # entity_id -> compressed state ({'s': ..., 'a': {...}, 'lc': ...})
+        self.states = states
+        self.connections = 0
+        self.subscriptions: List[List[str]] = []
+        self._sockets: Dict[object, Tuple[int, List[str]]] = {}
+        self._server = None
+        self.url: Optional[str] = None
+
+    async def start(self) -> None:
+        self._server = await websockets.serve(self._handle, "127.0.0.1", 0)
+        port = self._server.sockets[0].getsockname()[1]
+        self.url = f"ws://127.0.0.1:{port}/api/websocket"
+
+    async def stop(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, ws) -> None:
+        self.connections += 1
+        await ws.send(json.dumps({'type': 'auth_required', 'ha_version': '2024.1.0'}))
+        auth = json.loads(await ws.recv())
+        if auth.get('type') != 'auth' or auth.get('access_token') != self.token:
+            await ws.send(json.dumps({'type': 'auth_invalid', 'message': 'Invalid access token'}))
+            return
+        await ws.send(json.dumps({'type': 'auth_ok', 'ha_version': '2024.1.0'}))
+
+        try:
+            async for raw in ws:
+                message = json.loads(raw)
+                if message.get('type') != 'subscribe_entities':
+                    await ws.send(json.dumps({'id': message.get('id'), 'type': 'result', 'success': False,
+                                              'error': {'code': 'unknown_command'}}))
+                    continue
+                entity_ids = message['entity_ids']
+                self.subscriptions.append(entity_ids)
+                self._sockets[ws] = (message['id'], entity_ids)
+                await ws.send(json.dumps({'id': message['id'], 'type': 'result', 'success': True, 'result': None}))
+                snapshot = {entity_id: self.states[entity_id] for entity_id in entity_ids if entity_id in self.states}
+                await ws.send(json.dumps({'id': message['id'], 'type': 'event', 'event': {'a': snapshot}}))
+        finally:
+            self._sockets.pop(ws, None)
+
+    async def change(self, entity_id: str, diff: dict) -> None:
+        """Send a compressed change to subscribers of the entity"""
+        for ws, (subscription_id, entity_ids) in list(self._sockets.items()):
+            if entity_id in entity_ids:
+                await ws.send(json.dumps({'id': subscription_id, 'type': 'event', 'event': {'c': {entity_id: diff}}}))
+
+    async def drop_connections(self) -> None:
+        """Close every client connection, as a Home Assistant restart would"""
+        for ws in list(self._sockets):
+            await ws.close()
+        while self._sockets:
+            await asyncio.sleep(0.01)
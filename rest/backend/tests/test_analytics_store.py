@@ -0,0 +1,59 @@
+import multiprocessing
+import time
+
+import pytest
+
+from app import analytics_store
+
+WORKERS = 6
+BATCHES = 20
+SHARED_IPS = 100  # Visit through every worker
+OWN_IPS = 50  # Visit through one worker only
+SESSION_DURATION = 1800
+
+def periods(timestamp: float):
+    return [('all', 'all'), ('daily', time.strftime('%Y-%m-%d', time.localtime(timestamp)))]
+
+def run_worker(db, worker: int, now: float, results) -> None:
+    """One worker process feeding batches of repeated visits into the shared store"""
+    analytics_store.ANALYTICS_DB = db
+    analytics_store._conn = None
+    new_sessions = 0
+    for batch in range(BATCHES):
+        timestamp = now + batch * 0.01
+        visits = [(f"shared-{i}", timestamp) for i in range(SHARED_IPS)]
+        visits += [(f"worker{worker}-{i}", timestamp) for i in range(OWN_IPS)]
+        new_sessions += analytics_store.apply_visits(visits, SESSION_DURATION, periods, int(now // 3600) - 23)
+    analytics_store.close_store()
+    results.put(new_sessions)
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason="needs fork")
+def test_concurrent_workers_count_each_session_once(tmp_path, monkeypatch):
+    db = tmp_path / 'analytics.db'
+    monkeypatch.setattr(analytics_store, 'ANALYTICS_DB', db)
+    monkeypatch.setattr(analytics_store, '_conn', None)
+
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    now = time.time()
+    processes = [context.Process(target=run_worker, args=(db, w, now, results)) for w in range(WORKERS)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+    expected = SHARED_IPS + WORKERS * OWN_IPS
+    assert sum(results.get(timeout=5) for _ in processes) == expected
+
+    snapshot = analytics_store.read_snapshot(int(now // 3600) - 23)
+    assert snapshot['total_visits'] == expected
+    assert sum(snapshot['hourly'].values()) == expected
+    assert analytics_store.active_sessions(now - SESSION_DURATION) == expected
+
+    # Small sets are in HyperLogLog's linear-counting range, close to exact
+    unique = snapshot['sketches'][('all', 'all')].count()
+    assert abs(unique - expected) <= expected * 0.02
+    daily = snapshot['sketches'][('daily', periods(now)[1][1])].count()
+    assert daily == unique
+    analytics_store.close_store()
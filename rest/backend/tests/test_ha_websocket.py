@@ -0,0 +1,105 @@
+import asyncio
+import time
+
+import pytest
+
+from app import ha_websocket
+from app.config import settings
+from fake_ha_websocket import FakeHomeAssistant
+
+TEMPERATURE = "sensor.station_outdoor_temperature"
+HUMIDITY = "sensor.station_humidity"
+UNRELATED = "light.kitchen"
+
+def initial_states() -> dict:
+    return {
+        TEMPERATURE: {'s': '21.5', 'a': {'unit_of_measurement': '°C', 'friendly_name': 'Temperature'}, 'lc': 1700000000.0},
+        HUMIDITY: {'s': '55', 'a': {'unit_of_measurement': '%'}, 'lc': 1700000000.0, 'lu': 1700000060.0},
+        UNRELATED: {'s': 'on', 'a': {}, 'lc': 1700000000.0},
+    }
+
+async def wait_until(condition, timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting for the WebSocket store")
+        await asyncio.sleep(0.01)
+
+@pytest.fixture
+def configured(monkeypatch):
+    monkeypatch.setattr(settings, 'SENSOR_IDS', f"{TEMPERATURE},{HUMIDITY}")
+    monkeypatch.setattr(settings, 'HA_WS_MAX_BACKOFF', 0.2)
+    monkeypatch.setattr(ha_websocket, 'sensor_store', {})
+
+@pytest.fixture
+def run_with_fake(configured, monkeypatch):
+    """run(token, scenario) runs scenario(fake) with the subscription pointed at a fake Home Assistant"""
+    def run(token: str, scenario) -> None:
+        async def main():
+            fake = FakeHomeAssistant(token, initial_states())
+            await fake.start()
+            monkeypatch.setattr(settings, 'HASS_WS_URL', fake.url)
+            ha_websocket.start()
+            try:
+                await scenario(fake)
+            finally:
+                await ha_websocket.stop()
+                await fake.stop()
+        asyncio.run(main())
+    return run
+
+def test_auth_and_initial_sync(run_with_fake):
+    async def scenario(fake):
+        await wait_until(ha_websocket.is_live)
+        assert fake.subscriptions == [[TEMPERATURE, HUMIDITY]]
+        states = ha_websocket.get_states(settings.sensor_list)
+        # Only the configured entities, expanded to REST state format
+        assert list(states) == [TEMPERATURE, HUMIDITY]
+        assert states[TEMPERATURE] == {
+            'entity_id': TEMPERATURE,
+            'state': '21.5',
+            'attributes': {'unit_of_measurement': '°C', 'friendly_name': 'Temperature'},
+            'last_changed': '2023-11-14T22:13:20+00:00',
+            'last_updated': '2023-11-14T22:13:20+00:00',
+        }
+        assert states[HUMIDITY]['last_updated'] == '2023-11-14T22:14:20+00:00'
+    run_with_fake(settings.HASS_TOKEN, scenario)
+
+def test_rejected_token_never_goes_live(run_with_fake):
+    async def scenario(fake):
+        await wait_until(lambda: fake.connections >= 2)
+        assert not ha_websocket.is_live()
+        assert fake.subscriptions == []
+    run_with_fake("another-token", scenario)
+
+def test_changes_are_applied(run_with_fake):
+    async def scenario(fake):
+        await wait_until(ha_websocket.is_live)
+        version = ha_websocket.store_version
+        await fake.change(TEMPERATURE, {'+': {'s': '22.0', 'lc': 1700000120.0, 'a': {'friendly_name': 'Outdoor'}}})
+        await fake.change(HUMIDITY, {'+': {'lu': 1700000180.0}, '-': {'a': ['unit_of_measurement']}})
+        await wait_until(lambda: ha_websocket.store_version >= version + 2)
+
+        temperature = ha_websocket.get_states([TEMPERATURE])[TEMPERATURE]
+        assert temperature['state'] == '22.0'
+        assert temperature['attributes'] == {'unit_of_measurement': '°C', 'friendly_name': 'Outdoor'}
+        assert temperature['last_changed'] == temperature['last_updated'] == '2023-11-14T22:15:20+00:00'
+
+        humidity = ha_websocket.get_states([HUMIDITY])[HUMIDITY]
+        assert humidity['state'] == '55'
+        assert humidity['attributes'] == {}
+        assert humidity['last_changed'] == '2023-11-14T22:13:20+00:00'
+        assert humidity['last_updated'] == '2023-11-14T22:16:20+00:00'
+    run_with_fake(settings.HASS_TOKEN, scenario)
+
+def test_reconnect_resyncs(run_with_fake):
+    async def scenario(fake):
+        await wait_until(ha_websocket.is_live)
+        # Changes made while the connection is down arrive with the next snapshot
+        fake.states[TEMPERATURE] = {'s': '18.0', 'a': {'unit_of_measurement': '°C'}, 'lc': 1700003600.0}
+        await fake.drop_connections()
+        await wait_until(lambda: fake.connections == 2 and ha_websocket.is_live())
+        await wait_until(lambda: ha_websocket.get_states([TEMPERATURE])[TEMPERATURE]['state'] == '18.0')
+        assert fake.subscriptions == [[TEMPERATURE, HUMIDITY]] * 2
+        assert ha_websocket.get_states([TEMPERATURE])[TEMPERATURE]['attributes'] == {'unit_of_measurement': '°C'}
+    run_with_fake(settings.HASS_TOKEN, scenario)
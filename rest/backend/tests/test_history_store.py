@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+from app import history_store, series
+
+ENTITY = 'sensor.test_outdoor_temperature'
+DAY = 86400
+# Midnight UTC, so every sample falls in the same 1d bucket
+START = 1_750_000_000 // DAY * DAY
+
+# 999 °C is outside the temperature range and must not show up anywhere
+SAMPLES = [
+    (START, '20.0', 20.0),
+    (START + 1200, '999', 999.0),
+    (START + 1800, '22.0', 22.0),
+]
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(history_store, 'HISTORY_DB', tmp_path / 'history.db')
+    asyncio.run(history_store.init_store())
+    yield
+    history_store.close_store()
+
+def rollups(granularity):
+    return asyncio.run(history_store.query_rollups(ENTITY, granularity, START, START + DAY))
+
+def test_out_of_range_sample_excluded_from_raw_and_rollups(store):
+    history_store._store_samples(ENTITY, SAMPLES, START, START + DAY)
+
+    _, values, _ = asyncio.run(series.load(ENTITY, START, START + DAY))
+    assert values.tolist() == [20.0, 22.0]
+
+    for granularity in history_store.ROLLUP_GRANULARITIES:
+        assert max(row[2] for row in rollups(granularity)) == 22.0
+        assert sum(row[4] for row in rollups(granularity)) == 2
+
+    (_, v_min, v_max, mean, count, last), = rollups('1d')
+    assert (v_min, v_max, mean, count, last) == (20.0, 22.0, 21.0, 2, 22.0)
+
+def test_rollups_rebuilt_without_out_of_range_samples(store):
+    history_store._store_samples(ENTITY, SAMPLES, START, START + DAY)
+    # A store whose rollups were built before out-of-range values were excluded
+    conn = history_store.get_connection()
+    with conn:
+        conn.execute("UPDATE rollups SET v_max = 999")
+        conn.execute("PRAGMA user_version = 0")
+
+    history_store._update_rollups()
+
+    (_, v_min, v_max, mean, count, last), = rollups('1d')
+    assert (v_min, v_max, mean, count, last) == (20.0, 22.0, 21.0, 2, 22.0)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == history_store.ROLLUP_VERSION
@@ -0,0 +1,43 @@
+import pytest
+
+from app.hll import HyperLogLog
+
+# Standard error for p=12 is about 1.6%; allow three of them
+MAX_RELATIVE_ERROR = 0.05
+
+def ids(start: int, stop: int):
+    return (f"visitor-{i}" for i in range(start, stop))
+
+@pytest.mark.parametrize("n", [1_000, 10_000, 100_000])
+def test_count_close_to_exact(n):
+    sketch = HyperLogLog.from_values(ids(0, n))
+    assert abs(sketch.count() - n) / n <= MAX_RELATIVE_ERROR
+
+def test_duplicates_do_not_change_count():
+    sketch = HyperLogLog.from_values(ids(0, 10_000))
+    before = sketch.count()
+    for value in ids(0, 10_000):
+        sketch.add(value)
+    assert sketch.count() == before
+
+def test_merge_equals_sketch_of_union():
+    # Overlapping sets: 0-60k and 40k-100k
+    a = HyperLogLog.from_values(ids(0, 60_000))
+    b = HyperLogLog.from_values(ids(40_000, 100_000))
+    union = HyperLogLog.from_values(ids(0, 100_000))
+
+    merged = a.copy().merge(b)
+    assert merged.registers == union.registers
+    assert abs(merged.count() - 100_000) / 100_000 <= MAX_RELATIVE_ERROR
+    # merge() must not change the sketch that was merged in
+    assert b.registers == HyperLogLog.from_values(ids(40_000, 100_000)).registers
+
+def test_merge_rejects_different_precision():
+    with pytest.raises(ValueError):
+        HyperLogLog(12).merge(HyperLogLog(10))
+
+def test_dict_round_trip():
+    sketch = HyperLogLog.from_values(ids(0, 5_000))
+    restored = HyperLogLog.from_dict(sketch.to_dict())
+    assert restored.registers == sketch.registers
+    assert restored.count() == sketch.count()
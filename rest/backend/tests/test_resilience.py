@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from app import resilience
+
+BUDGET = 0.05
+
+def run_with_budget(body):
+    async def main():
+        resilience.start_deadline(BUDGET)
+        result = await body()
+        # The deadline's cancellation must not reach the caller's next await
+        await asyncio.sleep(BUDGET * 2)
+        task = asyncio.current_task()
+        return result, task.cancelling() if hasattr(task, 'cancelling') else 0
+    return asyncio.run(main())
+
+async def slow_call():
+    async with resilience.within_deadline():
+        await asyncio.sleep(BUDGET * 10)
+
+async def swallowing_call():
+    # A library that catches the cancellation and finishes normally
+    async with resilience.within_deadline():
+        try:
+            await asyncio.sleep(BUDGET * 10)
+        except asyncio.CancelledError:
+            pass
+    return 'done'
+
+@pytest.fixture(params=['timeout_at', 'call_at'])
+def deadline_impl(request, monkeypatch):
+    if request.param == 'call_at':
+        monkeypatch.delattr(asyncio, 'timeout_at', raising=False)
+    elif not hasattr(asyncio, 'timeout_at'):
+        pytest.skip("asyncio.timeout_at needs Python 3.11")
+    return request.param
+
+def test_slow_call_raises_deadline_exceeded(deadline_impl):
+    async def body():
+        with pytest.raises(resilience.DeadlineExceeded):
+            await slow_call()
+    _, cancelling = run_with_budget(body)
+    if deadline_impl == 'timeout_at':
+        assert cancelling == 0
+
+def test_fast_call_is_not_cancelled(deadline_impl):
+    async def body():
+        async with resilience.within_deadline():
+            await asyncio.sleep(0)
+        return 'done'
+    assert run_with_budget(body)[0] == 'done'
+
+def test_swallowed_cancellation_does_not_escape(deadline_impl):
+    assert run_with_budget(swallowing_call)[0] == 'done'
+
+def test_without_deadline_nothing_is_cancelled():
+    async def main():
+        async with resilience.within_deadline():
+            await asyncio.sleep(BUDGET)
+        return 'done'
+    assert asyncio.run(main()) == 'done'